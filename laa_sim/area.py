@@ -1,9 +1,10 @@
 import numpy as np
-import scipy.signal
+
+from discretisation_cache import discretisation_cache
 
 
 class Area:
-    def __init__(self, area_num, m, matrixA, matrixB1, matrixB2, matrixC, controller, time_step_sec) -> None:
+    def __init__(self, area_num, m, matrixA, matrixB1, matrixB2, matrixC, time_step_sec) -> None:
         self._area_num = area_num
         self._m = m
         self._A = matrixA
@@ -11,7 +12,6 @@ class Area:
         self._B2 = matrixB2
         self._C = matrixC
         self._time_step_sec = time_step_sec
-        self.controller = controller
         self._set_discrete_matrices_from_const_matrices()
         
         
@@ -24,8 +24,7 @@ class Area:
         #Dd = np.zeros([1]) # always 0
         #dt = np.zeros([1]) # the same as time_step
 
-        Ad, Bd, Cd, _, _ = scipy.signal.cont2discrete(
-                                (self._A, B, self._C, 0), self._time_step_sec, method='zoh')
+        Ad, Bd, Cd = discretisation_cache.discretise(self._A, B, self._C, self._time_step_sec)
         self.Ad = Ad
         self.B1d = Bd[:, 0:2]
         self.B2d = Bd[:, 2:]
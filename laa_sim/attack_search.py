@@ -0,0 +1,318 @@
+import numpy as np
+import argparse
+import json
+
+from pathlib import Path
+
+from laa_scenarios import ScenariosParser
+from system_config import SystemConfig
+from simulation import build_fused_system
+from response_library import ResponseLibrary
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Search for the multistep LAA schedules with the largest frequency deviation within an attack budget.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of generators into areas, numbered from 1 as in the config.")
+    parser.add_argument("-t", "--sim_time_sec", type=int, default=300, help="The end time of the simulation in seconds.")
+    parser.add_argument("-a", "--areas", type=int, nargs="+", default=None, help="The areas which may be attacked. By default, all areas.")
+    parser.add_argument("-n", "--steps_per_area", type=int, default=3, help="The maximum number of steps of the attack in every area.")
+    parser.add_argument("-sr", "--strength_range", type=float, nargs=2, default=[0.0, 0.1], help="The minimum and maximum attack strength as a fraction of the load.")
+    parser.add_argument("-w", "--window_sec", type=float, nargs=2, default=[30, 240], help="The attack steps start within this time window in seconds.")
+    parser.add_argument("-r", "--resolution_sec", type=float, default=1, help="The attack steps start on a grid with this many seconds between the start times.")
+    parser.add_argument("-bg", "--budget", type=float, default=None, help="The total budget of the attack, the sum of |strength| x duration in seconds over all steps (a step lasts until the next step of the area or the end of the simulation). By default, only the strength range bounds the attack.")
+    parser.add_argument("-cn", "--candidates", type=int, default=500, help="The number of random start schedules to evaluate.")
+    parser.add_argument("-rf", "--refinements", type=int, default=200, help="The number of local refinements of the best schedules.")
+    parser.add_argument("-sc", "--score_resolution_sec", type=float, default=1, help="Candidates are scored from the responses sampled every this many seconds, the best ones are scored again at every time step.")
+    parser.add_argument("-k", "--top_k", type=int, default=5, help="The number of the worst schedules to output.")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="The seed of the random search.")
+    parser.add_argument("-o", "--output", type=str, default="results/worst_case_scenarios.json", help="The path to the JSON file with the worst schedules as scenarios.json entries.")
+    parser.add_argument("-cd", "--cache_dir", type=str, default=".cache/responses", help="The directory of the response library.")
+    parser.add_argument("-v", "--verify", action="store_true", help="Simulate the worst schedules with the fused engine and report the error of the superposition.")
+    args = parser.parse_args()
+    if args.budget is not None and args.budget < 0:
+        parser.error("The budget of the attack must not be negative.")
+    return args
+
+
+class AttackSearch:
+    # Worst-case search over multistep attack schedules. The closed loop is linear in the load,
+    # so the frequency deviation of any schedule is the free response plus the sum of shifted and
+    # scaled unit step responses of the areas. For fixed start times the deviation at every time
+    # and area is linear in the strengths, so the strengths maximising it are found exactly for all
+    # times and areas at once: at the bounds of the strength range, or with a total budget of
+    # |strength| x duration, by spending the budget on the steps of the largest effect per unit of
+    # the budget first. Only the start times are searched, by random sampling followed by local
+    # refinement of the best schedules. The start times lie on a grid, so candidates are scored in
+    # batches from the step responses sampled at score_resolution_sec (only the samples of their
+    # grid are touched), and the best ones are scored again exactly at every time step.
+    def __init__(self, library: ResponseLibrary, f0, score_resolution_sec=1.0) -> None:
+        self._library = library
+        self._responses = library.responses # areas x steps x areas, frequency deviation in per unit
+        self._free_response = library.free_response # steps x areas
+        self._steps = library.steps
+        self._time_step_sec = library.time_step_sec
+        self._f0 = f0
+        self._score_resolution_sec = score_resolution_sec
+
+
+    def evaluate(self, areas_attacks) -> np.ndarray:
+        # Frequency deviation in Hz (steps x areas) of a scenario parsed by ScenariosParser
+        return self._library.deviation(areas_attacks)*self._f0
+
+
+    def validate(self, fused_system, n, m, scenarios_attacks) -> list[float]:
+        return [error*self._f0 for error in self._library.validate(fused_system, n, m, scenarios_attacks)]
+
+
+    def optimise_strengths(self, areas, starts, strength_range, budget=None) -> tuple[float, np.ndarray, int, int]:
+        # starts - areas x steps start times in seconds, sorted in every area. Returns the largest
+        # absolute deviation in Hz at any time step, the strengths (areas x steps) reaching it, its
+        # time step and area. The deviation is -inf when the smallest strengths exceed the budget.
+        ticks = np.rint(np.asarray(starts) / self._time_step_sec).astype(int)
+        responses, free_response = self._sampled_responses(1)
+        levels = self._levels(responses, areas, ticks[None])
+        durations = self._durations(ticks[None])
+        deviation, t, area, sign = self._worst_cases(levels, free_response, durations, strength_range, budget)
+        if not np.isfinite(deviation[0]):
+            return -np.inf, None, int(t[0]), int(area[0])
+        strengths = self._strengths(sign[0]*levels[0, :, t[0], area[0]], durations[0], strength_range, budget)
+        return deviation[0]*self._f0, strengths.reshape(ticks.shape), int(t[0]), int(area[0])
+
+
+    def score(self, shifted, free_response, areas, grid_ticks, grid_indices, strength_range, budget=None) -> np.ndarray:
+        # Largest absolute deviation in per unit of every schedule (candidates x areas x steps indices
+        # of the grid of start times) at the sampled time steps, from the shifted_responses of the grid
+        candidates, steps_per_area = len(grid_indices), grid_indices.shape[2]
+        starts = grid_indices.reshape(candidates, -1)
+        # The last step of an area is never switched off, the zero responses after the grid
+        ends = np.concatenate([grid_indices[:, :, 1:], np.full([candidates, len(areas), 1], shifted.shape[1]-1)], axis=2)
+        # Rows of the flattened shifted responses, every one is copied whole
+        rows = np.repeat(areas, steps_per_area)[None]*shifted.shape[1]
+        table = shifted.reshape(-1, *shifted.shape[2:])
+        levels = np.take(table, rows + starts, axis=0) - np.take(table, rows + ends.reshape(candidates, -1), axis=0)
+        return self._worst_cases(levels, free_response, self._durations(grid_ticks[grid_indices]), strength_range, budget)[0]
+
+
+    def shifted_responses(self, grid_ticks, stride) -> tuple[np.ndarray, np.ndarray]:
+        # Step responses of the areas (areas x grid + 1 x samples x areas) starting at every start time
+        # of the grid and sampled at every stride-th time step, the last ones are zero, and the free response.
+        # They only rank the candidates, so single precision halves the memory traffic of the scoring.
+        responses, free_response = self._sampled_responses(stride)
+        samples = len(free_response)
+        shifts = np.append(grid_ticks // stride, 2*samples)
+        times = np.maximum(np.arange(samples)[None] - shifts[:, None] + 1, 0)
+        return responses[:, times].astype(np.float32), free_response.astype(np.float32)
+
+
+    def _sampled_responses(self, stride) -> tuple[np.ndarray, np.ndarray]:
+        # Step responses at every stride-th time step, after a zero sample for the steps not started yet
+        sampled = self._responses[:, ::stride]
+        return np.concatenate([np.zeros_like(sampled[:, :1]), sampled], axis=1), self._free_response[::stride]
+
+
+    def _levels(self, responses, areas, ticks) -> np.ndarray:
+        # Response (candidates x steps x samples x areas) to the unit strength of every step, which
+        # holds from its start until the next step of the area. ticks are in samples of responses.
+        candidates, samples = len(ticks), responses.shape[1] - 1
+        starts = ticks.reshape(candidates, -1)
+        # The last step of an area is never switched off within the simulation
+        ends = np.concatenate([ticks[:, :, 1:], np.full([candidates, len(areas), 1], 2*samples)], axis=2).reshape(candidates, -1)
+        step_areas = np.repeat(areas, ticks.shape[2])[None, :, None]
+        times = np.arange(samples)[None, None]
+        return (responses[step_areas, np.maximum(times - starts[:, :, None] + 1, 0)]
+                - responses[step_areas, np.maximum(times - ends[:, :, None] + 1, 0)])
+
+
+    def _durations(self, ticks) -> np.ndarray:
+        # Seconds from the start of every step (candidates x steps) until the next step of the area or the end
+        ends = np.concatenate([ticks[:, :, 1:], np.full([len(ticks), ticks.shape[1], 1], self._steps)], axis=2)
+        return ((ends - ticks)*self._time_step_sec).reshape(len(ticks), -1)
+
+
+    def _worst_cases(self, levels, free_response, durations, strength_range, budget):
+        # Largest absolute deviation (per unit) of every candidate with its time, area and direction (1 up, -1 down)
+        low, high = strength_range
+        base = min(max(0.0, low), high) # The strength of the smallest magnitude
+        candidates = np.arange(len(levels))
+        best = np.full(len(levels), -np.inf)
+        best_t, best_area, best_sign = (np.zeros(len(levels), dtype=int) for _ in range(3))
+        if budget is None:
+            # max(low*l, high*l) = high*max(l, 0) + low*min(l, 0), so both directions need only two sums over the steps
+            rises = np.maximum(levels, 0).sum(axis=1)
+            falls = levels.sum(axis=1) - rises
+        for sign in (1, -1):
+            if budget is None:
+                deviation = (free_response + high*rises + low*falls if sign == 1
+                             else -free_response - high*falls - low*rises)
+            else:
+                # Effect of the strengths on the deviation in the direction, steps last to sort them per time and area
+                gains = np.moveaxis(sign*levels, 1, -1).copy()
+                remaining = budget - abs(base)*durations.sum(axis=1)
+                deviation = (sign*free_response + base*gains.sum(axis=-1)
+                             + self._budget_gains(gains, durations, remaining, low, high, base))
+                deviation[remaining < 0] = -np.inf
+            flat = deviation.reshape(len(levels), -1)
+            index = flat.argmax(axis=1)
+            better = flat[candidates, index] > best
+            t, area = np.unravel_index(index, deviation.shape[1:])
+            best = np.where(better, flat[candidates, index], best)
+            best_t, best_area = np.where(better, t, best_t), np.where(better, area, best_area)
+            best_sign = np.where(better, sign, best_sign)
+        return best, best_t, best_area, best_sign
+
+
+    def _budget_gains(self, gains, durations, remaining, low, high, base) -> np.ndarray:
+        # Moving the strength of a step from base towards the bound in the direction of its gain
+        # costs its duration per unit of strength. The best use of the remaining budget R is the
+        # value of the dual min over prices p >= 0 of p*R + sum(max(value - p*cost, 0)), reached
+        # at p = 0 or at the value per cost of one of the steps, so no sorting is needed.
+        # gains - candidates x samples x areas x steps
+        moves = np.where(gains > 0, high - base, low - base)
+        costs = np.abs(moves)*durations[:, None, None]
+        values = gains*moves
+        with np.errstate(divide="ignore", invalid="ignore"):
+            prices = np.where(costs > 0, values/costs, 0)
+        remaining = remaining[:, None, None]
+        best = values.sum(axis=-1)
+        for k in range(values.shape[-1]):
+            price = prices[..., k]
+            best = np.minimum(best, price*remaining + np.maximum(values - price[..., None]*costs, 0).sum(axis=-1))
+        return best
+
+
+    def _strengths(self, gains, durations, strength_range, budget) -> np.ndarray:
+        # Strengths of the steps reaching the largest deviation, for the gains of one time and area
+        low, high = strength_range
+        if budget is None:
+            return np.where(gains > 0, high, low)
+        base = min(max(0.0, low), high)
+        moves = np.where(gains > 0, high - base, low - base)
+        costs = np.abs(moves)*durations
+        remaining = budget - abs(base)*durations.sum()
+        strengths = np.full(len(gains), base)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            order = np.argsort(-np.where(costs > 0, gains*moves/costs, 0))
+        for k in order:
+            if costs[k] > 0 and remaining > 0:
+                fraction = min(remaining/costs[k], 1.0)
+                strengths[k] += fraction*moves[k]
+                remaining -= fraction*costs[k]
+        return strengths
+
+
+    def search(self, areas, steps_per_area, strength_range, window_sec, resolution_sec, candidates,
+               refinements, top_k, seed=None, budget=None, batch_size=256) -> list[dict]:
+        rng = np.random.default_rng(seed)
+        grid = np.round(np.arange(window_sec[0], window_sec[1] + resolution_sec/2, resolution_sec), 6)
+        if len(grid) < steps_per_area:
+            raise ValueError(f"The window holds only {len(grid)} start times, fewer than {steps_per_area} steps per area.")
+        grid_ticks = np.rint(grid / self._time_step_sec).astype(int)
+        # The scored time steps include all start times, so the responses are shifted by whole samples
+        stride = int(np.gcd.reduce(np.append(grid_ticks, max(int(round(self._score_resolution_sec/self._time_step_sec)), 1))))
+
+        shifted, free_response = self.shifted_responses(grid_ticks, stride)
+        scores = {}
+        def score(schedules):
+            new = {}
+            for grid_indices in schedules:
+                grid_indices = np.sort(grid_indices, axis=1)
+                if grid_indices.tobytes() not in scores:
+                    new[grid_indices.tobytes()] = grid_indices
+            new = list(new.values())
+            for start in range(0, len(new), batch_size):
+                batch = np.array(new[start:start+batch_size])
+                for grid_indices, deviation in zip(batch, self.score(shifted, free_response, areas, grid_ticks, batch,
+                                                                     strength_range, budget)):
+                    scores[grid_indices.tobytes()] = (deviation, grid_indices)
+
+        def best(count):
+            return sorted(scores.values(), key=lambda scored: -scored[0])[:count]
+
+        score([np.array([rng.choice(len(grid), steps_per_area, replace=False) for _ in areas]) for _ in range(candidates)])
+
+        # Move one start time of one of the best schedules, a batch of moves at a time,
+        # better schedules join the best ones
+        for start in range(0, refinements, batch_size):
+            leaders = best(top_k)
+            moved_schedules = []
+            for _ in range(min(batch_size, refinements - start)):
+                grid_indices = leaders[rng.integers(len(leaders))][1].copy()
+                i, j = rng.integers(len(areas)), rng.integers(steps_per_area)
+                shift = rng.choice([-1, 1]) * max(1, int(rng.geometric(0.2)))
+                moved = int(np.clip(grid_indices[i, j] + shift, 0, len(grid)-1))
+                if moved not in grid_indices[i]:
+                    grid_indices[i, j] = moved
+                    moved_schedules.append(grid_indices)
+            score(moved_schedules)
+
+        # The best sampled schedules are scored again exactly, at every time step. Sampling may
+        # miss the peak of a schedule, so more of them are kept than reported.
+        exact = []
+        for _, grid_indices in best(max(4*top_k, 32)):
+            deviation, strengths, t, area = self.optimise_strengths(areas, grid[grid_indices], strength_range, budget)
+            if np.isfinite(deviation):
+                exact.append({"deviation_Hz": deviation, "grid_indices": grid_indices, "strengths": strengths,
+                              "time_sec": t*self._time_step_sec, "area": area})
+
+        results = []
+        for result in sorted(exact, key=lambda result: -result["deviation_Hz"]):
+            scenario = self._to_scenario(areas, grid[result["grid_indices"]], result["strengths"])
+            if any(scenario == other["areas_attacks"] for other in results):
+                continue
+            durations = self._durations(grid_ticks[result["grid_indices"]][None])[0]
+            results.append({"areas_attacks": scenario, "deviation_Hz": result["deviation_Hz"],
+                            "time_sec": result["time_sec"], "area": result["area"] + 1,
+                            "budget_used": float(np.abs(result["strengths"]).ravel() @ durations)})
+            if len(results) == top_k:
+                break
+        return results
+
+
+    def _to_scenario(self, areas, starts, strengths) -> list[dict]:
+        # scenarios.json layout, consecutive steps of the same strength are merged
+        n = self._free_response.shape[1]
+        areas_attacks = [{"starts": [], "strengths": []} for _ in range(n)]
+        for i, area in enumerate(areas):
+            level = 0
+            for start, strength in zip(starts[i], strengths[i]):
+                if strength != level:
+                    areas_attacks[area]["starts"].append(float(start))
+                    areas_attacks[area]["strengths"].append(float(strength))
+                    level = strength
+        return areas_attacks
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = SystemConfig.load(args.config)
+    gen_params = config.split(args.split)
+    time_step_sec = config.time_step_sec
+    fused_system = build_fused_system(gen_params, config.K, config.setpoint, time_step_sec)
+
+    steps = int(args.sim_time_sec/time_step_sec)
+    search = AttackSearch(ResponseLibrary(fused_system, steps, time_step_sec, args.cache_dir), gen_params.f0,
+                          args.score_resolution_sec)
+    areas = [area-1 for area in args.areas] if args.areas else list(range(gen_params.n))
+    results = search.search(areas, args.steps_per_area, args.strength_range, args.window_sec, args.resolution_sec,
+                            args.candidates, args.refinements, args.top_k, args.seed, args.budget)
+    if not results:
+        raise SystemExit("No schedule fits the budget, the smallest strengths of the steps already exceed it.")
+
+    scenarios = []
+    for rank, result in enumerate(results):
+        scenarios.append({"name": f"Worst_case_{rank+1}",
+                          "description": f"Worst-case schedule {rank+1}: {round(result["deviation_Hz"], 4)} Hz frequency deviation in area {result["area"]} at {round(result["time_sec"], 2)} s, budget used {round(result["budget_used"], 4)}",
+                          "areas_attacks": result["areas_attacks"]})
+        print(scenarios[-1]["description"])
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(scenarios, f, indent=4)
+    print(f"Worst schedules saved to {args.output}")
+
+    if args.verify:
+        scenarios_attacks = [scenario["areas_attacks"] for scenario in ScenariosParser(args.output, args.sim_time_sec).get_all_scenarios()]
+        errors = search.validate(fused_system, gen_params.n, gen_params.m, scenarios_attacks)
+        for scenario, error in zip(scenarios, errors):
+            print(f"{scenario["name"]}: superposition error {error:.3e} Hz")
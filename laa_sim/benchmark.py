@@ -0,0 +1,263 @@
+import numpy as np
+import argparse
+import importlib
+import itertools
+import platform
+import subprocess
+import tempfile
+import sys
+import json
+import time
+
+from pathlib import Path
+
+from genparams import GenParams
+from system_config import SystemConfig
+from laa_scenarios import ScenariosParser
+from matrices import MatrixA, MatrixB1, MatrixB2, MatrixC
+from area import Area
+from topology import Topology
+from results_store import RESULTS_FORMATS
+from discretisation_cache import discretisation_cache
+from utils import freq_per_unit_to_Hz
+from main import build_simulation
+
+
+# Modules that dominate the start of the interpreter, none of them is needed by main.py before it plots
+HEAVY_MODULES = ["matplotlib", "seaborn", "pandas", "scipy", "numba"]
+# (engine, backend) of Simulation for every benchmarked engine, batch is the fused engine over all scenarios at once
+ENGINES = {"loop": ("loop", "numpy"), "fused": ("fused", "numpy"), "batch": ("fused", "numpy"),
+           "sparse": ("sparse", "numpy"), "segmented": ("segmented", "numpy"), "numba": ("fused", "numba")}
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Time every stage of the simulation pipeline over a grid of horizons, time steps, area counts and scenario counts, and flag regressions against a baseline.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file with the scenarios, the first ones are used (repeated if there are fewer).")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of the config used when the number of areas equals its number of areas.")
+    parser.add_argument("-t", "--horizons_sec", type=float, nargs="+", default=[60, 300], help="The simulation times in seconds.")
+    parser.add_argument("-dt", "--time_steps_sec", type=float, nargs="+", default=None, help="The time steps in seconds. By default, the time step of the config.")
+    parser.add_argument("-n", "--areas", type=int, nargs="+", default=None, help="The numbers of areas. The config is used for its number of areas, other systems are generated rings. By default, only the config.")
+    parser.add_argument("-u", "--units_per_area", type=int, default=3, help="The number of units in every area of the generated rings.")
+    parser.add_argument("-ns", "--scenarios", type=int, nargs="+", default=[1], help="The numbers of scenarios simulated in one run.")
+    parser.add_argument("-en", "--engines", type=str, nargs="+", default=["fused", "loop"], choices=list(ENGINES), help="The engines to benchmark.")
+    parser.add_argument("-rf", "--results_format", type=str, default="npy", choices=RESULTS_FORMATS, help="The format of the written results.")
+    parser.add_argument("-np", "--no_plot", action="store_true", help="Do not time the rendering of the plots.")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Every case is run this many times, the fastest time of every stage is kept.")
+    parser.add_argument("-p", "--parity", action="store_true", help="Also check that the engines reproduce the trajectories of the reference loop.")
+    parser.add_argument("-pt", "--parity_tolerance", type=float, default=1e-8, help="The largest allowed absolute difference from the reference loop.")
+    parser.add_argument("-su", "--startup", action="store_true", help="Only time the start of main.py (the interpreter and the imports) and check it against --startup_budget_sec.")
+    parser.add_argument("-sb", "--startup_budget_sec", type=float, default=0.5, help="The longest allowed start of main.py in seconds.")
+    parser.add_argument("-o", "--output", type=str, default="results/benchmark.json", help="The path to the JSON file with the timings.")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help="The JSON file of an earlier run to compare with.")
+    parser.add_argument("-tol", "--tolerance", type=float, default=0.2, help="A stage is a regression when it is slower than the baseline by more than this fraction.")
+    parser.add_argument("-ms", "--min_sec", type=float, default=0.005, help="Differences from the baseline shorter than this many seconds are ignored as noise.")
+    args = parser.parse_args()
+    if not args.startup:
+        # Before the first attack the system stays at rest, such a run would time and compare only zeros
+        n_config = SystemConfig.load(args.config).n
+        library = load_library(args)
+        for n, count, sim_time_sec in itertools.product(args.areas or [n_config], args.scenarios, args.horizons_sec):
+            first_attack = min((attack["start"] for scenario in case_scenarios(library, n, count)
+                                for area_attacks in scenario["areas_attacks"] for attack in area_attacks), default=np.inf)
+            if first_attack >= sim_time_sec:
+                parser.error(f"the horizon of {sim_time_sec} s ends before the first attack of {count} scenarios of "
+                             f"{args.file_path} with {n} areas at {first_attack} s, the trajectories would be all zero")
+    return args
+
+
+def load_library(args) -> list[dict]:
+    # The first scenarios of the file, as many as the largest run
+    parser = ScenariosParser(args.file_path, max(args.horizons_sec))
+    return list(itertools.islice(parser.iter_scenarios(), max(args.scenarios)))
+
+
+def case_scenarios(library, n, count) -> list[dict]:
+    # The library repeated to count scenarios, attacks of missing areas are empty, as in topology.py
+    return [dict(scenario, areas_attacks=(scenario["areas_attacks"] + [[]]*n)[:n])
+            for scenario in itertools.islice(itertools.cycle(library), count)]
+
+
+def ring_system(n, units_per_area, seed=0) -> tuple[GenParams, np.ndarray, float]:
+    # GenParams, K and setpoint of a generated ring of areas (see Topology.generate_ring)
+    topology = Topology(Topology.generate_ring(n, units_per_area, seed))
+    alpha = np.split(topology.alpha, np.cumsum(topology.m)[:-1])
+    gen_params = GenParams(topology.f0, topology.base_MV, n, topology.m, topology.D, topology.H, topology.Tt,
+                           topology.Tg, topology.R, alpha, topology.Tij.toarray())
+    return gen_params, topology.K, topology.setpoint
+
+
+def benchmark_case(gen_params, K, setpoint, time_step_sec, sim_time_sec, scenarios, engine, results_format,
+                   plot, workdir) -> dict:
+    # Times of the stages of one run of the pipeline in seconds
+    times = {}
+    n, m = gen_params.n, gen_params.m
+
+    start = time.perf_counter()
+    matrices = [(MatrixA(m[i], gen_params.D[i], gen_params.H[i], gen_params.Tt[i], gen_params.Tg[i], gen_params.R[i],
+                         gen_params.Tij[i]).get_A(), MatrixB1(m[i], gen_params.H[i]).get_B1(),
+                 MatrixB2(m[i], gen_params.Tg[i], gen_params.alpha[i]).get_B2(), MatrixC(m[i], gen_params.beta[i]).get_C())
+                for i in range(n)]
+    times["matrices"] = time.perf_counter() - start
+
+    discretisation_cache.clear()
+    start = time.perf_counter()
+    areas = [Area(i+1, m[i], *matrices[i], time_step_sec) for i in range(n)]
+    times["discretisation"] = time.perf_counter() - start
+
+    indexes = np.arange(int(sim_time_sec/time_step_sec))
+    T = np.array(indexes*time_step_sec, dtype=np.float64)
+    simulation_engine, backend = ENGINES[engine]
+    start = time.perf_counter()
+    simulations = [build_simulation(gen_params, K, setpoint, time_step_sec, T, indexes, scenario, simulation_engine,
+                                    results_format, backend) for scenario in scenarios]
+    times["vectors"] = time.perf_counter() - start
+
+    for simulation, scenario in zip(simulations, scenarios):
+        simulation._scenario = scenario
+        simulation._Areas = areas
+        simulation._results_path = str(workdir)
+        simulation._csv_path = str(Path(workdir, "csv"))
+    start = time.perf_counter()
+    if engine == "batch":
+        first = simulations[0]
+        first._get_fused_system_class()(areas, first._Tij, first._K, first._setpoint, time_step_sec).simulate_batch(
+            [simulation._x for simulation in simulations], [simulation._w for simulation in simulations],
+            [simulation._u for simulation in simulations], [simulation._y for simulation in simulations], indexes)
+    else:
+        for simulation in simulations:
+            simulation._simulate_LFC_power_system()
+    times["stepping"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for simulation in simulations:
+        simulation._reduce_results()
+    times["reduce"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for simulation in simulations:
+        simulation._save_data_to_file()
+    times["write"] = time.perf_counter() - start
+
+    if plot:
+        from plotting import render_LFC_results
+        start = time.perf_counter()
+        for s, (simulation, scenario) in enumerate(zip(simulations, scenarios)):
+            freqs = [freq_per_unit_to_Hz(x[:, 0], gen_params.f0) for x in simulation._x]
+            render_LFC_results(str(Path(workdir, f"plot_{s}.png")), scenario["description"], T, freqs,
+                               None, None, None, None, gen_params.f0)
+        times["plot"] = time.perf_counter() - start
+    trajectories = [[*simulation._x, simulation._w, simulation._u, simulation._y] for simulation in simulations]
+    return {"stages": times, "trajectories": trajectories}
+
+
+def benchmark_startup(repeats, budget_sec) -> dict:
+    # Start of a new interpreter alone and importing main.py (the fastest of the repeats),
+    # with the heavy modules imported by main.py
+    def start(code):
+        begin = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent, check=True,
+                                capture_output=True, text=True).stdout
+        return time.perf_counter() - begin, output
+
+    interpreter = min(start("pass")[0] for _ in range(repeats))
+    runs = [start(f"import sys, main; print(' '.join(sorted({{name.split('.')[0] for name in sys.modules}} & {set(HEAVY_MODULES)})))")
+            for _ in range(repeats)]
+    total = min(run[0] for run in runs)
+    stages = {"interpreter": interpreter, "imports": total - interpreter}
+    return {"key": "startup", "engine": "startup", "stages": stages, "total_sec": total,
+            "heavy_modules": runs[0][1].split(), "budget_sec": budget_sec, "within_budget": total <= budget_sec}
+
+
+def max_abs_diff(trajectories, reference) -> float:
+    # All engines leave ACE and tie-lines of the last time step at zero like the reference loop, so every row is compared
+    return max(float(np.max(np.abs(a - b)))
+               for scenario, reference_scenario in zip(trajectories, reference)
+               for a, b in zip(scenario, reference_scenario))
+
+
+def run_benchmarks(args) -> list[dict]:
+    importlib.import_module("scipy.signal") # Imported before timing, so that the discretisation of the first case does not time the import
+    config = SystemConfig.load(args.config)
+    time_steps_sec = args.time_steps_sec or [config.time_step_sec]
+    library = load_library(args)
+    cases = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in args.areas or [config.n]:
+            if n == config.n:
+                gen_params, K, setpoint = config.split(args.split), config.K, config.setpoint
+            else:
+                gen_params, K, setpoint = ring_system(n, args.units_per_area)
+            for time_step_sec, sim_time_sec, count in itertools.product(time_steps_sec, args.horizons_sec, args.scenarios):
+                scenarios = case_scenarios(library, n, count)
+                reference = None
+                for engine in args.engines:
+                    if engine == "batch" and count == 1:
+                        continue
+                    runs = [benchmark_case(gen_params, K, setpoint, time_step_sec, sim_time_sec, scenarios, engine,
+                                           args.results_format, not args.no_plot, workdir) for _ in range(args.repeats)]
+                    stages = {stage: min(run["stages"][stage] for run in runs) for stage in runs[0]["stages"]}
+                    case = {"key": f"n{n}_dt{time_step_sec}_t{sim_time_sec}_s{count}_{engine}", "areas": n,
+                            "time_step_sec": time_step_sec, "sim_time_sec": sim_time_sec, "scenarios": count,
+                            "engine": engine, "stages": stages, "total_sec": sum(stages.values())}
+                    if args.parity:
+                        if reference is None:
+                            reference = benchmark_case(gen_params, K, setpoint, time_step_sec, sim_time_sec, scenarios,
+                                                       "loop", args.results_format, False, workdir)["trajectories"]
+                        case["max_abs_diff"] = max_abs_diff(runs[0]["trajectories"], reference)
+                        case["parity"] = case["max_abs_diff"] <= args.parity_tolerance
+                    cases.append(case)
+                    print(f"{case['key']}: {round(case['total_sec'], 4)} s ("
+                          + ", ".join(f"{stage} {round(sec, 4)}" for stage, sec in stages.items())
+                          + (f", parity {case['max_abs_diff']:.2e}" if args.parity else "") + ")")
+    return cases
+
+
+def find_regressions(cases, baseline_cases, tolerance, min_sec) -> list[dict]:
+    # Stages (and totals) slower than in the baseline case with the same key
+    baseline = {case["key"]: case for case in baseline_cases}
+    regressions = []
+    for case in cases:
+        if case["key"] not in baseline:
+            continue
+        before = dict(baseline[case["key"]]["stages"], total=baseline[case["key"]]["total_sec"])
+        after = dict(case["stages"], total=case["total_sec"])
+        for stage in after:
+            if stage in before and after[stage] - before[stage] > max(tolerance*before[stage], min_sec):
+                regressions.append({"key": case["key"], "stage": stage, "baseline_sec": before[stage],
+                                    "sec": after[stage], "ratio": after[stage]/before[stage]})
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.startup:
+        cases = [benchmark_startup(args.repeats, args.startup_budget_sec)]
+        print(f"Start of main.py: {round(cases[0]['total_sec'], 4)} s (interpreter {round(cases[0]['stages']['interpreter'], 4)} s, "
+              f"imports {round(cases[0]['stages']['imports'], 4)} s), heavy modules: {cases[0]['heavy_modules'] or 'none'}")
+    else:
+        cases = run_benchmarks(args)
+    report = {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": cases}
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Timings of {len(cases)} cases saved to {args.output}")
+
+    failures = [case for case in cases if not case.get("parity", True) or not case.get("within_budget", True)]
+    for case in failures:
+        if "budget_sec" in case:
+            print(f"BUDGET {case['key']}: {round(case['total_sec'], 4)} s over the budget of {case['budget_sec']} s")
+        else:
+            print(f"PARITY {case['key']}: {case['max_abs_diff']:.3e} from the reference loop")
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(cases, json.load(f)["cases"], args.tolerance, args.min_sec)
+        for regression in regressions:
+            print(f"REGRESSION {regression['key']} {regression['stage']}: {round(regression['sec'], 4)} s, "
+                  f"{round(regression['ratio'], 2)}x the baseline {round(regression['baseline_sec'], 4)} s")
+        print(f"{len(regressions)} regressions against {args.baseline}")
+    if failures or regressions:
+        raise SystemExit(1)
@@ -0,0 +1,117 @@
+import numpy as np
+import pickle
+
+from fused_system import FusedSystem
+from utils import atomic_write
+
+
+class Checkpoint:
+    # Full state of the simulation at a tick: the state vectors of the areas, the LFC outputs and
+    # the error history of the PID controllers, plus anything needed to continue a run (extra).
+    def __init__(self, tick, x, u, prev_error, second_prev_error, extra=None) -> None:
+        self.tick = tick
+        self.x = x
+        self.u = u
+        self.prev_error = prev_error
+        self.second_prev_error = second_prev_error
+        self.extra = extra or {}
+
+
+    @classmethod
+    def from_state(cls, system: FusedSystem, z, tick, extra=None) -> "Checkpoint":
+        return cls(tick, [z[xi].copy() for xi in system.x_slices], z[system.u_indices].copy(),
+                   z[system.e1_indices].copy(), z[system.e2_indices].copy(), extra)
+
+
+    def to_state(self, system: FusedSystem) -> np.ndarray:
+        z = np.zeros(system.size)
+        for xi, x in zip(system.x_slices, self.x):
+            z[xi] = x
+        z[system.u_indices] = self.u
+        z[system.e1_indices] = self.prev_error
+        z[system.e2_indices] = self.second_prev_error
+        return z
+
+
+    @classmethod
+    def load(cls, path) -> "Checkpoint":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+    def save(self, path) -> None:
+        # An interrupted save never replaces the last checkpoint
+        with atomic_write(path) as f:
+            pickle.dump(self, f)
+
+
+class PrefixCache:
+    # Trie of the load histories of the simulated scenarios. The load of a scenario is split into
+    # segments of constant load, every node holds a segment (load, end tick) and the vectors of the
+    # first scenario that went through it. A new scenario follows the trie while its loads agree,
+    # copies the rows of the shared prefix and is simulated only from the snapshot at its end,
+    # e.g. all static scenarios starting at 30 s share the quiet first 30 s, and a multistep
+    # scenario shares its first step with the static scenario of the same strength.
+    def __init__(self, system: FusedSystem) -> None:
+        self._system = system
+        self._roots = {}
+        self.reused_steps = 0
+        self.simulated_steps = 0
+
+
+    def simulate(self, x, w, u, y, indices) -> int:
+        # Fills the vectors like FusedSystem.simulate, returns the number of reused ticks
+        steps = len(indices)
+        if not np.array_equal(indices, np.arange(steps)):
+            raise ValueError("Prefix reuse requires all time steps from the start of the simulation.")
+        load = w[:, :, 0]
+        ends = np.concatenate([np.flatnonzero(np.any(load[1:] != load[:-1], axis=1)) + 1, [steps]])
+        starts = np.concatenate([[0], ends[:-1]])
+
+        z0 = self._system.initial_state(x, u)
+        node = self._roots.setdefault(z0.tobytes(), {})
+        shared, source, segment = 0, None, 0
+        while segment < len(starts):
+            # Children of a node by the load of the segment, then by its end
+            children = node.get(load[starts[segment]].tobytes(), {})
+            end = int(ends[segment])
+            if end in children:
+                source, node = children[end]
+                shared = end
+                segment += 1
+                continue
+            if children:
+                # A sibling with the same load ends earlier or later, the shorter part is shared
+                child_end = max(children, key=lambda child_end: min(child_end, end))
+                if min(child_end, end) > shared:
+                    shared, source = min(child_end, end), children[child_end][0]
+            break
+
+        if shared == steps:
+            self._copy_rows(source, x, w, u, y, steps, steps)
+        elif shared > 0:
+            self._copy_rows(source, x, w, u, y, shared+1, shared)
+            source_x, _, source_u, source_y = source
+            self._system.simulate_from(self._system.state_at(source_x, source_u, source_y, shared), x, w, u, y, shared)
+        else:
+            self._system.simulate_from(z0, x, w, u, y, 0)
+        self.reused_steps += shared
+        self.simulated_steps += steps - shared
+
+        # Segments after the matched ones are added with this scenario as their source
+        for start, end in zip(starts[segment:], ends[segment:]):
+            child = {}
+            node.setdefault(load[start].tobytes(), {})[int(end)] = ((x, w, u, y), child)
+            node = child
+        return shared
+
+
+    def _copy_rows(self, source, x, w, u, y, states, outputs) -> None:
+        # The states and LFC outputs up to the tick (states rows) depend only on the loads before it,
+        # ACE and tie-lines (outputs rows) are computed from the states of the same tick
+        source_x, source_w, source_u, source_y = source
+        for xi, source_xi in zip(x, source_x):
+            xi[:states] = source_xi[:states]
+        u[:states] = source_u[:states]
+        y[:outputs] = source_y[:outputs]
+        w[:outputs, :, 1] = source_w[:outputs, :, 1]
@@ -0,0 +1,107 @@
+import numpy as np
+import warnings
+
+from area import Area
+from controller import PIDControllerBank
+from fused_system import FusedSystem
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _simulate_kernel(Ad, B1d, B2d, Cd, starts, sizes, matrix_starts, Tij, Kp, Ki, Kd, setpoints, time_step,
+                     load, x, u, y, tie_lines):
+    # The per-area stepping loop over flat arrays: x is time x states of all areas (area i at
+    # starts[i]:starts[i]+sizes[i]), Ad holds the flattened Ad blocks of the areas (area i at
+    # matrix_starts[i]), B1d is states x 2, B2d and Cd are flat over the states of all areas.
+    steps, n = load.shape
+    prev_error = np.zeros(n)
+    second_prev_error = np.zeros(n)
+    for t in range(1, steps):
+        for i in range(n):
+            v = 0.0
+            for j in range(n):
+                v += Tij[i, j]*x[t-1, starts[j]]
+            tie_lines[t-1, i] = v
+
+            start, size, matrix_start = starts[i], sizes[i], matrix_starts[i]
+            for r in range(size):
+                acc = 0.0
+                for c in range(size):
+                    acc += Ad[matrix_start + r*size + c]*x[t-1, start+c]
+                x[t, start+r] = acc + B1d[start+r, 0]*load[t-1, i] + B1d[start+r, 1]*v + B2d[start+r]*u[t-1, i]
+
+            ace = 0.0
+            for c in range(size):
+                ace += Cd[start+c]*x[t-1, start+c]
+            y[t-1, i] = ace
+
+            error = setpoints[i] - ace
+            proportional = error - prev_error[i]
+            integral = error*time_step
+            derivative = (error - 2*prev_error[i] + second_prev_error[i])/time_step
+            second_prev_error[i] = prev_error[i]
+            prev_error[i] = error
+            u[t, i] = u[t-1, i] + Kp[i]*proportional + Ki[i]*integral + Kd[i]*derivative
+
+
+if numba is not None:
+    _simulate_kernel = numba.njit(cache=True)(_simulate_kernel)
+
+
+class CompiledSystem:
+    # Whole LFC step (area dynamics, Tij tie-lines, ACE via Cd, PID update) as a Numba nopython
+    # kernel over flat arrays. Without Numba it falls back to the NumPy FusedSystem.
+    def __init__(self, areas: list[Area], Tij, K, setpoint, time_step_sec) -> None:
+        self._n = len(areas)
+        self._time_step_sec = time_step_sec
+        if numba is None:
+            warnings.warn("Numba is not installed, falling back to the NumPy fused engine.")
+            self._fallback = FusedSystem(areas, Tij, K, setpoint, time_step_sec)
+            return
+        self._fallback = None
+        self._set_flat_arrays(areas, Tij, K, setpoint)
+
+
+    def _set_flat_arrays(self, areas, Tij, K, setpoint) -> None:
+        self._sizes = np.array([area.Ad.shape[0] for area in areas], dtype=np.int64)
+        self._starts = np.concatenate([[0], np.cumsum(self._sizes)[:-1]]).astype(np.int64)
+        self._matrix_starts = np.concatenate([[0], np.cumsum(self._sizes**2)[:-1]]).astype(np.int64)
+        self._Ad = np.concatenate([area.Ad.ravel() for area in areas])
+        self._B1d = np.concatenate([area.B1d for area in areas])
+        self._B2d = np.concatenate([area.B2d[:, 0] for area in areas])
+        self._Cd = np.concatenate([area.Cd for area in areas])
+        self._Tij = np.ascontiguousarray(Tij, dtype=np.float64)
+        K = np.asarray(K, dtype=np.float64)
+        self._Kp, self._Ki, self._Kd = K[:, 0].copy(), K[:, 1].copy(), K[:, 2].copy()
+        self._setpoints = PIDControllerBank(K, setpoint, self._time_step_sec).get_setpoints()
+
+
+    def simulate(self, x, w, u, y, indices) -> None:
+        if self._fallback is not None:
+            return self._fallback.simulate(x, w, u, y, indices)
+
+        steps = len(indices)
+        x_flat = np.zeros([steps, self._sizes.sum()])
+        x_flat[0] = np.concatenate([x[i][0] for i in range(self._n)])
+        u_flat = np.ascontiguousarray(u[:, :, 0])
+        y_flat = np.ascontiguousarray(y[:, :, 0])
+        tie_lines = np.ascontiguousarray(w[:, :, 1])
+        _simulate_kernel(self._Ad, self._B1d, self._B2d, self._Cd, self._starts, self._sizes, self._matrix_starts,
+                         self._Tij, self._Kp, self._Ki, self._Kd, self._setpoints, self._time_step_sec,
+                         np.ascontiguousarray(w[:, :, 0]), x_flat, u_flat, y_flat, tie_lines)
+
+        for i in range(self._n):
+            x[i][:] = x_flat[:, self._starts[i]:self._starts[i]+self._sizes[i]]
+        u[:, :, 0] = u_flat
+        y[:, :, 0] = y_flat
+        w[:, :, 1] = tie_lines
+
+
+    def simulate_batch(self, xs, ws, us, ys, indices) -> None:
+        if self._fallback is not None:
+            return self._fallback.simulate_batch(xs, ws, us, ys, indices)
+        for x, w, u, y in zip(xs, ws, us, ys):
+            self.simulate(x, w, u, y, indices)
@@ -1,15 +1,26 @@
-class PIDController:
-    def __init__(self, K, setpoint, time_step):
-        self._Kp = K[0]
-        self._Ki = K[1]
-        self._Kd = K[2]
-        self._setpoint = setpoint
+import numpy as np
+
+
+class PIDControllerBank:
+    # Incremental (velocity form) PID controllers of all areas, with the gains K (n x 3: Kp, Ki, Kd),
+    # setpoints and error history in contiguous arrays. The measured values may have a leading
+    # batch axis (... x n), e.g. scenarios x n, all controllers are updated in one operation.
+    def __init__(self, K, setpoint, time_step) -> None:
+        K = np.asarray(K, dtype=np.float64)
+        self._Kp = K[:, 0].copy()
+        self._Ki = K[:, 1].copy()
+        self._Kd = K[:, 2].copy()
+        self._setpoint = np.broadcast_to(np.asarray(setpoint, dtype=np.float64), self._Kp.shape).copy()
         self._time_step = time_step
-        self._prev_error = 0
-        self._second_prev_error = 0
+        self.reset()
+
 
+    def reset(self) -> None:
+        self._prev_error = np.zeros_like(self._Kp)
+        self._second_prev_error = np.zeros_like(self._Kp)
 
-    def update(self, measured_value, prev_output):
+
+    def update(self, measured_value, prev_output) -> np.ndarray:
         error = self._setpoint - measured_value
         proportional = error - self._prev_error
         integral = error * self._time_step
@@ -18,4 +29,23 @@ class PIDController:
         self._prev_error = error
 
         change_in_control_signal = self._Kp*proportional + self._Ki*integral + self._Kd*derivative
-        return prev_output + change_in_control_signal
\ No newline at end of file
+        return prev_output + change_in_control_signal
+
+
+    def get_state(self) -> tuple[np.ndarray, np.ndarray]:
+        return self._prev_error.copy(), self._second_prev_error.copy()
+
+
+    def set_state(self, prev_error, second_prev_error) -> None:
+        self._prev_error = np.array(prev_error, dtype=np.float64)
+        self._second_prev_error = np.array(second_prev_error, dtype=np.float64)
+
+
+    def get_setpoints(self) -> np.ndarray:
+        return self._setpoint
+
+
+    def get_velocity_form_gains(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # u[t] = u[t-1] + g0*e[t] + g1*e[t-1] + g2*e[t-2], the form folded into linear (fused or compiled) steps
+        dt = self._time_step
+        return self._Kp + self._Ki*dt + self._Kd/dt, -(self._Kp + 2*self._Kd/dt), self._Kd/dt
@@ -0,0 +1,313 @@
+import numpy as np
+import argparse
+import asyncio
+import json
+import time
+
+from pathlib import Path
+
+from system_config import SystemConfig
+from laa_scenarios import ScenariosParser
+from load_profiles import LoadProfile
+from controller import PIDControllerBank
+from simulation import build_areas
+from utils import freq_per_unit_to_Hz
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Step the simulated areas at wall-clock pace, coupled by tie-lines to external areas of another process over TCP.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of generators into areas, numbered from 1 as in the config.")
+    parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file containing the scenarios.")
+    parser.add_argument("-s", "--scenario_name", type=str, default=None, help="The attack scenario of the simulated areas. By default, no attack.")
+    parser.add_argument("-t", "--sim_time_sec", type=float, default=60, help="The end time of the co-simulation in seconds.")
+    parser.add_argument("-xt", "--external_tie_lines", type=float, nargs="+", default=[1, 0.1], metavar="AREA COEF", help="Pairs of the simulated area and the tie-line coefficient of every external area.")
+    parser.add_argument("-rt", "--realtime_factor", type=float, default=1.0, help="Wall-clock seconds per simulated second, 0 steps as fast as the inputs arrive.")
+    parser.add_argument("-to", "--input_timeout_sec", type=float, default=None, help="How long to wait for the external input of a tick in the as-fast-as-possible mode (realtime factor 0).")
+    parser.add_argument("-H", "--host", type=str, default="127.0.0.1", help="The address of the server.")
+    parser.add_argument("-p", "--port", type=int, default=8765, help="The port of the server.")
+    parser.add_argument("-cl", "--client", action="store_true", help="Run the stand-in external process instead of the server, replaying --trace.")
+    parser.add_argument("-tr", "--trace", type=str, default=None, help="The .npy file (ticks x external areas) of the frequency deviations in per unit replayed by the client. By default, zeros.")
+    parser.add_argument("-o", "--output", type=str, default="results/cosimulation_stats.json", help="The path to the JSON file with the deadline and jitter statistics.")
+    return parser.parse_args()
+
+
+class CoSimulationStepper:
+    # The per-area loop of Simulation advanced one tick at a time, with additional entries of Tij
+    # for the external areas: v_i = sum_j Tij[i][j]*x_j[0] + sum_k Tij_ext[i][k]*f_ext_k,
+    # where f_ext are the frequency deviations (per unit) of the external areas at the previous tick.
+    def __init__(self, areas, Tij, Tij_ext, K, setpoint, time_step_sec, profile: LoadProfile, chunk_ticks=1000) -> None:
+        self._areas = areas
+        self._n = len(areas)
+        self._Tij = np.asarray(Tij, dtype=np.float64)
+        self._Tij_ext = np.asarray(Tij_ext, dtype=np.float64)
+        self._controllers = PIDControllerBank(K, setpoint, time_step_sec)
+        self._profile = profile
+        self._chunk_ticks = chunk_ticks
+        self.time_step_sec = time_step_sec
+        self.external = self._Tij_ext.shape[1]
+        self.tick = 0
+        self.x = [np.zeros(area.Ad.shape[0]) for area in areas]
+        self.u = np.zeros(self._n)
+        self.y = np.zeros(self._n)
+        self.tie_lines = np.zeros(self._n)
+        self._loads = self._profile.evaluate(np.arange(chunk_ticks))
+
+
+    def freqs(self) -> np.ndarray:
+        return np.array([x[0] for x in self.x])
+
+
+    def step(self, external_freqs) -> None:
+        # Advances from tick to tick+1, the load is evaluated in chunks of ticks ahead
+        load = self._loads[self.tick % self._chunk_ticks]
+        self.tie_lines = self._Tij @ self.freqs() + self._Tij_ext @ np.asarray(external_freqs, dtype=np.float64)
+        self.y = np.array([area.Cd @ x for area, x in zip(self._areas, self.x)])
+        self.x = [area.Ad @ x + area.B1d @ [load[i], self.tie_lines[i]] + area.B2d @ self.u[i:i+1]
+                  for i, (area, x) in enumerate(zip(self._areas, self.x))]
+        self.u = self._controllers.update(self.y, self.u)
+        self.tick += 1
+        if self.tick % self._chunk_ticks == 0:
+            self._loads = self._profile.evaluate(np.arange(self.tick, self.tick + self._chunk_ticks))
+
+
+class TimingStats:
+    # Deadline misses and the distribution of the jitter (start of a tick after its deadline)
+    # and of the latency (from sending the outputs of a tick to receiving the external input).
+    def __init__(self, ticks) -> None:
+        self.jitter = np.full(ticks, np.nan)
+        self.latency = np.full(ticks, np.nan)
+        self.deadline_misses = 0
+        self.stale_inputs = 0
+
+
+    def result(self) -> dict:
+        result = {"ticks": int(np.count_nonzero(~np.isnan(self.jitter))), "deadline_misses": self.deadline_misses,
+                  "stale_inputs": self.stale_inputs}
+        for name, values in [("jitter", self.jitter), ("latency", self.latency)]:
+            values = values[~np.isnan(values)]*1e3
+            if len(values) > 0:
+                result[f"{name}_ms"] = {"mean": float(values.mean()), "std": float(values.std()),
+                                        "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+        return result
+
+
+class CoSimulationServer:
+    # Serves one external process over TCP with newline-delimited JSON messages:
+    # server -> client {"type": "hello", "areas", "external", "time_step_sec", "f0"} once, then every tick
+    #                  {"type": "step", "tick", "freqs", "tie_lines", "ace", "u"} (per unit, after the tick),
+    #                  and {"type": "stats", ...} at the end;
+    # client -> server {"type": "input", "tick", "freqs"} with the frequency deviations of the external areas
+    #                  at the tick, used for the next tick.
+    # Tick t is due at t*time_step_sec*realtime_factor after the start. An input that has not arrived
+    # by the deadline of the next tick (at least a period after the state was sent) is a deadline miss,
+    # the last input is held. An input is applied only at its own tick: late inputs are dropped as stale,
+    # inputs of later ticks are kept until their tick. An invalid message ends the co-simulation with an error.
+    def __init__(self, stepper: CoSimulationStepper, ticks, f0, realtime_factor=1.0, input_timeout_sec=None) -> None:
+        self._stepper = stepper
+        self._ticks = ticks
+        self._f0 = f0
+        self._period = stepper.time_step_sec*realtime_factor
+        self._input_timeout_sec = input_timeout_sec
+        self._early_inputs = {} # tick -> (received, freqs) of inputs that arrived before their tick
+        self.stats = TimingStats(ticks)
+
+
+    async def serve(self, host, port) -> dict:
+        done = asyncio.get_running_loop().create_future()
+        connected = False
+
+        async def handle(reader, writer):
+            # Only the first external process is served
+            nonlocal connected
+            if connected:
+                writer.close()
+                return
+            connected = True
+            try:
+                done.set_result(await self._run(reader, writer))
+            except Exception as error:
+                done.set_exception(error)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            return await done
+
+
+    async def _run(self, reader, writer) -> dict:
+        stepper = self._stepper
+        inputs = asyncio.Queue()
+        reader_task = asyncio.create_task(self._read_inputs(reader, inputs))
+        self._send(writer, {"type": "hello", "areas": len(stepper.x), "external": stepper.external,
+                            "time_step_sec": stepper.time_step_sec, "f0": self._f0})
+        self._send_step(writer)
+        await writer.drain()
+
+        external_freqs = np.zeros(stepper.external)
+        sent = time.perf_counter()
+        start = sent
+        for tick in range(1, self._ticks):
+            deadline = start + tick*self._period
+            # When the server runs late, the external process still gets a whole period after the state is sent
+            input_deadline = max(deadline, sent + self._period)
+            received, external_freqs = await self._wait_for_input(inputs, tick-1, input_deadline, external_freqs)
+            if received is None:
+                self.stats.deadline_misses += 1
+            else:
+                self.stats.latency[tick] = max(received - sent, 0) # Inputs kept from before their tick have none
+            if self._period > 0:
+                await asyncio.sleep(max(deadline - time.perf_counter(), 0))
+            self.stats.jitter[tick] = max(time.perf_counter() - deadline, 0) if self._period > 0 else 0
+            stepper.step(external_freqs)
+            self._send_step(writer)
+            await writer.drain()
+            sent = time.perf_counter()
+
+        reader_task.cancel()
+        stats = self.stats.result()
+        self._send(writer, dict(stats, type="stats"))
+        await writer.drain()
+        return stats
+
+
+    async def _wait_for_input(self, inputs, tick, deadline, external_freqs):
+        # Input of the tick, inputs of earlier ticks that arrive late are dropped and inputs of later
+        # ticks are kept for them. Inputs already queued are taken even when the server is behind
+        # schedule, only waiting is bounded by the deadline.
+        for early_tick in [early_tick for early_tick in self._early_inputs if early_tick < tick]:
+            del self._early_inputs[early_tick]
+            self.stats.stale_inputs += 1
+        if tick in self._early_inputs:
+            return self._early_inputs.pop(tick)
+        while True:
+            timeout = deadline - time.perf_counter() if self._period > 0 else self._input_timeout_sec
+            if inputs.empty() and timeout is not None and timeout <= 0:
+                await asyncio.sleep(0) # Lets the reader task queue an input that has already arrived
+            if not inputs.empty():
+                received, message = inputs.get_nowait()
+            elif timeout is not None and timeout <= 0:
+                return None, external_freqs
+            else:
+                try:
+                    received, message = await asyncio.wait_for(inputs.get(), timeout)
+                except asyncio.TimeoutError:
+                    return None, external_freqs
+            if message is None:
+                raise ConnectionError("The external process disconnected.")
+            if isinstance(message, Exception):
+                raise message
+            input_tick, freqs = message
+            if input_tick < tick:
+                self.stats.stale_inputs += 1
+            elif input_tick > tick:
+                self._early_inputs[input_tick] = (received, freqs)
+            else:
+                return received, freqs
+
+
+    async def _read_inputs(self, reader, inputs) -> None:
+        # Inputs are queued as (received, (tick, freqs)), errors of the connection or of the messages
+        # are passed to the stepping loop, which raises them
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    raise ValueError(f"expected a JSON object, got {line!r}")
+                if message.get("type") == "input":
+                    inputs.put_nowait((time.perf_counter(), self._parse_input(message)))
+        except ConnectionError as error:
+            inputs.put_nowait((time.perf_counter(), error))
+            return
+        except ValueError as error: # Including json.JSONDecodeError
+            inputs.put_nowait((time.perf_counter(), ValueError(f"Invalid message from the external process: {error}")))
+            return
+        inputs.put_nowait((time.perf_counter(), None))
+
+
+    def _parse_input(self, message) -> tuple[int, np.ndarray]:
+        tick, freqs = message.get("tick"), message.get("freqs")
+        if isinstance(tick, bool) or not isinstance(tick, int) or not 0 <= tick < self._ticks:
+            raise ValueError(f"the tick of an input must be an integer from 0 to {self._ticks-1}, got {tick!r}")
+        if (not isinstance(freqs, list) or len(freqs) != self._stepper.external
+                or not all(isinstance(freq, (int, float)) and not isinstance(freq, bool) for freq in freqs)
+                or not np.all(np.isfinite(freqs))):
+            raise ValueError(f"the freqs of an input must be a list of {self._stepper.external} finite numbers, got {freqs!r}")
+        return tick, np.array(freqs, dtype=np.float64)
+
+
+    def _send_step(self, writer) -> None:
+        stepper = self._stepper
+        self._send(writer, {"type": "step", "tick": stepper.tick, "freqs": stepper.freqs().tolist(),
+                            "tie_lines": [float(x[1]) for x in stepper.x], "ace": stepper.y.tolist(),
+                            "u": stepper.u.tolist()})
+
+
+    def _send(self, writer, message) -> None:
+        writer.write((json.dumps(message) + "\n").encode())
+
+
+async def replay_client(host, port, trace=None) -> dict:
+    # Stand-in for the external process: answers every tick with the next row of the trace
+    # (frequency deviations of the external areas in per unit), zeros without a trace.
+    reader, writer = await asyncio.open_connection(host, port)
+    hello = json.loads(await reader.readline())
+    while line := await reader.readline():
+        message = json.loads(line)
+        if message["type"] == "stats":
+            writer.close()
+            return message
+        tick = message["tick"]
+        freqs = np.zeros(hello["external"]) if trace is None else np.atleast_1d(trace[min(tick, len(trace)-1)])
+        writer.write((json.dumps({"type": "input", "tick": tick, "freqs": [float(f) for f in freqs]}) + "\n").encode())
+        await writer.drain()
+    writer.close()
+    raise ConnectionError("The server closed the connection before the end of the co-simulation.")
+
+
+def build_stepper(config: SystemConfig, split, external_tie_lines, scenario=None) -> CoSimulationStepper:
+    gen_params = config.split(split)
+    areas = build_areas(gen_params.n, gen_params.m, gen_params.D, gen_params.H, gen_params.Tt, gen_params.Tg,
+                        gen_params.R, gen_params.alpha, gen_params.beta, gen_params.Tij, config.time_step_sec)
+    if len(external_tie_lines) % 2 != 0:
+        raise ValueError("External tie-lines must be given as pairs of the simulated area and the coefficient.")
+    Tij_ext = np.zeros([gen_params.n, len(external_tie_lines)//2])
+    for k, (area, coefficient) in enumerate(zip(external_tie_lines[::2], external_tie_lines[1::2])):
+        if not 1 <= area <= gen_params.n:
+            raise ValueError(f"External area {k+1} must be tied to one of the areas 1 to {gen_params.n}.")
+        Tij_ext[int(area)-1, k] = coefficient
+    areas_attacks = [[] for _ in range(gen_params.n)] if scenario is None else scenario["areas_attacks"][:gen_params.n]
+    profile = LoadProfile.from_attacks(areas_attacks, config.time_step_sec)
+    return CoSimulationStepper(areas, gen_params.Tij, Tij_ext, config.K, config.setpoint, config.time_step_sec, profile)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.client:
+        trace = np.load(args.trace, mmap_mode="r") if args.trace is not None else None
+        stats = asyncio.run(replay_client(args.host, args.port, trace))
+        print(f"Co-simulation finished: {stats['ticks']} ticks, {stats['deadline_misses']} deadline misses")
+    else:
+        config = SystemConfig.load(args.config)
+        scenario = None
+        if args.scenario_name is not None:
+            scenario = ScenariosParser(args.file_path, args.sim_time_sec).get_scenario(args.scenario_name)
+            if scenario is None:
+                raise SystemExit(f"There is no scenario {args.scenario_name} in {args.file_path}.")
+        stepper = build_stepper(config, args.split, args.external_tie_lines, scenario)
+        server = CoSimulationServer(stepper, int(args.sim_time_sec/config.time_step_sec), config.f0,
+                                    args.realtime_factor, args.input_timeout_sec)
+        print(f"Waiting for the external process on {args.host}:{args.port}")
+        stats = asyncio.run(server.serve(args.host, args.port))
+
+        print("Final frequencies: " + " | ".join(f"Area {i+1}: {round(freq_per_unit_to_Hz(freq, config.f0), 4)} Hz"
+                                                  for i, freq in enumerate(stepper.freqs())))
+        print(f"{stats['ticks']} ticks, {stats['deadline_misses']} deadline misses, {stats['stale_inputs']} stale inputs")
+        for name in ["jitter_ms", "latency_ms"]:
+            if name in stats:
+                print(f"{name}: " + ", ".join(f"{key} {round(value, 3)}" for key, value in stats[name].items()))
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=4)
@@ -0,0 +1,74 @@
+import numpy as np
+import hashlib
+
+from pathlib import Path
+
+from profiling import profiler
+from utils import atomic_write
+
+
+class DiscretisationCache:
+    # Memo of the zero-order hold discretisations of (A, B, C) with time step,
+    # keyed by a hash of the continuous matrices (they depend only on the area parameters).
+    # With cache_dir set, discretisations are also stored on disk and shared between runs and processes.
+    def __init__(self, cache_dir=None) -> None:
+        self._memo = {}
+        self.cache_dir = cache_dir
+
+
+    def discretise(self, A, B, C, time_step_sec) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        key = self._key(A, B, C, time_step_sec)
+        if key not in self._memo:
+            self._memo[key] = self._load(key)
+        if self._memo[key] is None:
+            import scipy.signal # Only needed on a cache miss, scipy takes long to import
+            with profiler.stage("cont2discrete"):
+                Ad, Bd, Cd, _, _ = scipy.signal.cont2discrete((A, B, C, 0), time_step_sec, method='zoh')
+            self._memo[key] = self._read_only(Ad, Bd, Cd)
+            self._save(key, *self._memo[key])
+        return self._memo[key]
+
+
+    def clear(self) -> None:
+        self._memo = {}
+
+
+    def _key(self, A, B, C, time_step_sec) -> str:
+        digest = hashlib.sha256()
+        for matrix in (A, B, C):
+            matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+            digest.update(str(matrix.shape).encode())
+            digest.update(matrix.tobytes())
+        digest.update(np.float64(time_step_sec).tobytes())
+        return digest.hexdigest()
+
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        path = Path(self.cache_dir, f"{key}.npz")
+        if not path.exists():
+            return None
+        with np.load(path) as cached:
+            return self._read_only(cached["Ad"], cached["Bd"], cached["Cd"])
+
+
+    def _save(self, key, Ad, Bd, Cd) -> None:
+        if self.cache_dir is None:
+            return
+        with atomic_write(Path(self.cache_dir, f"{key}.npz")) as f:
+            np.savez(f, Ad=Ad, Bd=Bd, Cd=Cd)
+
+
+    def _read_only(self, *matrices) -> tuple[np.ndarray, ...]:
+        matrices = tuple(np.array(matrix) for matrix in matrices)
+        for matrix in matrices:
+            matrix.setflags(write=False)
+        return matrices
+
+
+discretisation_cache = DiscretisationCache()
+
+
+def set_cache_dir(cache_dir) -> None:
+    discretisation_cache.cache_dir = cache_dir
@@ -0,0 +1,202 @@
+import numpy as np
+import argparse
+import hashlib
+import itertools
+import csv
+
+from pathlib import Path
+
+from fused_system import FusedSystem
+from system_config import SystemConfig
+from simulation import build_fused_system
+from utils import atomic_write
+
+
+# The closed loop always has a marginal eigenvalue at 1 (integral of the ACE), perturbed only by rounding
+STABILITY_TOLERANCE = 1e-9
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Modal analysis of the closed-loop interconnected system (areas, tie-lines and PID controllers) without time-domain simulation.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of generators into areas, numbered from 1 as in the config.")
+    parser.add_argument("-kp", "--kp", type=float, nargs="+", default=None, help="Map the stability over these proportional gains.")
+    parser.add_argument("-ki", "--ki", type=float, nargs="+", default=None, help="Map the stability over these integral gains.")
+    parser.add_argument("-kd", "--kd", type=float, nargs="+", default=None, help="Map the stability over these derivative gains.")
+    parser.add_argument("-ga", "--grid_areas", type=int, nargs="+", default=None, help="The areas whose gains are set from the grid, the others keep the gains of the config. By default, all areas.")
+    parser.add_argument("-nm", "--modes", type=int, default=10, help="The number of the least damped modes to print.")
+    parser.add_argument("-o", "--output_dir", type=str, default="results/eigen", help="The directory of the CSV files with the modes or the stability map.")
+    parser.add_argument("-cd", "--cache_dir", type=str, default=".cache/eigen", help="Store the spectral decompositions in this directory and reuse them in later runs.")
+    return parser.parse_args()
+
+
+class SpectralCache:
+    # Eigen decompositions of closed-loop matrices keyed by a hash of the matrices, they depend
+    # only on the parameters of the system and not on the scenario. With cache_dir set, they are
+    # also stored on disk and shared between runs.
+    def __init__(self, cache_dir=None) -> None:
+        self._memo = {}
+        self.cache_dir = cache_dir
+
+
+    def decomposition(self, M) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Eigenvalues with right and left eigenvectors (columns of V and rows of W, W @ V = I)
+        key = "modes-" + self._key(M)
+        if key not in self._memo:
+            self._memo[key] = self._load(key, ["eigenvalues", "V", "W"])
+        if self._memo[key] is None:
+            eigenvalues, V = np.linalg.eig(M)
+            self._memo[key] = (eigenvalues, V, np.linalg.inv(V))
+            self._save(key, eigenvalues=eigenvalues, V=V, W=self._memo[key][2])
+        return self._memo[key]
+
+
+    def eigenvalues(self, Ms) -> np.ndarray:
+        # Eigenvalues of stacked matrices (matrices x states x states), all computed in one batched call
+        key = "batch-" + self._key(Ms)
+        if key not in self._memo:
+            self._memo[key] = self._load(key, ["eigenvalues"])
+        if self._memo[key] is None:
+            self._memo[key] = (np.linalg.eigvals(Ms),)
+            self._save(key, eigenvalues=self._memo[key][0])
+        return self._memo[key][0]
+
+
+    def _key(self, matrices) -> str:
+        matrices = np.ascontiguousarray(matrices, dtype=np.float64)
+        digest = hashlib.sha256()
+        digest.update(str(matrices.shape).encode())
+        digest.update(matrices.tobytes())
+        return digest.hexdigest()
+
+
+    def _load(self, key, names):
+        if self.cache_dir is None:
+            return None
+        path = Path(self.cache_dir, f"{key}.npz")
+        if not path.exists():
+            return None
+        with np.load(path) as cached:
+            return tuple(cached[name] for name in names)
+
+
+    def _save(self, key, **arrays) -> None:
+        if self.cache_dir is None:
+            return
+        with atomic_write(Path(self.cache_dir, f"{key}.npz")) as f:
+            np.savez(f, **arrays)
+
+
+def continuous_eigenvalues(eigenvalues, time_step_sec) -> np.ndarray:
+    # s = ln(z)/dt of the discrete eigenvalues z, the modes of the equivalent continuous system
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log(eigenvalues.astype(complex)) / time_step_sec
+
+
+def damping_ratios(continuous) -> np.ndarray:
+    # zeta = -Re(s)/|s|, NaN for the marginal mode (s = 0) and the pure delays of the error history (z = 0)
+    magnitude = np.abs(continuous)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(magnitude > STABILITY_TOLERANCE, -continuous.real / magnitude, np.nan)
+
+
+def participation_factors(V, W) -> np.ndarray:
+    # p[k, i] - relative participation of state k in mode i, every mode sums to 1
+    participation = np.abs(V * W.T)
+    return participation / participation.sum(axis=0)
+
+
+def state_labels(fused_system: FusedSystem, m) -> list[str]:
+    labels = [""]*fused_system.size
+    for i, xi in enumerate(fused_system.x_slices):
+        area_labels = ["frequency", "tie_line"] + [f"turbine{j+1}" for j in range(m[i])] + [f"governor{j+1}" for j in range(m[i])]
+        labels[xi] = [f"area{i+1}_{label}" for label in area_labels]
+        labels[fused_system.u_indices[i]] = f"area{i+1}_lfc_output"
+        labels[fused_system.e1_indices[i]] = f"area{i+1}_prev_error"
+        labels[fused_system.e2_indices[i]] = f"area{i+1}_second_prev_error"
+    return labels
+
+
+def analyse_modes(fused_system: FusedSystem, time_step_sec, cache: SpectralCache) -> list[dict]:
+    eigenvalues, V, W = cache.decomposition(fused_system.M)
+    continuous = continuous_eigenvalues(eigenvalues, time_step_sec)
+    damping = damping_ratios(continuous)
+    participation = participation_factors(V, W)
+    modes = []
+    for i in range(len(eigenvalues)):
+        modes.append({"eigenvalue": eigenvalues[i], "magnitude": abs(eigenvalues[i]), "continuous": continuous[i],
+                      "frequency_Hz": abs(continuous[i].imag) / (2*np.pi), "damping_ratio": damping[i],
+                      "participation": participation[:, i]})
+    return modes
+
+
+def stability_map(fused_system: FusedSystem, Ks, time_step_sec, cache: SpectralCache) -> dict:
+    # Spectral radius, stability and the smallest damping ratio of every gain matrix of Ks
+    eigenvalues = cache.eigenvalues(fused_system.closed_loop_matrices(Ks))
+    damping = damping_ratios(continuous_eigenvalues(eigenvalues, time_step_sec))
+    spectral_radius = np.abs(eigenvalues).max(axis=1)
+    min_damping = np.where(np.isnan(damping), np.inf, damping).min(axis=1)
+    return {"spectral_radius": spectral_radius, "stable": spectral_radius < 1 + STABILITY_TOLERANCE,
+            "min_damping_ratio": min_damping}
+
+
+def gain_grid(K, kp, ki, kd, areas) -> tuple[list[tuple], np.ndarray]:
+    # Every combination of the given gains, set in the given areas, the other gains are kept from K
+    K = np.asarray(K, dtype=np.float64)
+    axes = [values if values is not None else [None] for values in (kp, ki, kd)]
+    points = list(itertools.product(*axes))
+    Ks = np.repeat(K[None], len(points), axis=0)
+    for Kg, point in zip(Ks, points):
+        for column, value in enumerate(point):
+            if value is not None:
+                Kg[areas, column] = value
+    return points, Ks
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = SystemConfig.load(args.config)
+    gen_params = config.split(args.split)
+    time_step_sec = config.time_step_sec
+    fused_system = build_fused_system(gen_params, config.K, config.setpoint, time_step_sec)
+    cache = SpectralCache(args.cache_dir)
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    if args.kp is None and args.ki is None and args.kd is None:
+        labels = state_labels(fused_system, gen_params.m)
+        modes = analyse_modes(fused_system, time_step_sec, cache)
+        spectral_radius = max(mode["magnitude"] for mode in modes)
+        stability = "stable" if spectral_radius < 1 + STABILITY_TOLERANCE else "unstable"
+        print(f"Spectral radius {spectral_radius}, {stability}")
+
+        path = Path(args.output_dir, f"modes_split{args.split}.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["eigenvalue_real", "eigenvalue_imag", "magnitude", "continuous_real", "continuous_imag",
+                             "frequency_Hz", "damping_ratio"] + [f"participation_{label}" for label in labels])
+            for mode in modes:
+                writer.writerow([mode["eigenvalue"].real, mode["eigenvalue"].imag, mode["magnitude"],
+                                 mode["continuous"].real, mode["continuous"].imag, mode["frequency_Hz"],
+                                 mode["damping_ratio"]] + list(mode["participation"]))
+
+        # Least damped oscillatory modes, one of every complex conjugate pair
+        oscillatory = [mode for mode in modes if mode["eigenvalue"].imag > 0 and not np.isnan(mode["damping_ratio"])]
+        for mode in sorted(oscillatory, key=lambda mode: mode["damping_ratio"])[:args.modes]:
+            dominant = np.argsort(mode["participation"])[::-1][:3]
+            states = ", ".join(f"{labels[k]} {round(mode["participation"][k], 3)}" for k in dominant)
+            print(f"{round(mode["frequency_Hz"], 4)} Hz, damping {round(mode["damping_ratio"], 4)}: {states}")
+        print(f"Modes saved to {path}")
+    else:
+        areas = [area-1 for area in args.grid_areas] if args.grid_areas else list(range(gen_params.n))
+        points, Ks = gain_grid(config.K, args.kp, args.ki, args.kd, areas)
+        stability = stability_map(fused_system, Ks, time_step_sec, cache)
+
+        path = Path(args.output_dir, f"stability_map_split{args.split}.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Kp", "Ki", "Kd", "spectral_radius", "stable", "min_damping_ratio"])
+            for k, point in enumerate(points):
+                writer.writerow(["" if value is None else value for value in point] +
+                                [stability["spectral_radius"][k], bool(stability["stable"][k]), stability["min_damping_ratio"][k]])
+        print(f"{int(stability["stable"].sum())} of {len(points)} gain combinations are stable, stability map saved to {path}")
@@ -0,0 +1,252 @@
+import hashlib
+import numpy as np
+
+from area import Area
+from controller import PIDControllerBank
+
+
+class FusedSystem:
+    # Augmented state of the whole interconnected system, one column per step:
+    # z = [x_1, ..., x_n, u_1, ..., u_n, e1_1, ..., e1_n, e2_1, ..., e2_n]
+    # x_i  - state of Area i (2+2*m_i)
+    # u_i  - LFC controller output of Area i
+    # e1_i - previous error of the PID controller of Area i
+    # e2_i - second previous error of the PID controller of Area i
+    # so one step of all areas, tie-lines and incremental PIDs is z[t] = M @ z[t-1] + drive[t-1].
+    def __init__(self, areas: list[Area], Tij, K, setpoint, time_step_sec) -> None:
+        self._areas = areas
+        self._n = len(areas)
+        self.Tij = np.asarray(Tij, dtype=np.float64)
+        self.Cd = [area.Cd for area in areas]
+        self._time_step_sec = time_step_sec
+        self._controllers = PIDControllerBank(K, setpoint, time_step_sec)
+        self._set_state_layout()
+        self._set_system_matrix()
+        self._set_load_matrix_and_offset()
+
+
+    def _set_state_layout(self) -> None:
+        self.x_slices = []
+        start = 0
+        for area in self._areas:
+            size = area.Ad.shape[0]
+            self.x_slices.append(slice(start, start+size))
+            start += size
+        self.x_size = start
+        self.u_indices = np.arange(self.x_size, self.x_size+self._n)
+        self.e1_indices = self.u_indices + self._n
+        self.e2_indices = self.e1_indices + self._n
+        self.size = self.x_size + 3*self._n
+
+
+    def _set_system_matrix(self) -> None:
+        self.M = np.zeros([self.size, self.size])
+        for i, area in enumerate(self._areas):
+            xi = self.x_slices[i]
+            u, e1, e2 = self.u_indices[i], self.e1_indices[i], self.e2_indices[i]
+
+            # Area dynamics, tie-lines change v_i = sum_j Tij[i][j]*x_j[0] and LFC input
+            self.M[xi, xi] = area.Ad
+            for j in range(self._n):
+                self.M[xi, self.x_slices[j].start] += area.B1d[:, 1]*self.Tij[i][j]
+            self.M[xi, u] = area.B2d[:, 0]
+
+            # Error history of the PID with error = setpoint - Cd @ x_i
+            self.M[u, u] = 1
+            self.M[e1, xi] = -area.Cd
+            self.M[e2, e1] = 1
+        self._set_controller_rows(self.M, self._controllers)
+
+
+    def _set_controller_rows(self, M, controllers: PIDControllerBank) -> None:
+        # Incremental PID update, the only part of M depending on the gains
+        error_gain, prev_error_gain, second_prev_error_gain = controllers.get_velocity_form_gains()
+        for i, area in enumerate(self._areas):
+            u = self.u_indices[i]
+            M[u, self.x_slices[i]] = -error_gain[i]*area.Cd
+            M[u, self.e1_indices[i]] = prev_error_gain[i]
+            M[u, self.e2_indices[i]] = second_prev_error_gain[i]
+
+
+    def closed_loop_matrices(self, Ks) -> np.ndarray:
+        # M for every gain matrix (n x 3) of Ks, stacked as gains x states x states
+        Ms = np.repeat(self.M[None], len(Ks), axis=0)
+        for M, K in zip(Ms, Ks):
+            self._set_controller_rows(M, PIDControllerBank(K, 0, self._time_step_sec))
+        return Ms
+
+
+    def closed_loop_offsets(self, Ks) -> np.ndarray:
+        # offset for every gain matrix (n x 3) of Ks, stacked as gains x states
+        setpoints = self._controllers.get_setpoints()
+        offsets = np.repeat(self.offset[None], len(Ks), axis=0)
+        for offset, K in zip(offsets, Ks):
+            error_gain, _, _ = PIDControllerBank(K, setpoints, self._time_step_sec).get_velocity_form_gains()
+            offset[self.u_indices] = error_gain*setpoints
+        return offsets
+
+
+    def _set_load_matrix_and_offset(self) -> None:
+        error_gain, _, _ = self._controllers.get_velocity_form_gains()
+        setpoints = self._controllers.get_setpoints()
+
+        self.L = np.zeros([self.size, self._n])
+        self.offset = np.zeros(self.size)
+        for i, area in enumerate(self._areas):
+            self.L[self.x_slices[i], i] = area.B1d[:, 0]
+            self.offset[self.u_indices[i]] = error_gain[i]*setpoints[i]
+            self.offset[self.e1_indices[i]] = setpoints[i]
+
+
+    def fingerprint(self) -> str:
+        # Hash of the discrete closed-loop system, equal for systems stepping identically
+        digest = hashlib.sha256()
+        for matrix in (self.M, self.L, self.offset):
+            matrix = matrix.toarray() if hasattr(matrix, "toarray") else matrix # M and L of SparseSystem are CSR
+            digest.update(str(matrix.shape).encode())
+            digest.update(np.ascontiguousarray(matrix).tobytes())
+        digest.update(np.float64(self._time_step_sec).tobytes())
+        return digest.hexdigest()
+
+
+    def initial_state(self, x, u) -> np.ndarray:
+        z0 = np.zeros(self.size)
+        for i in range(self._n):
+            z0[self.x_slices[i]] = x[i][0]
+        z0[self.u_indices] = u[0, :, 0]
+        return z0
+
+
+    def state_at(self, x, u, y, tick) -> np.ndarray:
+        # Augmented state at a tick of simulated vectors, the error history of the PIDs
+        # holds the errors of the two previous ticks (zero before the start)
+        z = np.zeros(self.size)
+        for i in range(self._n):
+            z[self.x_slices[i]] = x[i][tick]
+        z[self.u_indices] = u[tick, :, 0]
+        setpoints = self._controllers.get_setpoints()
+        if tick >= 1:
+            z[self.e1_indices] = setpoints - y[tick-1, :, 0]
+        if tick >= 2:
+            z[self.e2_indices] = setpoints - y[tick-2, :, 0]
+        return z
+
+
+    def step_responses(self, steps, outputs) -> np.ndarray:
+        # Response of the entries `outputs` of z to a unit load step in every area, applied from
+        # the first step to the zero state without the setpoint offset: areas x steps x outputs.
+        # As the system is linear, any load is a sum of shifted and scaled step responses.
+        return self._propagate(self.L, steps, outputs).transpose(2, 0, 1)
+
+
+    def free_response(self, steps, outputs) -> np.ndarray:
+        # Response of the entries `outputs` of z from the zero state without load (only the setpoint offset)
+        return self._propagate(self.offset[:, None], steps, outputs)[:, :, 0]
+
+
+    def _propagate(self, drive, steps, outputs) -> np.ndarray:
+        z = np.zeros([self.size, drive.shape[1]])
+        responses = np.zeros([steps, len(outputs), drive.shape[1]])
+        for t in range(1, steps):
+            z = self.M @ z + drive
+            responses[t] = z[outputs]
+        return responses
+
+
+    def simulate(self, x, w, u, y, indices) -> None:
+        self.simulate_batch([x], [w], [u], [y], indices)
+
+
+    def simulate_batch(self, xs, ws, us, ys, indices, chunk_steps=1024) -> None:
+        # All scenarios are advanced together as a (scenarios x states) array,
+        # a single scenario is a batch of one. The product is stacked per scenario
+        # (scenarios x 1 x states) so that every scenario is computed exactly as
+        # in the per-scenario run, regardless of the size of the batch. The drive of
+        # the loads is formed step by step and the states are kept for chunk_steps
+        # steps at a time, so memory does not grow with steps x scenarios.
+        steps = len(indices)
+        M_T, L_T = self.M.T, self.L.T
+        z = np.empty([min(chunk_steps, steps), len(ws), 1, self.size])
+        z_prev = np.array([self.initial_state(x, u) for x, u in zip(xs, us)])[:, None]
+        for start in range(0, steps, chunk_steps):
+            end = min(start+chunk_steps, steps)
+            loads = np.stack([w[max(start-1, 0):end-1, :, 0] for w in ws], axis=1) # steps x scenarios x n
+            for k, t in enumerate(range(start, end)):
+                if t == 0:
+                    z[k] = z_prev
+                else:
+                    np.matmul(z_prev, M_T, out=z[k])
+                    z[k, :, 0] += loads[t-1-max(start-1, 0)] @ L_T + self.offset
+                z_prev = z[k]
+            for s in range(len(ws)):
+                self._scatter_rows(start, z[:end-start, s, 0], xs[s], ws[s], us[s], ys[s], steps)
+            z_prev = z_prev.copy()
+
+
+    def simulate_from(self, z, x, w, u, y, tick) -> None:
+        # Fills the vectors from the tick on, z is the augmented state at the tick (see state_at),
+        # the rows before it are kept, so a simulation can be resumed from a snapshot.
+        steps = len(w)
+        drive = w[tick:, :, 0] @ self.L.T + self.offset
+        zs = np.empty([steps-tick, 1, self.size])
+        zs[0, 0] = z
+        M_T = self.M.T
+        for k in range(1, steps-tick):
+            np.matmul(zs[k-1], M_T, out=zs[k])
+            zs[k, 0] += drive[k-1]
+        self._scatter_trajectories(zs[:, 0], [xi[tick:] for xi in x], w[tick:], u[tick:], y[tick:])
+
+
+    def stream(self, z0, profile, steps, chunk_steps, start=0):
+        # Generator of (indices, x, w, u, y) chunks of at most chunk_steps time steps,
+        # with the layout of StateInputOutputVectors, so memory does not grow with steps.
+        # The LoadProfile is evaluated one chunk at a time. When resuming from the tick start > 0,
+        # z0 is the state at the tick before it.
+        M_T = self.M.T
+        z_prev = z0
+        for chunk_start in range(start, steps, chunk_steps):
+            indices = np.arange(chunk_start, min(chunk_start+chunk_steps, steps))
+            load = profile.evaluate(indices)
+            drive = profile.evaluate(np.maximum(indices-1, 0)) @ self.L.T + self.offset
+
+            z = np.empty([len(indices), 1, self.size])
+            for k, t in enumerate(indices):
+                if t == 0:
+                    z[k, 0] = z0
+                else:
+                    np.matmul(z_prev, M_T, out=z[k])
+                    z[k, 0] += drive[k]
+                z_prev = z[k]
+            yield (indices, *self._split_chunk(indices, z[:, 0], load, steps))
+
+
+    def _split_chunk(self, indices, z, load, steps):
+        # As in the stepping loop, ACE and tie-lines are not computed for the last time step
+        computed = indices < steps-1
+        x = [z[:, xi] for xi in self.x_slices]
+        w = np.zeros([len(indices), self._n, 2])
+        u = np.zeros([len(indices), self._n, 1])
+        y = np.zeros([len(indices), self._n, 1])
+        w[:, :, 0] = load
+        w[computed, :, 1] = z[computed][:, [xi.start for xi in self.x_slices]] @ self.Tij.T
+        u[:, :, 0] = z[:, self.u_indices]
+        for i in range(self._n):
+            y[computed, i, 0] = x[i][computed] @ self.Cd[i]
+        return x, w, u, y
+
+
+    def _scatter_trajectories(self, z, x, w, u, y) -> None:
+        self._scatter_rows(0, z, x, w, u, y, len(z))
+
+
+    def _scatter_rows(self, start, z, x, w, u, y, steps) -> None:
+        # Rows from start on of the vectors of steps time steps from the states of those rows.
+        # As in the stepping loop, ACE and tie-lines are not computed for the last time step
+        # and the first LFC output is the initial one.
+        end, computed = start + len(z), max(min(len(z), steps-1-start), 0)
+        for i, area in enumerate(self._areas):
+            x[i][start:end] = z[:, self.x_slices[i]]
+            y[start:start+computed, i, 0] = x[i][start:start+computed] @ area.Cd
+        w[start:start+computed, :, 1] = z[:computed, [xi.start for xi in self.x_slices]] @ self.Tij.T
+        first = 1 if start == 0 else 0
+        u[start+first:end, :, 0] = z[first:, self.u_indices]
@@ -0,0 +1,306 @@
+import numpy as np
+import argparse
+import json
+import time
+import csv
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from fused_system import FusedSystem
+from laa_scenarios import ScenariosParser
+from load_profiles import LoadProfile
+from system_config import SystemConfig
+from simulation import build_fused_system
+from reducers import FREQUENCY_BANDS_HZ
+from eigen_analysis import STABILITY_TOLERANCE
+from sweep import flatten_parameters, run_sample
+from utils import iter_batches
+
+
+# Cost of an unstable gain set, above the cost of any stable one
+UNSTABLE_COST = 1e6
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tune the PID gains K of the areas for the smallest worst-case frequency deviation over the LAA scenarios.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of generators into areas, numbered from 1 as in the config.")
+    parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file containing the scenarios.")
+    parser.add_argument("-s", "--scenario_name", type=str, default=None, help="A shell-style pattern of the names of the scenarios to tune against. By default, all scenarios in the file.")
+    parser.add_argument("-t", "--sim_time_sec", type=int, default=300, help="The end time of the simulation in seconds.")
+    parser.add_argument("-e", "--end", type=int, default=300, help="The end time of the attacks in seconds.")
+    parser.add_argument("-a", "--areas", type=int, nargs="+", default=None, help="The areas whose gains are tuned, the others keep the gains of the config. By default, all areas.")
+    parser.add_argument("-kp", "--kp_range", type=float, nargs=2, default=[0.0, 10.0], help="The range of the proportional gains.")
+    parser.add_argument("-ki", "--ki_range", type=float, nargs=2, default=[0.0, 5.0], help="The range of the integral gains.")
+    parser.add_argument("-kd", "--kd_range", type=float, nargs=2, default=[0.0, 5.0], help="The range of the derivative gains.")
+    parser.add_argument("-sw", "--settling_weight", type=float, default=0.001, help="The cost of a second of the worst settling time, in Hz of frequency deviation.")
+    parser.add_argument("-vw", "--violation_weight", type=float, default=0.01, help="The cost of a second outside the narrowest safe frequency range, in Hz of frequency deviation.")
+    parser.add_argument("-ps", "--popsize", type=int, default=15, help="The population of the differential evolution, as a multiple of the number of tuned gains.")
+    parser.add_argument("-g", "--generations", type=int, default=30, help="The maximum number of generations of the differential evolution.")
+    parser.add_argument("-b", "--batch_size", type=int, default=64, help="The number of gain sets simulated together in one batched simulation.")
+    parser.add_argument("-sb", "--scenario_batch_size", type=int, default=256, help="The number of scenarios simulated together with a batch of gain sets, the worst cases of the batches are combined.")
+    parser.add_argument("-bs", "--block_steps", type=int, default=100, help="The number of time steps propagated at once between the attack breakpoints.")
+    parser.add_argument("-wk", "--workers", type=int, default=1, help="The number of worker processes simulating the batches of gain sets in parallel.")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="The seed of the differential evolution.")
+    parser.add_argument("-o", "--output", type=str, default="results/gain_tuning.csv", help="The path to the CSV file with the metrics of every evaluated gain set.")
+    parser.add_argument("-v", "--verify", action="store_true", help="Simulate the best gains with the fused engine and report the error of the batched evaluation.")
+    args = parser.parse_args()
+    if args.end > args.sim_time_sec:
+        parser.error("The end time of the attack must be less than or equal to the simulation time.")
+    return args
+
+
+class GainEvaluator:
+    # Worst-case frequency metrics over all scenarios for a batch of gain matrices K, simulated
+    # together with the gains stacked along a leading axis (gains x states x scenarios). Only M
+    # and the setpoint offset depend on the gains. The attacks are piecewise constant, so the
+    # time steps are propagated in blocks of at most block_steps steps, split at the breakpoints
+    # of all scenarios: with the drive d constant in a block, z[t+r] = M^r @ z[t] + (I + ... + M^(r-1)) @ d,
+    # and only the frequency rows of the powers of M are needed for the steps inside the block.
+    def __init__(self, fused_system: FusedSystem, scenarios_attacks, steps, time_step_sec, f0,
+                 block_steps=100, bands_Hz=FREQUENCY_BANDS_HZ, settling_band_Hz=0.02) -> None:
+        self._system = fused_system
+        self._steps = steps
+        self._time_step_sec = time_step_sec
+        self.f0 = f0
+        self._bands_Hz = bands_Hz
+        self._bands = (np.array(bands_Hz) - f0)/f0 # per unit frequency deviation
+        self._settling_band = settling_band_Hz/f0
+        self._freq_indices = [xi.start for xi in fused_system.x_slices]
+        self._set_blocks(scenarios_attacks, block_steps)
+
+
+    def _set_blocks(self, scenarios_attacks, block_steps) -> None:
+        # Blocks of drive steps [start, start+length) with the loads of all scenarios at their start,
+        # as augmented drive columns [load; 1] (blocks x areas+1 x scenarios)
+        profiles = [LoadProfile.from_attacks(areas_attacks, self._time_step_sec) for areas_attacks in scenarios_attacks]
+        if not all(profile.is_piecewise_constant for profile in profiles):
+            raise ValueError("Gain tuning requires piecewise-constant (step) attacks.")
+        breakpoints = np.unique(np.concatenate([profile.breakpoints for profile in profiles]))
+        starts = np.union1d(np.arange(0, self._steps-1, block_steps), breakpoints[breakpoints < self._steps-1])
+        self._block_starts = starts
+        self._block_lengths = np.diff(np.append(starts, self._steps-1))
+        loads = np.stack([profile.evaluate(starts) for profile in profiles], axis=2) # blocks x areas x scenarios
+        self._drives = np.concatenate([loads, np.ones([len(starts), 1, len(profiles)])], axis=1)
+        self.scenarios = len(profiles)
+
+
+    def evaluate(self, Ks) -> dict:
+        # Metrics of every gain matrix (n x 3) of Ks, NaN for the unstable ones
+        Ks = np.asarray(Ks, dtype=np.float64)
+        Ms = self._system.closed_loop_matrices(Ks)
+        spectral_radius = np.abs(np.linalg.eigvals(Ms)).max(axis=1)
+        stable = spectral_radius < 1 + STABILITY_TOLERANCE
+        metrics = {"spectral_radius": spectral_radius, "stable": stable}
+        for key, values in self._simulate(Ms[stable], self._system.closed_loop_offsets(Ks[stable])).items():
+            metrics[key] = np.full(len(Ks), np.nan)
+            metrics[key][stable] = values
+        return metrics
+
+
+    def _propagators(self, Ms, offsets):
+        # Frequency rows of M^r and of (I + ... + M^(r-1)) @ [L, offset] for r = 1..block_steps,
+        # and the whole matrices for the lengths of the blocks, to carry the state to the next block
+        gains, size, _ = Ms.shape
+        drive_matrix = np.concatenate([np.repeat(self._system.L[None], gains, axis=0), offsets[:, :, None]], axis=2)
+        lengths = set(self._block_lengths.tolist())
+        longest = max(lengths)
+        freq_powers = np.empty([gains, longest, len(self._freq_indices), size])
+        freq_totals = np.empty([gains, longest, len(self._freq_indices), drive_matrix.shape[2]])
+        transitions = {}
+        power = np.repeat(np.eye(size)[None], gains, axis=0)
+        total = np.zeros_like(power)
+        for r in range(1, longest+1):
+            total += power
+            power = Ms @ power
+            freq_powers[:, r-1] = power[:, self._freq_indices]
+            freq_totals[:, r-1] = total[:, self._freq_indices] @ drive_matrix
+            if r in lengths:
+                transitions[r] = (power, total @ drive_matrix)
+        return freq_powers, freq_totals, transitions
+
+
+    def _simulate(self, Ms, offsets) -> dict:
+        freq_powers, freq_totals, transitions = self._propagators(Ms, offsets)
+        gains, n, scenarios = len(Ms), len(self._freq_indices), self._drives.shape[2]
+
+        # Metrics per gains x areas x scenarios, from the zero state at the first step
+        nadir = np.zeros([gains, n, scenarios])
+        zenith = np.zeros([gains, n, scenarios])
+        outside = np.zeros([len(self._bands), gains, n, scenarios])
+        last_unsettled = np.full([gains, n, scenarios], -1)
+        z = np.zeros([gains, Ms.shape[1], scenarios])
+        for start, length, drive in zip(self._block_starts, self._block_lengths, self._drives):
+            freqs = freq_powers[:, :length] @ z[:, None] + freq_totals[:, :length] @ drive # gains x steps x areas x scenarios
+            nadir = np.minimum(nadir, freqs.min(axis=1))
+            zenith = np.maximum(zenith, freqs.max(axis=1))
+            # As in FrequencySecurityReducer, every sample holds until the next one, the last one is not counted
+            counted = freqs[:, :self._steps-1-(start+1)]
+            for k, (low, high) in enumerate(self._bands):
+                outside[k] += ((counted < low) | (counted > high)).sum(axis=1)
+            unsettled = np.abs(freqs) > self._settling_band
+            last = length - 1 - unsettled[:, ::-1].argmax(axis=1)
+            last_unsettled = np.where(unsettled.any(axis=1), start + 1 + last, last_unsettled)
+
+            power, total_drive = transitions[length]
+            z = power @ z + total_drive @ drive
+
+        # Frequencies still outside the settling band at the end settle at the end of the simulation
+        settling_time = (last_unsettled + 1)*self._time_step_sec
+        metrics = {"worst_nadir_Hz": nadir.min(axis=(1, 2))*self.f0 + self.f0,
+                   "max_zenith_Hz": zenith.max(axis=(1, 2))*self.f0 + self.f0,
+                   "max_settling_time_sec": settling_time.max(axis=(1, 2)),
+                   "unsettled_scenarios": (last_unsettled == self._steps-1).any(axis=1).sum(axis=1)}
+        for (low, high), times in zip(self._bands_Hz, outside*self._time_step_sec):
+            metrics[f"max_time_outside_{low}-{high}_sec"] = times.max(axis=(1, 2))
+        return metrics
+
+
+def combine_metrics(results) -> dict:
+    # Worst cases over all scenarios of the metrics of the same gain sets over batches of the scenarios
+    metrics = dict(results[0])
+    for result in results[1:]:
+        metrics["worst_nadir_Hz"] = np.minimum(metrics["worst_nadir_Hz"], result["worst_nadir_Hz"])
+        metrics["unsettled_scenarios"] = metrics["unsettled_scenarios"] + result["unsettled_scenarios"]
+        for key in ["max_zenith_Hz", "max_settling_time_sec"] + [key for key in result if key.startswith("max_time_outside_")]:
+            metrics[key] = np.maximum(metrics[key], result[key])
+    return metrics
+
+
+class GainTuner:
+    # Differential evolution over the gains of the tuned areas, every generation is evaluated
+    # at once in batches of batch_size gain sets, each simulated with every batch of scenarios
+    # (one evaluator per batch) in the worker processes.
+    # Every evaluated gain set is kept, the Pareto front of the worst nadir and the worst
+    # settling time is taken from all of them.
+    def __init__(self, evaluators: list[GainEvaluator], K, areas, ranges, settling_weight, violation_weight,
+                 batch_size=64, executor=None) -> None:
+        self._evaluators = evaluators
+        self._K = np.asarray(K, dtype=np.float64)
+        self._areas = areas
+        self._bounds = [tuple(ranges[column]) for _ in areas for column in range(3)]
+        self._settling_weight = settling_weight
+        self._violation_weight = violation_weight
+        self._batch_size = batch_size
+        self._executor = executor
+        self.evaluated_Ks = []
+        self.evaluated = []
+
+
+    def to_gains(self, X) -> np.ndarray:
+        # Columns of X (tuned areas x Kp, Ki, Kd) to gain matrices (candidates x n x 3)
+        Ks = np.repeat(self._K[None], X.shape[1], axis=0)
+        Ks[:, self._areas] = X.T.reshape(X.shape[1], len(self._areas), 3)
+        return Ks
+
+
+    def evaluate(self, Ks) -> dict:
+        batches = [Ks[start:start+self._batch_size] for start in range(0, len(Ks), self._batch_size)]
+        # Every batch of gain sets with every batch of scenarios, the results of one batch of gain sets are consecutive
+        evaluators = self._evaluators*len(batches)
+        batches = [batch for batch in batches for _ in self._evaluators]
+        if self._executor is not None:
+            results = list(self._executor.map(GainEvaluator.evaluate, evaluators, batches))
+        else:
+            results = [evaluator.evaluate(batch) for evaluator, batch in zip(evaluators, batches)]
+        results = [combine_metrics(results[start:start+len(self._evaluators)])
+                   for start in range(0, len(results), len(self._evaluators))]
+        metrics = {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+        metrics["cost"] = self.cost(metrics)
+        self.evaluated_Ks.extend(Ks)
+        self.evaluated.extend({key: values[k] for key, values in metrics.items()} for k in range(len(Ks)))
+        return metrics
+
+
+    def cost(self, metrics) -> np.ndarray:
+        f0 = self._evaluators[0].f0
+        deviation = np.maximum(f0 - metrics["worst_nadir_Hz"], metrics["max_zenith_Hz"] - f0)
+        low, high = FREQUENCY_BANDS_HZ[0]
+        cost = (deviation + self._settling_weight*metrics["max_settling_time_sec"]
+                + self._violation_weight*metrics[f"max_time_outside_{low}-{high}_sec"])
+        return np.where(metrics["stable"], cost, UNSTABLE_COST + metrics["spectral_radius"])
+
+
+    def tune(self, generations, popsize, seed=None):
+        from scipy.optimize import differential_evolution # SciPy is imported only for the search
+        x0 = np.clip(self._K[self._areas].ravel(), *np.array(self._bounds).T)
+        result = differential_evolution(lambda X: self.evaluate(self.to_gains(X))["cost"], self._bounds,
+                                        maxiter=generations, popsize=popsize, seed=seed, x0=x0, polish=False,
+                                        vectorized=True, updating="deferred")
+        return self.to_gains(result.x[:, None])[0], result.fun
+
+
+    def pareto_front(self) -> list[int]:
+        # Indices of the stable gain sets not dominated in the worst nadir (higher) and settling time (lower)
+        stable = [k for k, metrics in enumerate(self.evaluated) if metrics["stable"]]
+        stable.sort(key=lambda k: (self.evaluated[k]["max_settling_time_sec"], -self.evaluated[k]["worst_nadir_Hz"]))
+        front, best_nadir = [], -np.inf
+        for k in stable:
+            if self.evaluated[k]["worst_nadir_Hz"] > best_nadir:
+                front.append(k)
+                best_nadir = self.evaluated[k]["worst_nadir_Hz"]
+        return front
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = SystemConfig.load(args.config)
+    gen_params = config.split(args.split)
+    time_step_sec = config.time_step_sec
+    fused_system = build_fused_system(gen_params, config.K, config.setpoint, time_step_sec)
+
+    steps = int(args.sim_time_sec/time_step_sec)
+    parser = ScenariosParser(args.file_path, args.end)
+    # Only the attacks of the scenarios are kept, as the drives of one evaluator per batch of scenarios
+    evaluators = [GainEvaluator(fused_system, [scenario["areas_attacks"][:gen_params.n] for scenario in batch],
+                                steps, time_step_sec, gen_params.f0, args.block_steps)
+                  for batch in iter_batches(parser.iter_scenarios(args.scenario_name), args.scenario_batch_size)]
+    scenarios_count = sum(evaluator.scenarios for evaluator in evaluators)
+    areas = [area-1 for area in args.areas] if args.areas else list(range(gen_params.n))
+    executor = ProcessPoolExecutor(args.workers) if args.workers > 1 else None
+    tuner = GainTuner(evaluators, config.K, areas, [args.kp_range, args.ki_range, args.kd_range],
+                      args.settling_weight, args.violation_weight, args.batch_size, executor)
+
+    start = time.perf_counter()
+    initial = tuner.evaluate(np.asarray(config.K)[None])
+    best_K, best_cost = tuner.tune(args.generations, args.popsize, args.seed)
+    elapsed = time.perf_counter() - start
+    if executor is not None:
+        executor.shutdown()
+    print(f"Evaluated {len(tuner.evaluated)} gain sets against {scenarios_count} scenarios in {round(elapsed, 2)} s "
+          f"({round(len(tuner.evaluated)/elapsed*60)} per minute)")
+
+    front = tuner.pareto_front()
+    on_front = set(front)
+    rows = []
+    for k, (K, metrics) in enumerate(zip(tuner.evaluated_Ks, tuner.evaluated)):
+        row = dict({"gain_set": k}, **flatten_parameters({"K": K}, ["K"]))
+        row.update({key: bool(value) if key == "stable" else value for key, value in metrics.items()})
+        rows.append(dict(row, pareto=k in on_front))
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print("Pareto front of the worst nadir and settling time:")
+    for k in front:
+        print(f"    nadir {round(tuner.evaluated[k]["worst_nadir_Hz"], 4)} Hz, settling {round(tuner.evaluated[k]["max_settling_time_sec"], 2)} s: "
+              f"K = {json.dumps(np.round(tuner.evaluated_Ks[k], 4).tolist())}")
+    print(f"Config gains: cost {round(initial["cost"][0], 4)}, nadir {round(initial["worst_nadir_Hz"][0], 4)} Hz, "
+          f"settling {round(initial["max_settling_time_sec"][0], 2)} s")
+    print(f"Best gains: cost {round(best_cost, 4)}, K = {json.dumps(np.round(best_K, 4).tolist())}")
+    print(f"All evaluated gain sets saved to {args.output}")
+
+    if args.verify:
+        # The worst case of the best gains over the scenarios simulated step by step, as in the parameter sweep
+        sample = {"D": config.D, "H": config.H, "Tt": config.Tt, "Tg": config.Tg, "R": config.R,
+                  "alpha": config.splits[args.split-1]["alpha"], "Tij": config.Tij, "K": best_K}
+        simulated = run_sample(config, args.split, sample, parser.iter_scenarios(args.scenario_name), args.sim_time_sec,
+                               args.scenario_batch_size)
+        evaluated = combine_metrics([evaluator.evaluate(best_K[None]) for evaluator in evaluators])
+        for key in ["worst_nadir_Hz", "max_zenith_Hz", "max_time_outside_58.8-60.5_sec"]:
+            print(f"{key}: simulated {simulated[key]}, batched evaluation {evaluated[key][0]} "
+                  f"(error {abs(simulated[key] - evaluated[key][0]):.3e})")
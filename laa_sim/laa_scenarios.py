@@ -9,10 +9,26 @@ Classes
 - ScenariosParser
 
     A class to parse and manage LAA scenarios.
+
+Functions
+-------
+- stream_scenarios(json_file_path: str, chunk_size: int) -> Iterator[tuple[int, int, dict]]
+
+    Yields the raw scenarios of the JSON file one by one with their byte offsets and lengths.
+
+- expand_scenario(scenario: dict, end: int) -> dict
+
+    Expands the attacks of one scenario from the JSON file.
 """
 
+import fnmatch
 import json
 
+from collections.abc import Iterator
+from pathlib import Path
+
+from utils import atomic_write
+
 class ScenariosParser:
     """
     ScenarioParser
@@ -21,24 +37,43 @@ class ScenariosParser:
 
     Methods
     -------
-    - __init__(json_file_path: str, end: int) -> None
+    - __init__(json_file_path: str, end: int, chunk_size: int = 1 << 20) -> None
     
-        Initializes the ScenariosParser object by parsing the scenarios from a JSON file.
+        Initializes the ScenariosParser object with the index of the scenarios in a JSON file.
     
     - get_all_scenarios() -> list
     
         Returns all parsed scenarios.
 
+    - iter_scenarios(pattern: str | None = None) -> Iterator[dict]
+
+        Yields the parsed scenarios one by one, only those whose name matches a shell-style pattern if given.
+
+    - get_scenario_names(pattern: str | None = None) -> list
+
+        Returns the names of all scenarios (or of those matching the pattern) without parsing them.
+
+    - get_scenario(scenario_name: str) -> dict | None
+
+        Returns a specific scenario by name, or None if there is no such scenario.
+
     - get_scenario_attacks(scenario_name: str) -> list
     
         Returns the attacks for a specific scenario by name.
 
+    The file is never loaded as a whole. On the first use it is read in chunks of chunk_size characters
+    and the byte offset and length of every scenario are stored in an index next to the file
+    (`<json_file_path>.index`), which is reused while the size and modification time of the file do not
+    change. A scenario is then read from its offset and parsed only when requested.
+
     Parameters
     ----------
     json_file_path: str
         The path to the JSON file containing the scenarios.
     end: int
         The end time of the attack in seconds.
+    chunk_size: int
+        The number of characters read at once while indexing the file.
 
     Scenario structure after parsing
     -------
@@ -49,6 +84,8 @@ class ScenariosParser:
         - start (int): The start time of the attack in seconds.
         - end (int): The end time of the attack in seconds.
         - strength (float): Attack strength as a fraction of the load.
+        - shape (str, optional): The shape of the load change, a step if missing (see `load_profiles.py`),
+          with its parameters, taken from the optional list `shapes` of the area in the JSON file.
 
     Example
     -------
@@ -57,29 +94,155 @@ class ScenariosParser:
     .. code-block:: python
         parser = ScenariosParser("scenarios.json", 300)
         scenario_attacks = parser.get_scenario_attacks("Multi_10_15_16_up_all")
+        for scenario in parser.iter_scenarios("Static_*_area1"):
+            print(scenario["name"])
     """
     
-    def __init__(self, json_file_path: str, end: int) -> None:
-        with open(json_file_path) as json_file:
-            self._scenarios = [scenario for scenario in json.load(json_file)]
-            for scenario in self._scenarios:
-                for i, area_attacks in enumerate(scenario["areas_attacks"]):
-                    area_attacks["ends"] = []
-                    if len(area_attacks["starts"]) > 1:
-                        area_attacks["ends"] = area_attacks["starts"][1:]
-                    area_attacks["ends"].append(end)
-                    
-                    attacks = []
-                    for start, end, strength in zip(area_attacks["starts"], area_attacks["ends"], area_attacks["strengths"]):
-                        
-                        attacks.append({"start": start, "end": end, "strength": strength})
-                    scenario["areas_attacks"][i] = attacks
-                    
+    def __init__(self, json_file_path: str, end: int, chunk_size: int = 1 << 20) -> None:
+        self._path = Path(json_file_path)
+        self._end = end
+        self._chunk_size = chunk_size
+        self._names, self._offsets, self._lengths = self._load_index()
+        self._index = {}
+        for position, name in enumerate(self._names):
+            self._index.setdefault(name, position)
+
     def get_all_scenarios(self) -> list:
-        return self._scenarios
-    
+        return list(self.iter_scenarios())
+
+    def iter_scenarios(self, pattern: str | None = None) -> Iterator[dict]:
+        with open(self._path, "rb") as json_file:
+            for position in self._matching_positions(pattern):
+                yield self._read_scenario(json_file, position)
+
+    def get_scenario_names(self, pattern: str | None = None) -> list:
+        return [self._names[position] for position in self._matching_positions(pattern)]
+
+    def get_scenario(self, scenario_name: str) -> dict | None:
+        position = self._index.get(scenario_name)
+        if position is None:
+            return None
+        with open(self._path, "rb") as json_file:
+            return self._read_scenario(json_file, position)
+
     def get_scenario_attacks(self, scenario_name: str) -> list:
-        for scenario in self._scenarios:
-            if scenario_name == scenario["name"]:
-                return scenario["areas_attacks"]
-        return []
+        scenario = self.get_scenario(scenario_name)
+        return [] if scenario is None else scenario["areas_attacks"]
+
+    def _matching_positions(self, pattern: str | None) -> list:
+        if pattern is None:
+            return list(range(len(self._names)))
+        return [position for position, name in enumerate(self._names) if fnmatch.fnmatchcase(name, pattern)]
+
+    def _read_scenario(self, json_file, position: int) -> dict:
+        json_file.seek(self._offsets[position])
+        return expand_scenario(json.loads(json_file.read(self._lengths[position])), self._end)
+
+    def _check_index(self, names, offsets, lengths) -> None:
+        # Every indexed scenario is read back at its offset before the index is used or stored
+        self._offsets, self._lengths = offsets, lengths
+        with open(self._path, "rb") as json_file:
+            for position, name in enumerate(names):
+                try:
+                    scenario = self._read_scenario(json_file, position)
+                except (ValueError, KeyError) as error:
+                    raise ValueError(f"{self._path}: the index of the scenario {name} does not match the file.") from error
+                if scenario["name"] != name:
+                    raise ValueError(f"{self._path}: the index of the scenario {name} does not match the file.")
+
+    def _load_index(self) -> tuple[list, list, list]:
+        # The index is valid only for the file it was built from
+        stat = self._path.stat()
+        index_path = Path(f"{self._path}.index")
+        if index_path.exists():
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                return index["names"], index["offsets"], index["lengths"]
+
+        names, offsets, lengths = [], [], []
+        for offset, length, scenario in stream_scenarios(self._path, self._chunk_size):
+            names.append(scenario["name"])
+            offsets.append(offset)
+            lengths.append(length)
+        self._check_index(names, offsets, lengths)
+        # A read-only directory only means that the file is indexed again next time
+        try:
+            with atomic_write(index_path, "w") as index_file:
+                json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                           "names": names, "offsets": offsets, "lengths": lengths}, index_file)
+        except OSError:
+            pass
+        return names, offsets, lengths
+
+
+def stream_scenarios(json_file_path, chunk_size: int = 1 << 20) -> Iterator[tuple[int, int, dict]]:
+    """
+    Yields the byte offset, the length in bytes and the raw scenario of every element of the JSON array
+    of scenarios, reading the file in chunks of chunk_size characters, so only the current chunk and
+    scenario are held in memory. Newlines are not translated (newline=""), so every character between
+    the scenarios is one byte of the file, also in files with CRLF line endings.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_file_path, encoding="utf-8", newline="") as json_file:
+        buffer, position = "", 0
+        offset = 0 # Byte offset of buffer[position] in the file
+        eof = False
+        expected = "["
+        while True:
+            # More of the file is read when the buffer runs out, the consumed part is dropped
+            if position == len(buffer):
+                if eof:
+                    raise ValueError(f"{json_file_path}: unexpected end of the file, expected {expected}.")
+                chunk = json_file.read(chunk_size)
+                buffer, position, eof = chunk, 0, len(chunk) < chunk_size
+                continue
+            character = buffer[position]
+            if character in " \t\r\n":
+                position += 1
+                offset += 1
+            elif expected == "[":
+                if character != "[":
+                    raise ValueError(f"{json_file_path}: the scenarios must be a JSON array.")
+                position += 1
+                offset += 1
+                expected = "a scenario or ]"
+            elif character == "]" and expected != "a scenario":
+                return
+            elif expected == ", or ]":
+                if character != ",":
+                    raise ValueError(f"{json_file_path}: expected , or ] at byte {offset}.")
+                position += 1
+                offset += 1
+                expected = "a scenario"
+            else:
+                # A scenario cut by the end of the buffer is decoded again with more of the file
+                try:
+                    scenario, scenario_end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    chunk = json_file.read(chunk_size)
+                    buffer, position, eof = buffer[position:] + chunk, 0, len(chunk) < chunk_size
+                    continue
+                length = len(buffer[position:scenario_end].encode())
+                yield offset, length, scenario
+                position = scenario_end
+                offset += length
+                expected = ", or ]"
+
+def expand_scenario(scenario: dict, end: int) -> dict:
+    """
+    Expands the starts and strengths of every area of a scenario from the JSON file into attacks
+    with start, end and strength, an attack lasts until the start of the next one or the end.
+    The entries of the optional shapes of an area (e.g. {"shape": "sine", "frequency_hz": 0.5},
+    null for a step) are added to the attacks.
+    """
+    areas_attacks = []
+    for area_attacks in scenario["areas_attacks"]:
+        ends = area_attacks["starts"][1:] + [end]
+        shapes = area_attacks.get("shapes") or [None]*len(area_attacks["starts"])
+        areas_attacks.append([dict({"start": start, "end": attack_end, "strength": strength}, **(shape or {}))
+                              for start, attack_end, strength, shape in zip(area_attacks["starts"], ends,
+                                                                            area_attacks["strengths"], shapes)])
+    return dict(scenario, areas_attacks=areas_attacks)
@@ -0,0 +1,130 @@
+import numpy as np
+
+from abc import ABC, abstractmethod
+
+
+LOAD_SHAPES = ("step", "ramp", "sine", "trace")
+
+
+def piecewise_constant_loads(areas_attacks, time_step_sec) -> tuple[np.ndarray, np.ndarray]:
+    # Returns the breakpoints (time step indices, starting with 0) and the loads of all areas
+    # between them: loads[k] holds for breakpoints[k] <= t < breakpoints[k+1] (the last one until the end).
+    # Only the step attacks are included, the other shapes are components of the LoadProfile.
+    ticks = [[(int(attack["start"] / time_step_sec), int(attack["end"] / time_step_sec))
+              for attack in area_attacks if attack.get("shape", "step") == "step"]
+             for area_attacks in areas_attacks]
+    breakpoints = np.unique([0] + [tick for area_ticks in ticks for attack_ticks in area_ticks for tick in attack_ticks])
+    loads = np.zeros([len(breakpoints), len(areas_attacks)])
+    for i, area_attacks in enumerate(areas_attacks):
+        steps = [attack for attack in area_attacks if attack.get("shape", "step") == "step"]
+        for (start_index, end_index), attack in zip(ticks[i], steps):
+            loads[(breakpoints >= start_index) & (breakpoints < end_index), i] = attack["strength"]
+    return breakpoints, loads
+
+
+class LoadComponent(ABC):
+    # A time-varying load change of one area between the time step indices start and end,
+    # added to the piecewise-constant part of the profile. Subclasses compute the values
+    # for a whole slice of time step indices at once.
+    def __init__(self, area, start, end, strength, time_step_sec) -> None:
+        self.area = area
+        self.start = start
+        self.end = end
+        self.strength = strength
+        self.time_step_sec = time_step_sec
+
+
+    @abstractmethod
+    def values(self, indices) -> np.ndarray:
+        pass
+
+
+class RampLoad(LoadComponent):
+    # Rises linearly from 0 at the start to the strength over ramp_sec, then holds it until the end
+    def __init__(self, area, start, end, strength, time_step_sec, ramp_sec=None) -> None:
+        super().__init__(area, start, end, strength, time_step_sec)
+        self.ramp_steps = max((end - start) if ramp_sec is None else ramp_sec/time_step_sec, 1)
+
+
+    def values(self, indices) -> np.ndarray:
+        return self.strength*np.minimum((indices - self.start)/self.ramp_steps, 1.0)
+
+
+class SineLoad(LoadComponent):
+    # Oscillatory attack: strength*sin(2*pi*frequency_hz*(t - start) + phase_rad)
+    def __init__(self, area, start, end, strength, time_step_sec, frequency_hz, phase_rad=0.0) -> None:
+        super().__init__(area, start, end, strength, time_step_sec)
+        self.frequency_hz = frequency_hz
+        self.phase_rad = phase_rad
+
+
+    def values(self, indices) -> np.ndarray:
+        t = (indices - self.start)*self.time_step_sec
+        return self.strength*np.sin(2*np.pi*self.frequency_hz*t + self.phase_rad)
+
+
+class TraceLoad(LoadComponent):
+    # Recorded load trace (per unit, one sample per time step from the start) in a .npy file,
+    # scaled by the strength. The file is memory-mapped, only the samples in use are read,
+    # the last sample holds if the trace is shorter than the attack.
+    def __init__(self, area, start, end, strength, time_step_sec, path) -> None:
+        super().__init__(area, start, end, strength, time_step_sec)
+        self.path = path
+        self._trace = np.load(path, mmap_mode="r")
+        if self._trace.ndim != 1 or len(self._trace) == 0:
+            raise ValueError(f"{path}: the load trace must be a non-empty one-dimensional array.")
+
+
+    def values(self, indices) -> np.ndarray:
+        return self.strength*np.asarray(self._trace[np.minimum(indices - self.start, len(self._trace)-1)], dtype=np.float64)
+
+
+class LoadProfile:
+    # Load change of all areas as a function of the time step index: a piecewise-constant
+    # part (breakpoints and the loads between them) plus time-varying components.
+    # It is evaluated only at the requested indices, so a profile is never expanded
+    # over the whole horizon unless the whole horizon is requested.
+    def __init__(self, n, breakpoints=None, loads=None, components=()) -> None:
+        self.n = n
+        self.breakpoints = np.zeros(1, dtype=int) if breakpoints is None else np.asarray(breakpoints)
+        self.loads = np.zeros([1, n]) if loads is None else np.asarray(loads)
+        self.components = list(components)
+
+
+    @classmethod
+    def from_attacks(cls, areas_attacks, time_step_sec) -> "LoadProfile":
+        # Attacks without a shape (or with "shape": "step") are piecewise constant
+        breakpoints, loads = piecewise_constant_loads(areas_attacks, time_step_sec)
+        components = []
+        for i, area_attacks in enumerate(areas_attacks):
+            for attack in area_attacks:
+                shape = attack.get("shape", "step")
+                if shape == "step":
+                    continue
+                start, end = int(attack["start"] / time_step_sec), int(attack["end"] / time_step_sec)
+                if shape == "ramp":
+                    components.append(RampLoad(i, start, end, attack["strength"], time_step_sec, attack.get("ramp_sec")))
+                elif shape == "sine":
+                    components.append(SineLoad(i, start, end, attack["strength"], time_step_sec,
+                                               attack["frequency_hz"], attack.get("phase_rad", 0.0)))
+                elif shape == "trace":
+                    components.append(TraceLoad(i, start, end, attack["strength"], time_step_sec, attack["path"]))
+                else:
+                    raise ValueError(f"Unknown shape of the attack '{shape}', expected one of {', '.join(LOAD_SHAPES)}.")
+        return cls(len(areas_attacks), breakpoints, loads, components)
+
+
+    @property
+    def is_piecewise_constant(self) -> bool:
+        return len(self.components) == 0
+
+
+    def evaluate(self, indices) -> np.ndarray:
+        # Loads of all areas (len(indices) x n) at the sorted time step indices
+        indices = np.asarray(indices)
+        load = self.loads[np.searchsorted(self.breakpoints, indices, side="right") - 1]
+        for component in self.components:
+            first, last = np.searchsorted(indices, [component.start, component.end])
+            if first < last:
+                load[first:last, component.area] += component.values(indices[first:last])
+        return load
@@ -1,110 +1,259 @@
 import numpy as np
 import argparse
+import json
+import time
 
-from genparams import GenParams
-from simulation import StateInputOutputVectors, Simulation
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from system_config import SystemConfig
+from simulation import StateInputOutputVectors, Simulation, BatchSimulation, StreamingSimulation
 from laa_scenarios import ScenariosParser
+from results_store import RESULTS_FORMATS
+from discretisation_cache import set_cache_dir
+from profiling import profiler, set_profiling
+from utils import iter_batches
 
 # Argument parsing
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run the LAA simulation. By default, it runs all scenarios in the scenarios.json file.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system, its splits, PID gains and time step.")
     parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file containing the scenarios.")
-    parser.add_argument("-s", "--scenario_name", type=str, default=None, help="The name of the scenario to run.")
+    parser.add_argument("-s", "--scenario_name", type=str, default=None, help="The name of the scenario to run, or a shell-style pattern of the names (e.g. 'Static_*_area1').")
     parser.add_argument("-t", "--sim_time_sec", type=int, default=300, help="The end time of the simulation in seconds.")
     parser.add_argument("-e", "--end", type=int, default=300, help="The end time of the attacks in seconds.")
     parser.add_argument("-pc", "--print_continuous_matrices", action="store_true", help="Print the state space matrices in continuous form.")
     parser.add_argument("-pd", "--print_discrete_matrices", action="store_true", help="Print the state space matrices in discrete form.")
     parser.add_argument("-pa", "--plot_all", action="store_true", help="Apart from frequency, also plot RoCoF, Tie-Lines output, ACE, and LFC controller output.")
+    parser.add_argument("-en", "--engine", type=str, default="fused", choices=["fused", "sparse", "loop", "segmented"], help="The time-stepping engine: one matrix-vector product per step for the whole system (fused), the same with the system in sparse form (sparse), the per-area reference loop (loop) or propagation of whole constant-load segments between attack breakpoints (segmented).")
+    parser.add_argument("-b", "--batch_size", type=int, default=0, help="Advance up to this many scenarios together in one batched simulation. By default, scenarios are simulated one by one.")
+    parser.add_argument("-sp", "--splits", type=int, nargs="+", default=[1], help="The splits of generators into areas to simulate, numbered from 1 as in the config.")
+    parser.add_argument("-wk", "--workers", type=int, default=1, help="The number of worker processes simulating the scenario x split grid in parallel.")
+    parser.add_argument("-np", "--no_plot", action="store_true", help="Do not plot, only store the results and print and store the final frequencies and metrics. Plotting libraries are then never imported.")
+    parser.add_argument("-ns", "--no_show", action="store_true", help="Do not show the plots, render them to files in --plot_dir instead.")
+    parser.add_argument("-pdir", "--plot_dir", type=str, default=None, help="Render the plots to PNG files in this directory (results/plots with --no_show) instead of showing them.")
+    parser.add_argument("-pw", "--plot_workers", type=int, default=1, help="The number of background processes rendering the plots to files.")
+    parser.add_argument("-rf", "--results_format", type=str, default="npy", choices=RESULTS_FORMATS, help="Store all trajectories as memory-mappable .npy files (npy) or compressed archives (npz) per scenario, or only the frequencies as text (csv).")
+    parser.add_argument("-dc", "--discretisation_cache_dir", type=str, default=None, help="Store the discretised matrices of the areas in this directory and reuse them in later runs.")
+    parser.add_argument("-ss", "--sample_step_sec", type=float, default=None, help="With the segmented engine, export the results only every this many seconds (and at the end of the simulation).")
+    parser.add_argument("-st", "--sample_times", type=float, nargs="+", default=None, help="With the segmented engine, export the results only at these times in seconds.")
+    parser.add_argument("-str", "--stream", action="store_true", help="Simulate in chunks written through to disk, with memory independent of the simulation time. Prints the frequency nadir instead of plotting.")
+    parser.add_argument("-ckd", "--checkpoint_dir", type=str, default=None, help="With --stream, save checkpoints of the simulations in this directory and continue interrupted ones from them.")
+    parser.add_argument("-ckc", "--checkpoint_chunks", type=int, default=1, help="The number of chunks between the checkpoints.")
+    parser.add_argument("-rp", "--reuse_prefixes", action="store_true", help="Simulate the time steps that the scenarios of a batch share before their loads diverge only once (requires --batch_size).")
+    parser.add_argument("-cs", "--chunk_steps", type=int, default=10000, help="The number of time steps in one chunk of the streaming simulation.")
+    parser.add_argument("-be", "--backend", type=str, default="numpy", choices=["numpy", "numba"], help="The backend of the fused engine, numba compiles the whole step (falls back to numpy when Numba is not installed).")
+    parser.add_argument("-prof", "--profile", type=str, default=None, help="Save the time of every stage of the run (matrices, cont2discrete, vectors, stepping, controller updates with the loop engine, timed within the stepping, metrics, io and plotting), the throughput in ticks and scenarios per second (wall clock and per process of the stepping) and the peak memory to this JSON file.")
+    parser.add_argument("-cprof", "--cprofile", type=str, default=None, help="Run under cProfile and save the pstats dump of the main process to this file.")
+    parser.add_argument("-ce", "--compare_engines", action="store_true", help="Only report the parity and speedup of the fused engine (numpy and numba backends) against the reference loop for the scenarios.")
+    parser.add_argument("-pt", "--parity_tolerance", type=float, default=1e-8, help="With --compare_engines, the largest allowed absolute difference from the reference loop, the run fails when an engine exceeds it.")
     args = parser.parse_args()
     if args.end > args.sim_time_sec:
         parser.error("The end time of the attack must be less than or equal to the simulation time.")
+    if args.batch_size > 0 and args.engine != "fused":
+        parser.error("Batched simulation requires the fused engine.")
+    if (args.sample_step_sec is not None or args.sample_times is not None) and args.engine != "segmented":
+        parser.error("Sampling the results requires the segmented engine.")
+    if args.stream and (args.engine not in ["fused", "sparse"] or args.results_format == "npz"):
+        parser.error("Streaming simulation requires the fused or sparse engine and the npy or csv results format.")
+    if args.backend != "numpy" and (args.engine != "fused" or args.stream):
+        parser.error("The numba backend applies only to the fused engine without --stream.")
+    if args.compare_engines and (args.engine != "fused" or args.stream or args.batch_size > 0 or args.workers > 1):
+        parser.error("--compare_engines compares the fused engine with the loop itself, without --engine, --stream, --batch_size or --workers.")
+    if args.checkpoint_dir is not None and (not args.stream or args.chunk_steps < 3):
+        parser.error("Checkpoints require the streaming simulation with chunks of at least 3 time steps.")
+    if args.reuse_prefixes and (args.batch_size < 2 or args.backend != "numpy"):
+        parser.error("Prefix reuse requires batches of scenarios (--batch_size) with the numpy backend.")
+    number_of_splits = SystemConfig.load(args.config).number_of_splits
+    if any(not 1 <= split <= number_of_splits for split in args.splits):
+        parser.error(f"The splits must be numbered from 1 to {number_of_splits} as in {args.config}.")
+    if args.no_show and args.plot_dir is None:
+        args.plot_dir = "results/plots"
     return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    
-    # GENERAL PARAMETERS
-    f0 = 60 # Hz
-    base_MV = 250 # MV
-    n = 3 # number of Areas
+def get_sample_indexes(indexes, time_step_sec, sample_step_sec, sample_times) -> np.ndarray:
+    # Time step indexes at which the segmented engine exports the results, always with the first and the last one
+    if sample_times is not None:
+        samples = np.rint(np.array(sample_times)/time_step_sec).astype(int)
+    elif sample_step_sec is not None:
+        samples = indexes[::max(int(round(sample_step_sec/time_step_sec)), 1)]
+    else:
+        return indexes
+    samples = samples[(samples >= indexes[0]) & (samples <= indexes[-1])]
+    return np.unique(np.concatenate([[indexes[0]], samples, [indexes[-1]]]))
 
-    # Generator parameters
-    D = np.array([0.015, 0.014, 0.015])
-    H = np.array([5.031, 6.051, 3.741])
 
-    # Turbine and governor parameters 
-    Tt_general = [0.4, 0.36, 0.42, 0.44, 0.32, 0.4, 0.3, 0.4, 0.41, 0.48]
-    Tg_general = [0.08, 0.06, 0.07, 0.06, 0.06, 0.08, 0.07, 0.07, 0.08, 0.06]
+def build_simulation(gen_params, K, setpoint, time_step_sec, T, indexes, scenario, engine,
+                     results_format, backend="numpy") -> Simulation:
+    state_in_out_vectors = StateInputOutputVectors(gen_params.n, gen_params.m, T, time_step_sec,
+                                                   None, scenario["areas_attacks"], indexes)
+    return Simulation(gen_params.f0, gen_params.base_MV, gen_params.n, gen_params.m,
+                      gen_params.D, gen_params.H, gen_params.Tt, gen_params.Tg,
+                      gen_params.R, gen_params.alpha, gen_params.beta, gen_params.Tij,
+                      K, setpoint, time_step_sec, T, indexes,
+                      state_in_out_vectors.get_x(), state_in_out_vectors.get_w(),
+                      state_in_out_vectors.get_u(), state_in_out_vectors.get_y(), engine, results_format, backend)
 
-    # Droop characteristic
-    R_general = [3, 3, 3.3, 2.7273, 2.6667, 2.5, 2.8235, 3, 2.9412, 2.3465]
 
-    # Tie-lines, matrix
-    Tij = np.array([[   0,  0.2, 0.25],
-                    [ 0.2,    0, 0.12],
-                    [0.25, 0.12,    0]])
+def simulate_scenarios(gen_params, K, setpoint, time_step_sec, T, indexes, scenarios, engine,
+                       results_format, backend, reuse_prefixes=False, plot=False, plot_all=False) -> list[Simulation]:
+    # Runs in the worker processes, results that are appended to shared files
+    # (final frequencies, metrics) are written by the main process in order.
+    # Only what the main process prints and plots is sent back to it.
+    simulations = [build_simulation(gen_params, K, setpoint, time_step_sec, T, indexes,
+                                    scenario, engine, results_format, backend) for scenario in scenarios]
+    if len(simulations) > 1:
+        BatchSimulation(simulations, reuse_prefixes).run(scenarios)
+    else:
+        simulations[0].run(scenarios[0])
+    for simulation in simulations:
+        simulation.release_trajectories(plot, plot_all)
+    return simulations
 
+
+def init_worker(discretisation_cache_dir, profiling) -> None:
+    set_cache_dir(discretisation_cache_dir)
+    set_profiling(profiling)
+
+
+def run_profiled_task(run_task, *task):
+    # The measurements of a worker process are returned with the simulations and merged by the main process
+    return run_task(*task), profiler.collect()
+
+
+def run_tasks(executor, run_task, tasks, ahead, profiled=False):
+    # Results of the tasks in order, at most ahead tasks are submitted before their results are taken,
+    # so that only their batches of scenarios are held in memory
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(run_profiled_task, run_task, *task) if profiled else executor.submit(run_task, *task))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def stream_scenarios(gen_params, K, setpoint, time_step_sec, steps, chunk_steps, scenarios,
+                     results_format, checkpoint_dir=None, checkpoint_chunks=1, engine="fused") -> list[StreamingSimulation]:
+    simulations = []
+    for scenario in scenarios:
+        simulation = StreamingSimulation(gen_params.f0, gen_params.base_MV, gen_params.n, gen_params.m,
+                                         gen_params.D, gen_params.H, gen_params.Tt, gen_params.Tg,
+                                         gen_params.R, gen_params.alpha, gen_params.beta, gen_params.Tij,
+                                         K, setpoint, time_step_sec, steps, chunk_steps, results_format,
+                                         checkpoint_dir, checkpoint_chunks, engine)
+        simulation.run(scenario)
+        simulations.append(simulation)
+    return simulations
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start_time = time.perf_counter()
+    set_profiling(args.profile is not None)
+    if args.cprofile is not None:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
     
-    # SPLITS PARAMETERS
-    number_of_splits = 3
-    
-    # Number of Governor-Turbines in each Area
-    m1 = [3, 6, 1]
-    m2 = [2, 3, 5]
-    m3 = [4, 2, 4]
-
-    # Automatic Generation Control (AGC) parameters
-    # Alfa only if many Governor-Turibne in one Area, must sum to 1 in one Area
-    alpha1 = [np.array([0.4, 0.6, 0]),
-              np.array([0.55, 0.45, 0, 0, 0, 0]),
-              np.array([1])]
-    alpha2 = [np.array([0.4, 0.6]),
-              np.array([0.55, 0.45, 0]),
-              np.array([0.34, 0.33, 0.33, 0, 0])]
-    alpha3 = [np.array([0.4, 0.6, 0, 0]),
-              np.array([0.55, 0.45]),
-              np.array([0.34, 0.33, 0.33, 0])]
-
-    Split1_parameters = GenParams(f0, base_MV, n, m1, D, H, Tt_general, Tg_general, R_general, alpha1, Tij)
-    Split2_parameters = GenParams(f0, base_MV, n, m2, D, H, Tt_general, Tg_general, R_general, alpha2, Tij)
-    Split3_parameters = GenParams(f0, base_MV, n, m3, D, H, Tt_general, Tg_general, R_general, alpha3, Tij)
-    GeneratorsParametersList = [Split1_parameters, Split2_parameters, Split3_parameters]
+    # SYSTEM PARAMETERS (GenParams of the splits are built only when used)
+    config = SystemConfig.load(args.config)
     
     
     # TIME PARAMETERS
-    time_step_sec = 0.01
-    indexes = np.arange(int(args.sim_time_sec/time_step_sec))
-    T = np.array(indexes*time_step_sec, dtype=np.float64).tolist()
+    time_step_sec = config.time_step_sec
+    steps = int(args.sim_time_sec/time_step_sec)
+    if not args.stream:
+        indexes = np.arange(steps)
+        if args.engine == "segmented":
+            indexes = get_sample_indexes(indexes, time_step_sec, args.sample_step_sec, args.sample_times)
+        T = np.array(indexes*time_step_sec, dtype=np.float64)
     
     
     # LFC CONTROLLERS PARAMETERS
-    setpoint = 0
-    K = np.array([[4.5, 1.1, 2.8],
-                  [4, 1.1, 2.5],
-                  [3.8, 1.2, 2.4]])
+    setpoint = config.setpoint
+    K = config.K
 
 
     # LOAD CHANGE
-    initial_loads_pu = np.array([np.zeros(len(T)) for _ in range(n)])
-    parser = ScenariosParser("scenarios.json", args.sim_time_sec)
-    scenarios = parser.get_all_scenarios()
-    for scenario in scenarios:
-        if args.scenario_name is not None and scenario["name"] != args.scenario_name:
-            continue
-                
-        for split in range(1): #range(number_of_splits):
-            gen_params = GeneratorsParametersList[split]
-            state_in_out_vectors = StateInputOutputVectors(gen_params.n, gen_params.m, T, time_step_sec,
-                                                        initial_loads_pu, scenario["areas_attacks"])
-            simulation = Simulation(gen_params.f0, gen_params.base_MV, gen_params.n, gen_params.m,
-                                    gen_params.D, gen_params.H, gen_params.Tt, gen_params.Tg,
-                                    gen_params.R, gen_params.alpha, gen_params.beta, gen_params.Tij,
-                                    K, setpoint, time_step_sec, T, indexes,
-                                    state_in_out_vectors.get_x(), state_in_out_vectors.get_w(),
-                                    state_in_out_vectors.get_u(), state_in_out_vectors.get_y())
-            simulation.run_and_plot_results(args.print_continuous_matrices, args.print_discrete_matrices,
-                                            args.plot_all, scenario)
-        
-        if scenario["name"] == args.scenario_name:
-            break
\ No newline at end of file
+    # The attacks are turned into load profiles evaluated only at the simulated time steps.
+    # Only the scenarios matching the name are read from the file
+    parser = ScenariosParser(args.file_path, args.end)
+    scenarios = parser.iter_scenarios(args.scenario_name)
+    
+    parity_failures = []
+    if args.compare_engines:
+        for scenario in scenarios:
+            for split in args.splits:
+                simulation = build_simulation(config.split(split), K, setpoint, time_step_sec, T, indexes,
+                                              scenario, "fused", args.results_format)
+                report = simulation.compare_engines(scenario)
+                print(json.dumps(dict(report, split=split)))
+                parity_failures += [(scenario["name"], split, name, result["max_abs_diff"]) for name, result in report.items()
+                                    if isinstance(result, dict) and result["max_abs_diff"] > args.parity_tolerance]
+        for name, split, engine, max_abs_diff in parity_failures:
+            print(f"PARITY {name} split {split} {engine}: {max_abs_diff:.3e} from the reference loop")
+    else:
+        # Scenario x split grid, the results are reported in this order.
+        # The tasks are built lazily, the scenarios are read in batches as the tasks are run.
+        def iter_tasks():
+            for scenarios_batch in iter_batches(scenarios, max(args.batch_size, 1)):
+                for split in args.splits:
+                    batch = scenarios_batch
+                    if len(args.splits) > 1:
+                        batch = [dict(scenario, name=scenario["name"] + f"_split{split}") for scenario in batch]
+                    if args.stream:
+                        yield (config.split(split), K, setpoint, time_step_sec, steps,
+                               args.chunk_steps, batch, args.results_format, args.checkpoint_dir, args.checkpoint_chunks,
+                               args.engine)
+                    else:
+                        yield (config.split(split), K, setpoint, time_step_sec, T, indexes,
+                               batch, args.engine, args.results_format, args.backend, args.reuse_prefixes,
+                               not args.no_plot, args.plot_all)
+    
+        renderer = None
+        if args.plot_dir is not None and not args.no_plot:
+            from plotting import PlotRenderer # Plotting libraries are imported only when plotting
+            renderer = PlotRenderer(args.plot_dir, args.plot_workers)
+        set_cache_dir(args.discretisation_cache_dir)
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                       initargs=(args.discretisation_cache_dir, profiler.enabled)) if args.workers > 1 else None
+        run_task = stream_scenarios if args.stream else simulate_scenarios
+        if executor is not None:
+            # Two tasks per worker keep the workers busy while the main process prints and plots
+            results = run_tasks(executor, run_task, iter_tasks(), 2*args.workers, profiler.enabled)
+        else:
+            results = (run_task(*task) for task in iter_tasks())
+        for simulations in results:
+            if executor is not None and profiler.enabled:
+                simulations, measurements = simulations
+                profiler.merge(measurements)
+            for simulation in simulations:
+                simulation.print_matrices(args.print_continuous_matrices, args.print_discrete_matrices)
+                if args.no_plot:
+                    simulation.print_results()
+                else:
+                    simulation.plot_and_print_results(args.plot_all, renderer)
+        if executor is not None:
+            executor.shutdown()
+        if renderer is not None:
+            with profiler.stage("plotting"): # Waits for the plots still rendered in the background
+                renderer.close()
+
+    if args.cprofile is not None:
+        cprofiler.disable()
+        cprofiler.dump_stats(args.cprofile)
+    if args.profile is not None:
+        profiler.add_time("total", time.perf_counter() - start_time)
+        report = profiler.report()
+        with open(args.profile, "w") as f:
+            json.dump(report, f, indent=4)
+        print(" | ".join([f"{name}" + (f" (within {stage['within']})" if "within" in stage else "") + f": {round(stage['sec'], 3)} s"
+                          for name, stage in report["stages"].items()]))
+        throughput = report.get("throughput", {})
+        if "ticks_per_stepping_sec_per_process" in throughput:
+            print(f"{round(throughput['ticks_per_wall_clock_sec'])} ticks/s | {round(throughput['scenarios_per_wall_clock_sec'], 2)} scenarios/s "
+                  f"(wall clock), stepping {round(throughput['ticks_per_stepping_sec_per_process'])} ticks/s per process")
+    if parity_failures:
+        raise SystemExit(1)
@@ -0,0 +1,94 @@
+import numpy as np
+import seaborn as sns
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from matplotlib.figure import Figure
+
+
+LINE_TYPES = ['solid', 'dashed', 'dashdot', 'dotted']
+
+
+def set_plot_theme() -> None:
+    sns.set_theme(style="whitegrid")
+    sns.set_context("paper", font_scale=1.5)
+    sns.set_palette("deep")
+    sns.set_style("whitegrid", {"axes.grid": True, "grid.color": ".9", "grid.linestyle": "--"})
+
+
+def decimate_min_max(x, y, buckets) -> tuple[np.ndarray, np.ndarray]:
+    # Keeps the minimum and the maximum of every bucket (one bucket per pixel column),
+    # so the decimated line covers the same pixels as the full one.
+    if buckets <= 0 or len(y) <= 2*buckets:
+        return x, y
+    bucket_len = -(-len(y) // buckets)
+    padded = np.pad(y, (0, bucket_len*buckets - len(y)), mode="edge").reshape(buckets, bucket_len)
+    starts = np.arange(buckets)*bucket_len
+    indices = np.sort(np.stack([starts + padded.argmin(axis=1), starts + padded.argmax(axis=1)], axis=1), axis=1)
+    indices = np.unique(np.concatenate([[0], np.minimum(indices.ravel(), len(y)-1), [len(y)-1]]))
+    return x[indices], y[indices]
+
+
+def draw_LFC_results(fig, description, T, freqs, rocofs, tie_lines, aces, lfc_outputs, f0, plot_all=False,
+                     decimate=False) -> None:
+    # freqs, rocofs, tie_lines, aces and lfc_outputs hold one series per area,
+    # rocofs are given for T[1:]. Only frequencies are required when plot_all is False.
+    buckets = int(fig.get_size_inches()[0]*fig.dpi) if decimate else 0
+    rows = 5 if plot_all else 1
+    axes = [fig.add_subplot(rows, 1, row+1) for row in range(rows)]
+    series = [("Freq [Hz]", T, freqs)]
+    if plot_all:
+        series += [("RoCoF", T[1:], rocofs), ("Tie-lines", T, tie_lines),
+                   ("ACE", T, aces), ("LFC output", T, lfc_outputs)]
+
+    for ax, (ylabel, x, ys) in zip(axes, series):
+        for i, y in enumerate(ys):
+            ax.plot(*decimate_min_max(x, y, buckets), linestyle=LINE_TYPES[i % len(LINE_TYPES)])
+        ax.set_xlim(T[0], T[-1])
+        ax.set_ylabel(ylabel)
+    for ax in axes[:-1]:
+        ax.set_xticks([])
+    axes[0].set_title(description)
+    axes[-1].set_xlabel("Time [s]")
+
+    # Nominal frequency
+    axes[0].axhline(y=f0, color='r', linestyle=LINE_TYPES[0], linewidth=0.5)
+    # Safe operating frequency ranges
+    axes[0].axhline(y=58.8, color='b', linestyle=LINE_TYPES[1], linewidth=0.5)
+    axes[0].axhline(y=60.5, color='b', linestyle=LINE_TYPES[1], linewidth=0.5)
+    axes[0].axhline(y=57.5, color='g', linestyle=LINE_TYPES[2], linewidth=0.5)
+    axes[0].axhline(y=61.5, color='g', linestyle=LINE_TYPES[2], linewidth=0.5)
+    axes[0].axhline(y=57.0, color='r', linestyle=LINE_TYPES[3], linewidth=0.5)
+    axes[0].axhline(y=62.5, color='r', linestyle=LINE_TYPES[3], linewidth=0.5)
+    axes[0].legend([f"Area{i+1}" for i in range(len(freqs))], loc="upper right")
+
+
+def render_LFC_results(path, description, T, freqs, rocofs, tie_lines, aces, lfc_outputs, f0, plot_all=False) -> str:
+    # Draws on a standalone Figure saved with the non-interactive Agg canvas, no pyplot state is involved.
+    set_plot_theme()
+    fig = Figure()
+    draw_LFC_results(fig, description, np.asarray(T), freqs, rocofs, tie_lines, aces, lfc_outputs, f0,
+                     plot_all, decimate=True)
+    fig.savefig(path)
+    return path
+
+
+class PlotRenderer:
+    # Renders figures to files in background processes, while the next scenarios are simulated.
+    def __init__(self, plot_dir, workers=1) -> None:
+        self._plot_dir = plot_dir
+        Path(self._plot_dir).mkdir(parents=True, exist_ok=True)
+        self._executor = ProcessPoolExecutor(workers)
+        self._futures = []
+
+
+    def submit(self, name, description, T, freqs, rocofs, tie_lines, aces, lfc_outputs, f0, plot_all=False) -> None:
+        path = f"{self._plot_dir}/{name}.png"
+        self._futures.append(self._executor.submit(render_LFC_results, path, description, T, freqs, rocofs,
+                                                   tie_lines, aces, lfc_outputs, f0, plot_all))
+
+
+    def close(self) -> list[str]:
+        paths = [future.result() for future in self._futures]
+        self._executor.shutdown()
+        return paths
@@ -0,0 +1,150 @@
+import time
+
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+_NO_STAGE = nullcontext()
+
+
+class Profiler:
+    # Wall time of the named stages of a run (with the number of calls), counters (e.g. ticks and
+    # scenarios) and peaks (e.g. bytes of the state vectors). Disabled, stage() returns a shared
+    # no-op context and wrap() and iterate() return their argument, so the instrumented code runs
+    # as without the profiler. Reports of worker processes are merged with collect() and merge().
+    # A stage timed inside another one (within) is marked in the report, its time is part of both.
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+
+    def reset(self) -> None:
+        self._times = {}
+        self._calls = {}
+        self._counters = {}
+        self._peaks = {}
+        self._within = {}
+
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+
+    def wrap(self, name, function, within=None):
+        # The function with its calls timed as the stage, for calls inside hot loops
+        if not self.enabled:
+            return function
+        if within is not None:
+            self._within[name] = within
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+        return timed
+
+
+    def iterate(self, name, iterable):
+        # The items of the iterable with the time of producing them (e.g. chunks of a generator) timed as the stage
+        if not self.enabled:
+            return iterable
+        return self._timed_iteration(name, iter(iterable))
+
+
+    def _timed_iteration(self, name, iterator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+
+    def add_time(self, name, seconds, calls=1) -> None:
+        self._times[name] = self._times.get(name, 0.0) + seconds
+        self._calls[name] = self._calls.get(name, 0) + calls
+
+
+    def count(self, name, value=1) -> None:
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+
+    def peak(self, name, value) -> None:
+        if self.enabled:
+            self._peaks[name] = max(self._peaks.get(name, value), value)
+
+
+    def collect(self) -> dict:
+        # The raw measurements since the last reset, which are then reset
+        measurements = {"times": self._times, "calls": self._calls, "counters": self._counters, "peaks": self._peaks,
+                        "within": self._within}
+        self.reset()
+        return measurements
+
+
+    def merge(self, measurements) -> None:
+        for name, seconds in measurements["times"].items():
+            self.add_time(name, seconds, measurements["calls"][name])
+        for name, value in measurements["counters"].items():
+            self._counters[name] = self._counters.get(name, 0) + value
+        for name, value in measurements["peaks"].items():
+            self._peaks[name] = max(self._peaks.get(name, value), value)
+        self._within.update(measurements["within"])
+
+
+    def report(self) -> dict:
+        # The times of the stages are summed over the processes, so with worker processes the
+        # throughput of the stepping is per process. The wall-clock throughput is over the
+        # "total" stage, the run time of the main process, when it is added.
+        stepping, total = self._times.get("stepping", 0.0), self._times.get("total", 0.0)
+        stages = {name: {"sec": seconds, "calls": self._calls[name]} for name, seconds in self._times.items()}
+        for name, within in self._within.items():
+            if name in stages:
+                stages[name]["within"] = within
+        report = {"stages": stages,
+                  "counters": dict(self._counters), "peaks": dict(self._peaks)}
+        throughput = {}
+        for name, seconds in [("stepping_sec_per_process", stepping), ("wall_clock_sec", total)]:
+            if seconds > 0:
+                throughput[f"ticks_per_{name}"] = self._counters.get("ticks", 0)/seconds
+                throughput[f"scenarios_per_{name}"] = self._counters.get("scenarios", 0)/seconds
+        if throughput:
+            report["throughput"] = throughput
+        if resource is not None:
+            # Peak resident memory of this process and of the finished worker processes, kB on Linux
+            report["peaks"]["max_rss_kB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report["peaks"]["max_rss_children_kB"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return report
+
+
+class _Stage:
+    def __init__(self, profiler: Profiler, name) -> None:
+        self._profiler = profiler
+        self._name = name
+
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+
+    def __exit__(self, *exc_info) -> None:
+        self._profiler.add_time(self._name, time.perf_counter() - self._start)
+
+
+profiler = Profiler()
+
+
+def set_profiling(enabled) -> None:
+    profiler.enabled = enabled
+    profiler.reset()
@@ -0,0 +1,125 @@
+import numpy as np
+
+from abc import ABC, abstractmethod
+
+from utils import freq_per_unit_to_Hz
+
+
+class Reducer(ABC):
+    # Online summary of a simulation, updated with consecutive chunks of the
+    # vectors (layout of StateInputOutputVectors) and the times T of the chunk.
+    @abstractmethod
+    def update(self, T, x, w, u, y) -> None:
+        pass
+
+
+    @abstractmethod
+    def result(self) -> dict:
+        pass
+
+
+class FinalFrequencyReducer(Reducer):
+    def __init__(self, f0) -> None:
+        self._f0 = f0
+        self._final_freqs = None
+
+
+    def update(self, T, x, w, u, y) -> None:
+        self._final_freqs = [freq_per_unit_to_Hz(x[i][-1, 0], self._f0) for i in range(len(x))]
+
+
+    def result(self) -> dict:
+        return {"final_freq_Hz": self._final_freqs}
+
+
+class FrequencyExtremaReducer(Reducer):
+    # Frequency nadir (minimum) and zenith (maximum) of every area with their times
+    def __init__(self, f0) -> None:
+        self._f0 = f0
+        self._nadir = self._zenith = self._nadir_time = self._zenith_time = None
+
+
+    def update(self, T, x, w, u, y) -> None:
+        freqs = freq_per_unit_to_Hz(np.stack([x[i][:, 0] for i in range(len(x))], axis=1), self._f0)
+        argmin, argmax = freqs.argmin(axis=0), freqs.argmax(axis=0)
+        nadir, zenith = freqs[argmin, range(len(x))], freqs[argmax, range(len(x))]
+        if self._nadir is None:
+            self._nadir, self._nadir_time = nadir, T[argmin]
+            self._zenith, self._zenith_time = zenith, T[argmax]
+            return
+        lower, higher = nadir < self._nadir, zenith > self._zenith
+        self._nadir = np.where(lower, nadir, self._nadir)
+        self._nadir_time = np.where(lower, T[argmin], self._nadir_time)
+        self._zenith = np.where(higher, zenith, self._zenith)
+        self._zenith_time = np.where(higher, T[argmax], self._zenith_time)
+
+
+    def result(self) -> dict:
+        return {"nadir_Hz": self._nadir.tolist(), "nadir_time_sec": self._nadir_time.tolist(),
+                "zenith_Hz": self._zenith.tolist(), "zenith_time_sec": self._zenith_time.tolist()}
+
+
+# Safe operating frequency ranges, the same as drawn on the plots
+FREQUENCY_BANDS_HZ = [(58.8, 60.5), (57.5, 61.5), (57.0, 62.5)]
+
+
+class FrequencySecurityReducer(Reducer):
+    # Per area: maximum |RoCoF|, time spent outside every frequency band, the first time
+    # each band is violated and the settling time (after which the frequency stays
+    # within f0 +- settling_band_Hz). A sample holds until the next one, so sampled
+    # (non-uniform) time vectors are supported. Times are None when they never happen.
+    def __init__(self, f0, bands_Hz=FREQUENCY_BANDS_HZ, settling_band_Hz=0.02) -> None:
+        self._f0 = f0
+        self._bands = np.array(bands_Hz)
+        self._settling_band_Hz = settling_band_Hz
+        self._last_T = self._last_freqs = self._last_outside = None
+
+
+    def update(self, T, x, w, u, y) -> None:
+        T = np.asarray(T)
+        freqs = freq_per_unit_to_Hz(np.stack([x[i][:, 0] for i in range(len(x))], axis=1), self._f0) # time x n
+        outside = (freqs[None] < self._bands[:, 0, None, None]) | (freqs[None] > self._bands[:, 1, None, None]) # bands x time x n
+        if self._last_T is None:
+            n = freqs.shape[1]
+            self._max_abs_rocof = np.zeros(n)
+            self._time_outside = np.zeros([len(self._bands), n])
+            self._first_violation = np.full([len(self._bands), n], np.nan)
+            self._settling_time = np.zeros(n)
+            all_T, all_freqs, all_outside = T, freqs, outside
+        else:
+            all_T = np.concatenate([[self._last_T], T])
+            all_freqs = np.concatenate([self._last_freqs[None], freqs])
+            all_outside = np.concatenate([self._last_outside[:, None], outside], axis=1)
+
+        # Every sample holds until the next one, the last sample of a chunk waits for the next chunk
+        durations = np.diff(all_T)
+        self._time_outside += (all_outside[:, :-1] * durations[None, :, None]).sum(axis=1)
+        if len(all_T) > 1:
+            self._max_abs_rocof = np.maximum(self._max_abs_rocof,
+                                             np.abs(np.diff(all_freqs, axis=0) / durations[:, None]).max(axis=0))
+
+        violated = outside.any(axis=1)
+        first = T[outside.argmax(axis=1)]
+        self._first_violation = np.where(np.isnan(self._first_violation) & violated, first, self._first_violation)
+
+        unsettled = np.abs(freqs - self._f0) > self._settling_band_Hz
+        for i in range(freqs.shape[1]):
+            if unsettled[:, i].any():
+                last = np.flatnonzero(unsettled[:, i])[-1]
+                self._settling_time[i] = T[last+1] if last+1 < len(T) else np.nan
+            elif np.isnan(self._settling_time[i]):
+                self._settling_time[i] = T[0]
+
+        self._last_T, self._last_freqs, self._last_outside = T[-1], freqs[-1], outside[:, -1]
+
+
+    def result(self) -> dict:
+        labels = [f"{low}-{high}" for low, high in self._bands]
+        return {"max_abs_rocof_Hz_per_s": self._max_abs_rocof.tolist(),
+                "time_outside_sec": {label: times.tolist() for label, times in zip(labels, self._time_outside)},
+                "first_violation_time_sec": {label: self._to_list(times) for label, times in zip(labels, self._first_violation)},
+                "settling_time_sec": self._to_list(self._settling_time)}
+
+
+    def _to_list(self, values) -> list:
+        return [None if np.isnan(value) else float(value) for value in values]
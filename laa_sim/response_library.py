@@ -0,0 +1,148 @@
+import numpy as np
+import argparse
+import hashlib
+import time
+
+from pathlib import Path
+
+from fused_system import FusedSystem
+from laa_scenarios import ScenariosParser
+from system_config import SystemConfig
+from simulation import StateInputOutputVectors, build_fused_system
+from utils import freq_per_unit_to_Hz, atomic_write
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Evaluate LAA scenarios instantly from a library of precomputed step responses.")
+    parser.add_argument("-c", "--config", type=str, default="system.json", help="The path to the JSON or TOML file with the parameters of the power system.")
+    parser.add_argument("-sp", "--split", type=int, default=1, help="The split of generators into areas, numbered from 1 as in the config.")
+    parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file containing the scenarios.")
+    parser.add_argument("-s", "--scenario_names", type=str, nargs="+", default=None, help="The names of the scenarios to evaluate. By default, all scenarios in the file.")
+    parser.add_argument("-t", "--sim_time_sec", type=int, default=300, help="The end time of the simulation in seconds.")
+    parser.add_argument("-e", "--end", type=int, default=300, help="The end time of the attacks in seconds.")
+    parser.add_argument("-cd", "--cache_dir", type=str, default=".cache/responses", help="The directory of the response library.")
+    parser.add_argument("-v", "--validate", action="store_true", help="Also simulate the scenarios with the fused engine and report the error of the library.")
+    return parser.parse_args()
+
+
+class ResponseLibrary:
+    # Frequency responses of all areas (in per unit) to a unit load step in every area
+    # (areas x steps x areas) and without load (steps x areas), from the zero state.
+    # The closed loop is linear, so the response to any piecewise constant load is the free
+    # response plus shifted and scaled step responses. The library is keyed by a hash of the
+    # discrete closed-loop system and stored in cache_dir, a longer stored library serves
+    # shorter simulations.
+    def __init__(self, fused_system: FusedSystem, steps, time_step_sec, cache_dir=None) -> None:
+        self.steps = steps
+        self.time_step_sec = time_step_sec
+        self.cache_dir = cache_dir
+        self.loaded_from_cache = False
+        self._freq_indices = [xi.start for xi in fused_system.x_slices]
+        self._key = self._get_key(fused_system)
+        if not self._load():
+            self.responses = fused_system.step_responses(steps, self._freq_indices)
+            self.free_response = fused_system.free_response(steps, self._freq_indices)
+            self._save()
+
+
+    def deviation(self, areas_attacks) -> np.ndarray:
+        # Frequency deviation in per unit (steps x areas) of a scenario parsed by ScenariosParser
+        return self.deviations([areas_attacks])[0]
+
+
+    def deviations(self, scenarios_attacks) -> np.ndarray:
+        # Frequency deviations in per unit (scenarios x steps x areas). The load edges of all
+        # scenarios are grouped by time step, every group is one shift-and-add of the responses.
+        n = self.responses.shape[0]
+        edges = {}
+        for s, areas_attacks in enumerate(scenarios_attacks):
+            for i, attacks in enumerate(areas_attacks):
+                for attack in attacks:
+                    if attack.get("shape", "step") != "step":
+                        raise ValueError(f"The response library superposes step responses, the attack of {attack['shape']} shape is not supported.")
+                    for edge, sign in [(attack["start"], 1), (attack["end"], -1)]:
+                        tick = int(edge / self.time_step_sec)
+                        if tick < self.steps:
+                            edges.setdefault(tick, np.zeros([len(scenarios_attacks), n]))[s, i] += sign*attack["strength"]
+
+        deviations = np.repeat(self.free_response[None], len(scenarios_attacks), axis=0)
+        for tick, strengths in edges.items():
+            deviations[:, tick:] += np.einsum("sa,ato->sto", strengths, self.responses[:, :self.steps-tick])
+        return deviations
+
+
+    def validate(self, fused_system: FusedSystem, n, m, scenarios_attacks) -> list[float]:
+        # Maximum absolute error (per unit) of the library against the fused simulation of every scenario
+        T = np.arange(self.steps)*self.time_step_sec
+        errors = []
+        for areas_attacks, deviation in zip(scenarios_attacks, self.deviations(scenarios_attacks)):
+            vectors = StateInputOutputVectors(n, m, T, self.time_step_sec, None, areas_attacks)
+            fused_system.simulate(vectors.get_x(), vectors.get_w(), vectors.get_u(), vectors.get_y(), np.arange(self.steps))
+            simulated = np.stack([x[:, 0] for x in vectors.get_x()], axis=1)
+            errors.append(float(np.abs(deviation - simulated).max()))
+        return errors
+
+
+    def _get_key(self, fused_system) -> str:
+        digest = hashlib.sha256()
+        for matrix in (fused_system.M, fused_system.L, fused_system.offset, np.array(self._freq_indices)):
+            matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+            digest.update(str(matrix.shape).encode())
+            digest.update(matrix.tobytes())
+        digest.update(np.float64(self.time_step_sec).tobytes())
+        return digest.hexdigest()
+
+
+    def _load(self) -> bool:
+        if self.cache_dir is None:
+            return False
+        path = Path(self.cache_dir, f"{self._key}.npz")
+        if not path.exists():
+            return False
+        with np.load(path) as cached:
+            if cached["free_response"].shape[0] < self.steps:
+                return False
+            self.responses = cached["responses"][:, :self.steps]
+            self.free_response = cached["free_response"][:self.steps]
+        self.loaded_from_cache = True
+        return True
+
+
+    def _save(self) -> None:
+        if self.cache_dir is None:
+            return
+        with atomic_write(Path(self.cache_dir, f"{self._key}.npz")) as f:
+            np.savez(f, responses=self.responses, free_response=self.free_response)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = SystemConfig.load(args.config)
+    gen_params = config.split(args.split)
+    time_step_sec = config.time_step_sec
+    fused_system = build_fused_system(gen_params, config.K, config.setpoint, time_step_sec)
+
+    steps = int(args.sim_time_sec/time_step_sec)
+    start = time.perf_counter()
+    library = ResponseLibrary(fused_system, steps, time_step_sec, args.cache_dir)
+    source = "loaded" if library.loaded_from_cache else "computed"
+    print(f"Response library {source} in {round(time.perf_counter() - start, 3)} s")
+
+    parser = ScenariosParser(args.file_path, args.end)
+    names = args.scenario_names or parser.get_scenario_names()
+    scenarios_attacks = [parser.get_scenario_attacks(name) for name in names]
+    start = time.perf_counter()
+    freqs = freq_per_unit_to_Hz(library.deviations(scenarios_attacks), gen_params.f0)
+    print(f"Evaluated {len(names)} scenarios in {round((time.perf_counter() - start)*1000, 2)} ms")
+
+    for name, scenario_freqs in zip(names, freqs):
+        print(name)
+        for i in range(gen_params.n):
+            print(f"    Area {i+1}: nadir {round(scenario_freqs[:, i].min(), 4)} Hz, zenith {round(scenario_freqs[:, i].max(), 4)} Hz, "
+                  f"final {round(scenario_freqs[-1, i], 4)} Hz")
+
+    if args.validate:
+        errors = library.validate(fused_system, gen_params.n, gen_params.m, scenarios_attacks)
+        for name, error in zip(names, errors):
+            print(f"{name}: library error {error*gen_params.f0:.3e} Hz")
@@ -0,0 +1,175 @@
+import numpy as np
+import json
+
+from pathlib import Path
+
+
+RESULTS_FORMATS = ["npy", "npz", "csv"]
+
+
+class ResultsWriter:
+    # Every trajectory of a scenario is stored as a separate series:
+    # T, x_area1 ... x_arean (time x 2+2*m_i), w (time x n x 2), u and y (time x n x 1).
+    # npy - a directory of .npy files per scenario, which can be memory-mapped
+    # npz - one compressed .npz archive per scenario
+    # csv - only the frequencies of the areas as text (the original output)
+    def __init__(self, results_path="results", results_format="npy") -> None:
+        if results_format not in RESULTS_FORMATS:
+            raise ValueError(f"Unknown results format {results_format}, expected one of {RESULTS_FORMATS}.")
+        self._results_path = results_path
+        self._results_format = results_format
+
+
+    def write(self, name, T, x, w, u, y, metadata=None) -> str:
+        if self._results_format == "csv":
+            return self._write_csv(name, x)
+
+        series = {"T": np.asarray(T, dtype=np.float64), "w": w, "u": u, "y": y}
+        for i in range(len(x)):
+            series[f"x_area{i+1}"] = x[i]
+        meta = {"n": len(x), "series": list(series.keys())}
+        meta.update(metadata or {})
+
+        if self._results_format == "npz":
+            return self._write_npz(name, series, meta)
+        return self._write_npy(name, series, meta)
+
+
+    def _write_npy(self, name, series, meta) -> str:
+        path = Path(self._results_path, "npy", name)
+        path.mkdir(parents=True, exist_ok=True)
+        for key, values in series.items():
+            np.save(path / f"{key}.npy", values)
+        (path / "meta.json").write_text(json.dumps(meta))
+        return str(path)
+
+
+    def _write_npz(self, name, series, meta) -> str:
+        path = Path(self._results_path, "npz")
+        path.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path / f"{name}.npz", meta=json.dumps(meta), **series)
+        return str(path / f"{name}.npz")
+
+
+    def _write_csv(self, name, x) -> str:
+        path = Path(self._results_path, "csv")
+        path.mkdir(parents=True, exist_ok=True)
+        freqs = np.array([x[i][:, 0] for i in range(len(x))]).T
+        np.savetxt(path / f"{name}.csv", freqs, delimiter=",")
+        return str(path / f"{name}.csv")
+
+
+class StreamingResultsWriter:
+    # Writes the results of one scenario chunk by chunk, in the same layout as ResultsWriter,
+    # so memory does not depend on the length of the simulation.
+    # npy - the headers are written upfront with the final shapes, then the rows of every chunk
+    # csv - the frequencies of the areas are appended as text
+    # With offsets (see offsets) the files of an interrupted run are truncated to them and continued.
+    def __init__(self, name, steps, m, results_path="results", results_format="npy", metadata=None,
+                 offsets=None) -> None:
+        if results_format not in ["npy", "csv"]:
+            raise ValueError(f"Results format {results_format} cannot be streamed, expected npy or csv.")
+        self._results_format = results_format
+        n = len(m)
+        shapes = {"T": (steps,), "w": (steps, n, 2), "u": (steps, n, 1), "y": (steps, n, 1)}
+        for i in range(n):
+            shapes[f"x_area{i+1}"] = (steps, 2+2*m[i])
+        self._meta = {"n": n, "series": list(shapes.keys())}
+        self._meta.update(metadata or {})
+
+        if results_format == "csv":
+            self._path = Path(results_path, "csv")
+            self._path.mkdir(parents=True, exist_ok=True)
+            self._files = {"freqs": open(self._path / f"{name}.csv", "w" if offsets is None else "r+")}
+        else:
+            self._path = Path(results_path, "npy", name)
+            self._path.mkdir(parents=True, exist_ok=True)
+            self._files = {}
+            for key, shape in shapes.items():
+                if offsets is not None:
+                    self._files[key] = open(self._path / f"{key}.npy", "r+b")
+                    continue
+                self._files[key] = open(self._path / f"{key}.npy", "wb")
+                np.lib.format.write_array_header_2_0(self._files[key], {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                    "fortran_order": False, "shape": shape})
+        for key, offset in (offsets or {}).items():
+            self._files[key].truncate(offset)
+            self._files[key].seek(offset)
+
+
+    def write(self, T, x, w, u, y) -> None:
+        if self._results_format == "csv":
+            np.savetxt(self._files["freqs"], np.array([x[i][:, 0] for i in range(len(x))]).T, delimiter=",")
+            return
+        series = {"T": T, "w": w, "u": u, "y": y}
+        for i in range(len(x)):
+            series[f"x_area{i+1}"] = x[i]
+        for key, values in series.items():
+            self._files[key].write(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+
+
+    def offsets(self) -> dict:
+        # Positions of all files after the rows written so far, flushed to disk
+        for f in self._files.values():
+            f.flush()
+        return {key: f.tell() for key, f in self._files.items()}
+
+
+    def close(self) -> str:
+        for f in self._files.values():
+            f.close()
+        if self._results_format == "npy":
+            (self._path / "meta.json").write_text(json.dumps(self._meta))
+        return str(self._path)
+
+
+class ResultsReader:
+    # Opens the results of one scenario written by ResultsWriter (a npy directory or a npz file).
+    # Series are loaded lazily on first access, npy series are memory-mapped.
+    def __init__(self, path) -> None:
+        self._path = Path(path)
+        self._series = {}
+        if self._path.is_dir():
+            self._npz = None
+            self.meta = json.loads((self._path / "meta.json").read_text())
+        else:
+            self._npz = np.load(self._path)
+            self.meta = json.loads(str(self._npz["meta"]))
+
+
+    @classmethod
+    def open(cls, name, results_path="results", results_format="npy") -> "ResultsReader":
+        if results_format == "npz":
+            return cls(Path(results_path, "npz", f"{name}.npz"))
+        return cls(Path(results_path, "npy", name))
+
+
+    def names(self) -> list[str]:
+        return self.meta["series"]
+
+
+    def __getitem__(self, key) -> np.ndarray:
+        if key not in self.meta["series"]:
+            raise KeyError(key)
+        if key not in self._series:
+            if self._npz is None:
+                self._series[key] = np.load(self._path / f"{key}.npy", mmap_mode="r")
+            else:
+                self._series[key] = self._npz[key]
+        return self._series[key]
+
+
+    def x(self, area) -> np.ndarray:
+        return self[f"x_area{area}"]
+
+
+    def frequencies(self) -> np.ndarray:
+        # Frequency deviation in per unit, time x n
+        return np.stack([self.x(i+1)[:, 0] for i in range(self.meta["n"])], axis=1)
+
+
+    def close(self) -> None:
+        self._series = {}
+        if self._npz is not None:
+            self._npz.close()
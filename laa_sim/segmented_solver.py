@@ -0,0 +1,64 @@
+import numpy as np
+
+from fused_system import FusedSystem
+from load_profiles import LoadProfile
+
+
+class SegmentedSolver:
+    # Between the breakpoints of a piecewise-constant load the fused system is
+    # z[t] = M @ z[t-1] + d, so a segment of L steps is propagated at once:
+    # z[t+L] = M^L @ z[t] + (I + M + ... + M^(L-1)) @ d.
+    # Propagators are computed by binary powering and cached by L, so the cost
+    # depends on the number of breakpoints and samples, not on the horizon length.
+    def __init__(self, fused_system: FusedSystem) -> None:
+        self._system = fused_system
+        self._propagators = {}
+
+
+    def _propagator(self, steps) -> tuple[np.ndarray, np.ndarray]:
+        if steps not in self._propagators:
+            size = self._system.size
+            augmented = np.block([[self._system.M, np.eye(size)],
+                                  [np.zeros([size, size]), np.eye(size)]])
+            power = np.linalg.matrix_power(augmented, steps)
+            self._propagators[steps] = (power[:size, :size], power[:size, size:])
+        return self._propagators[steps]
+
+
+    def solve(self, z0, breakpoints, loads, sample_indices) -> np.ndarray:
+        # Augmented states at the requested time step indices, z0 is the state at index 0
+        sample_indices = np.asarray(sample_indices)
+        samples = np.empty([len(sample_indices), self._system.size])
+        samples[sample_indices == 0] = z0
+
+        z = z0
+        tick = 0
+        for event in np.union1d(breakpoints, sample_indices):
+            if event <= tick:
+                continue
+            segment = np.searchsorted(breakpoints, tick, side="right") - 1
+            drive = self._system.L @ loads[segment] + self._system.offset
+            power, total = self._propagator(int(event - tick))
+            z = power @ z + total @ drive
+            tick = event
+            samples[sample_indices == tick] = z
+        return samples
+
+
+    def simulate(self, x, w, u, y, indices, areas_attacks, time_step_sec) -> None:
+        # Fills the vectors only at the time step indices, the first one must be 0 (initial conditions)
+        # and the last one the last time step of the simulation
+        profile = LoadProfile.from_attacks(areas_attacks, time_step_sec)
+        if not profile.is_piecewise_constant:
+            raise ValueError("The segmented engine requires piecewise-constant (step) attacks.")
+        z = self.solve(self._system.initial_state(x, u), profile.breakpoints, profile.loads, indices)
+
+        # The last index is the last time step, as in the stepping loop its ACE and tie-lines are not computed
+        system = self._system
+        freqs = z[:-1, [xi.start for xi in system.x_slices]]
+        for i, xi in enumerate(system.x_slices):
+            x[i][:] = z[:, xi]
+            y[:-1, i, 0] = x[i][:-1] @ system.Cd[i]
+        w[:, :, 0] = profile.evaluate(indices)
+        w[:-1, :, 1] = freqs @ system.Tij.T
+        u[:, :, 0] = z[:, system.u_indices]
@@ -1,24 +1,57 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import json
+import time
 
 from pathlib import Path
 
 from utils import freq_per_unit_to_Hz
 from matrices import MatrixA, MatrixB1, MatrixB2, MatrixC
-from controller import PIDController
+from controller import PIDControllerBank
 from area import Area
+from fused_system import FusedSystem
+from segmented_solver import SegmentedSolver
+from load_profiles import LoadProfile
+from checkpoint import Checkpoint, PrefixCache
+from results_store import ResultsWriter, StreamingResultsWriter
+from reducers import FinalFrequencyReducer, FrequencyExtremaReducer, FrequencySecurityReducer
+from profiling import profiler
+
+
+def build_areas(n, m, D, H, Tt, Tg, R, alpha, beta, Tij, time_step_sec) -> list[Area]:
+    areas = []
+    for i in range(n):
+        with profiler.stage("matrices"):
+            matrixA = MatrixA(m[i], D[i], H[i], Tt[i], Tg[i], R[i], Tij[i]).get_A()
+            matrixB1 = MatrixB1(m[i], H[i]).get_B1()
+            matrixB2 = MatrixB2(m[i], Tg[i], alpha[i]).get_B2()
+            matrixC = MatrixC(m[i], beta[i]).get_C()
+        areas.append(Area(i+1, m[i], matrixA, matrixB1, matrixB2, matrixC, time_step_sec))
+    return areas
+
+
+def build_fused_system(gen_params, K, setpoint, time_step_sec) -> FusedSystem:
+    areas = build_areas(gen_params.n, gen_params.m, gen_params.D, gen_params.H, gen_params.Tt, gen_params.Tg,
+                        gen_params.R, gen_params.alpha, gen_params.beta, gen_params.Tij, time_step_sec)
+    return FusedSystem(areas, gen_params.Tij, K, setpoint, time_step_sec)
 
 
 class StateInputOutputVectors:
-    def __init__(self, n, m, T, time_step_sec, initial_loads_pu, attack_scenario):
+    # The load change is the LoadProfile of the attack scenario (a list of attacks per area or a
+    # LoadProfile) evaluated at the time steps, added to initial_loads_pu (n x len(T)) if given.
+    def __init__(self, n, m, T, time_step_sec, initial_loads_pu, attack_scenario, indices=None):
         self._n = n
         self._m = m
         self._T = T
+        self._indices = np.arange(len(T)) if indices is None else np.asarray(indices) # time step index of each entry of T
         self._time_step_sec = time_step_sec
         self._initial_loads_pu = initial_loads_pu
         self._scenario = attack_scenario
-        self._set_vectors()
+        with profiler.stage("vectors"):
+            self._set_vectors()
+        if profiler.enabled:
+            nbytes = sum(vector.nbytes for vector in (*self._x, self._w, self._u, self._y))
+            profiler.peak("vectors_bytes", nbytes)
+            profiler.count("vectors_bytes_total", nbytes)
 
 
     def get_x(self):
@@ -47,7 +80,7 @@ class StateInputOutputVectors:
             self._x[i][0, :] = x0[i]
 
         # Adding load changes    
-        self._add_load_change(i)
+        self._add_load_change()
 
 
     def _define_state_input_output_vectors(self):
@@ -57,18 +90,18 @@ class StateInputOutputVectors:
         self._y = np.zeros(shape=(len(self._T), self._n, 1)) # Area Control Error (ACE)
 
 
-    def _add_load_change(self, i):            
-        altered_load = self._initial_loads_pu.copy()
-        for i in range(self._n):
-            for j in range(len(self._scenario[i])):
-                start_index = int(self._scenario[i][j]["start"] / self._time_step_sec)
-                end_index = int(self._scenario[i][j]["end"] / self._time_step_sec)
-                altered_load[i][start_index:end_index] = self._scenario[i][j]["strength"]
-        self._w[:, :, 0] = altered_load.T
+    def _add_load_change(self):
+        profile = self._scenario
+        if not isinstance(profile, LoadProfile):
+            profile = LoadProfile.from_attacks(self._scenario[:self._n], self._time_step_sec)
+        self._w[:, :, 0] = profile.evaluate(self._indices)
+        if self._initial_loads_pu is not None:
+            self._w[:, :, 0] += np.asarray(self._initial_loads_pu).T
 
 
 class Simulation:
-    def __init__(self, f0, base_MV, n, m, D, H, Tt, Tg, R, alpha, beta, Tij, K, setpoint, time_step_sec, T, indices, x, w, u, y):
+    def __init__(self, f0, base_MV, n, m, D, H, Tt, Tg, R, alpha, beta, Tij, K, setpoint, time_step_sec, T, indices, x, w, u, y, engine="fused",
+                 results_format="npy", backend="numpy"):
         self._f0 = f0
         self._base_MV = base_MV
         self._n = n
@@ -90,36 +123,152 @@ class Simulation:
         self._w = w
         self._u = u
         self._y = y
+        self._engine = engine
+        self._backend = backend
+        self._results_format = results_format
+        self._results_path = "results"
         self._csv_path = "results/csv"
         
     
     def run_and_plot_results(self, print_continuous_matrices, print_discrete_matrices,
                                    plot_all, scenario):        
+        self.run(scenario)
+        self.print_matrices(print_continuous_matrices, print_discrete_matrices)
+        self.plot_and_print_results(plot_all)
+
+
+    def run(self, scenario):
         self._scenario = scenario
-            
-        # Getting areas
-        self._Areas: list[Area] = []
-        for i in range(self._n):
-            matrixA = MatrixA(self._m[i], self._D[i], self._H[i], self._Tt[i], self._Tg[i], self._R[i], self._Tij[i]).get_A()
-            matrixB1 = MatrixB1(self._m[i], self._H[i]).get_B1()
-            matrixB2 = MatrixB2(self._m[i], self._Tg[i], self._alpha[i]).get_B2()
-            matrixC = MatrixC(self._m[i], self._beta[i]).get_C()
-            controller = PIDController(self._K[i], self._setpoint, self._time_step_sec)
-            
-            self._Areas.append(Area(i+1, self._m[i], matrixA, matrixB1, matrixB2, matrixC, controller, self._time_step_sec))
+        self._set_areas()
+        with profiler.stage("stepping"):
+            self._simulate_LFC_power_system()
+        profiler.count("ticks", int(self._indices[-1]) + 1)
+        profiler.count("scenarios")
+        self._save_data_to_file()
+        self._reduce_results()
+
+
+    def get_summary(self) -> dict:
+        summary = {"name": self._scenario["name"], "description": self._scenario["description"]}
+        for reducer in self._reducers:
+            summary.update(reducer.result())
+        return summary
+
+
+    def release_trajectories(self, plot=False, plot_all=False) -> None:
+        # Keeps only what the results are printed and plotted from (the summary, and the
+        # frequencies or with plot_all all outputs when plotted), so a simulation run in a
+        # worker process is sent back to the main process without its whole trajectories.
+        # The trajectories are already stored in the results files.
+        if self._x is None:
+            return
+        self._indices = None
+        if not plot:
+            self._T = self._x = self._w = self._u = self._y = None
+        else:
+            self._x = [x[:, :1].copy() for x in self._x]
+            if not plot_all:
+                self._w = self._u = self._y = None
+
+
+    def print_matrices(self, print_continuous_matrices, print_discrete_matrices):
+        for area in self._Areas:
             if (print_continuous_matrices):
-                self._Areas[i].print_continuous_matrices()
+                area.print_continuous_matrices()
             if (print_discrete_matrices):
-                self._Areas[i].print_discrete_matrices()
+                area.print_discrete_matrices()
+
+
+    def plot_and_print_results(self, plot_all, renderer=None):
+        with profiler.stage("plotting"):
+            self._plot_LFC_power_system_results(plot_all, renderer)
+        self.print_results()
+
+
+    def print_results(self):
+        self._print_final_frequencies(self.get_summary()["final_freq_Hz"])
+        self._save_metrics_to_file()
+
+
+    def _default_reducers(self):
+        return [FinalFrequencyReducer(self._f0), FrequencyExtremaReducer(self._f0), FrequencySecurityReducer(self._f0)]
+
+
+    def _reduce_results(self):
+        self._reducers = self._default_reducers()
+        with profiler.stage("metrics"):
+            for reducer in self._reducers:
+                reducer.update(np.asarray(self._T), self._x, self._w, self._u, self._y)
+
+
+    def _save_metrics_to_file(self):
+        # One JSON record per scenario, for ranking scenarios without replotting
+        with profiler.stage("io"), open(f"{self._results_path}/metrics.jsonl", "a+") as f:
+            f.write(json.dumps(self.get_summary()) + "\n")
+
+
+    def _set_areas(self):
+        self._Areas = build_areas(self._n, self._m, self._D, self._H, self._Tt, self._Tg, self._R,
+                                  self._alpha, self._beta, self._Tij, self._time_step_sec)
+
+
+    def _simulate_LFC_power_system(self):
+        if self._engine == "fused":
+            self._get_fused_system_class()(self._Areas, self._Tij, self._K, self._setpoint, self._time_step_sec).simulate(
+                self._x, self._w, self._u, self._y, self._indices)
+        elif self._engine == "sparse":
+            from sparse_system import SparseSystem # scipy.sparse is imported only for the sparse engine
+            SparseSystem(self._Areas, self._Tij, self._K, self._setpoint, self._time_step_sec).simulate(
+                self._x, self._w, self._u, self._y, self._indices)
+        elif self._engine == "segmented":
+            SegmentedSolver(FusedSystem(self._Areas, self._Tij, self._K, self._setpoint, self._time_step_sec)).simulate(
+                self._x, self._w, self._u, self._y, self._indices, self._scenario["areas_attacks"], self._time_step_sec)
+        else:
+            self._simulate_LFC_power_system_loop()
+
+
+    def _get_fused_system_class(self):
+        if self._backend == "numba":
+            from compiled_system import CompiledSystem # Numba is imported only for its backend
+            return CompiledSystem
+        return FusedSystem
+
+
+    def compare_engines(self, scenario) -> dict:
+        # Parity of the fused engine (NumPy and Numba backends) with the per-area reference loop
+        # and the speedup over it. The Numba kernel is compiled before it is timed. The engine and
+        # backend of the simulation are restored afterwards, the vectors hold the last results.
+        self._scenario = scenario
+        self._set_areas()
+        initial = [np.copy(vector) for vector in (*self._x, self._w, self._u, self._y)]
+        report = {"name": scenario["name"]}
+        reference = None
+        engine_and_backend = self._engine, self._backend
+        try:
+            for engine, backend in [("loop", "numpy"), ("fused", "numpy"), ("fused", "numba"), ("fused", "numba")]:
+                self._engine, self._backend = engine, backend
+                for vector, values in zip((*self._x, self._w, self._u, self._y), initial):
+                    vector[:] = values
+                start = time.perf_counter()
+                self._simulate_LFC_power_system()
+                elapsed = time.perf_counter() - start
                 
-        # Running simulation, plotting and printing results
-        self._simulate_LFC_power_system() 
-        self._save_data_to_file()
-        self._plot_LFC_power_system_results(plot_all)
-        self._print_final_frequencies()
+                results = [np.copy(vector) for vector in (*self._x, self._w, self._u, self._y)]
+                if reference is None:
+                    reference, reference_time = results, elapsed
+                name = f"{engine}_{backend}"
+                if name in report:
+                    report[f"{name}_compile_sec"] = report[name]["time_sec"] - elapsed
+                report[name] = {"time_sec": elapsed, "speedup": reference_time/elapsed,
+                                "max_abs_diff": max(float(np.max(np.abs(a - b))) for a, b in zip(results, reference))}
+        finally:
+            self._engine, self._backend = engine_and_backend
+        return report
 
 
-    def _simulate_LFC_power_system(self):    
+    def _simulate_LFC_power_system_loop(self):
+        controllers = PIDControllerBank(self._K, self._setpoint, self._time_step_sec)
+        update = profiler.wrap("controller", controllers.update, within="stepping")
         for t in self._indices[1:]:
             for i in range(self._n):
                 self._w[t-1, i, 1] = np.sum([self._Tij[i][j]*self._x[j][t-1, 0] for j in range(self._n)]) # v_i calculation
@@ -127,87 +276,188 @@ class Simulation:
                 # Additional entries in Tij for inputs from real areas
                 self._x[i][t] = self._Areas[i].Ad @ self._x[i][t-1] + self._Areas[i].B1d @ self._w[t-1, i] + self._Areas[i].B2d @ self._u[t-1, i]
                 self._y[t-1, i] = self._Areas[i].Cd @ self._x[i][t-1]
-                self._u[t, i] = self._Areas[i].controller.update(self._y[t-1, i], self._u[t-1, i]) # Delta P_Ci calculation 
+            self._u[t, :, 0] = update(self._y[t-1, :, 0], self._u[t-1, :, 0]) # Delta P_Ci calculation 
 
 
     def _save_data_to_file(self):
-        x = np.array([self._x[i][:, 0] for i in range(self._n)]).T
         Path(self._csv_path).mkdir(parents=True, exist_ok=True)
-        np.savetxt(f"{self._csv_path}/{self._scenario["name"]}.csv", x, delimiter=",")
+        metadata = {"description": self._scenario["description"], "f0": self._f0,
+                    "time_step_sec": self._time_step_sec, "m": [int(m) for m in self._m]}
+        with profiler.stage("io"):
+            ResultsWriter(self._results_path, self._results_format).write(self._scenario["name"], self._T,
+                                                                          self._x, self._w, self._u, self._y, metadata)
          
 
-    def _plot_LFC_power_system_results(self, plot_all=False):
-        sns.set_theme(style="whitegrid")
-        sns.set_context("paper", font_scale=1.5)
-        sns.set_palette("deep")
-        sns.set_style("whitegrid", {"axes.grid": True, "grid.color": ".9", "grid.linestyle": "--"})
-        
-        legend = []
-        types = ['solid', 'dashed', 'dashdot', 'dotted']
-        plt.figure()
-        for i in range(self._n):
-            legend.append(f"Area{i+1}")
-            if (plot_all):
-                plt.subplot(5, 1, 1)
-            plt.title(self._scenario["description"])
-            sns.lineplot(x=self._T, y=freq_per_unit_to_Hz(self._x[i][:, 0], self._f0), linestyle=types[i])
-            plt.xlim(self._T[0], self._T[-1])
-            plt.ylabel("Freq [Hz]")
-            
-            if (plot_all):
-                plt.xticks([])
-                
-                plt.subplot(5, 1, 2)
-                sns.lineplot(x=self._T[1:], y=np.diff(freq_per_unit_to_Hz(self._x[i][:, 0], self._f0))/self._time_step_sec, linestyle=types[i])
-                plt.xlim(self._T[0], self._T[-1])
-                plt.ylabel("RoCoF")
-                plt.xticks([])
-                
-                plt.subplot(5, 1, 3)
-                sns.lineplot(x=self._T, y=self._w[:, i, 1], linestyle=types[i])
-                plt.xlim(self._T[0], self._T[-1])
-                plt.ylabel("Tie-lines")
-                plt.xticks([])
-                
-                plt.subplot(5, 1, 4)
-                sns.lineplot(x=self._T, y=self._y[:, i, 0], linestyle=types[i])
-                plt.xlim(self._T[0], self._T[-1])
-                plt.ylabel("ACE")
-                plt.xticks([])
-                
-                plt.subplot(5, 1, 5)
-                sns.lineplot(x=self._T, y=self._u[:, i, 0], linestyle=types[i])
-                plt.xlim(self._T[0], self._T[-1])
-                plt.ylabel("LFC output")
-        plt.xlabel("Time [s]")
+    def _plot_LFC_power_system_results(self, plot_all=False, renderer=None):
+        T = np.asarray(self._T)
+        freqs = [freq_per_unit_to_Hz(self._x[i][:, 0], self._f0) for i in range(self._n)]
+        rocofs = tie_lines = aces = lfc_outputs = None
         if (plot_all):
-            plt.subplot(5, 1, 1)
-            
-        # Nominal frequency
-        plt.axhline(y=self._f0, color='r', linestyle=types[0], linewidth=0.5)
-        # Safe operating frequency ranges
-        plt.axhline(y=58.8, color='b', linestyle=types[1], linewidth=0.5)
-        plt.axhline(y=60.5, color='b', linestyle=types[1], linewidth=0.5)
-        plt.axhline(y=57.5, color='g', linestyle=types[2], linewidth=0.5)
-        plt.axhline(y=61.5, color='g', linestyle=types[2], linewidth=0.5)
-        plt.axhline(y=57.0, color='r', linestyle=types[3], linewidth=0.5)
-        plt.axhline(y=62.5, color='r', linestyle=types[3], linewidth=0.5)
-        plt.legend(legend, loc="upper right")
-        #plt.tight_layout()
-        plt.show()
-        
-        # get eigenvalues of matrixA from all areas and save them to a file
-        with open(f"{self._csv_path}/eigenvalues.csv", "a+") as f:
-            f.write(f"{self._scenario["name"]},{','.join([str(eig) for eig in np.linalg.eigvals(self._Areas[0].Ad)])}\n")
-        
-        
-    def _print_final_frequencies(self):
-        final_freqs = []
+            rocofs = [np.diff(freq)/np.diff(T) for freq in freqs]
+            tie_lines = [self._w[:, i, 1] for i in range(self._n)]
+            aces = [self._y[:, i, 0] for i in range(self._n)]
+            lfc_outputs = [self._u[:, i, 0] for i in range(self._n)]
+        
+        if renderer is not None:
+            renderer.submit(self._scenario["name"], self._scenario["description"], T, freqs, rocofs,
+                            tie_lines, aces, lfc_outputs, self._f0, plot_all)
+        else:
+            # Plotting libraries are imported only when the results are plotted
+            import matplotlib.pyplot as plt
+            from plotting import set_plot_theme, draw_LFC_results
+            set_plot_theme()
+            draw_LFC_results(plt.figure(), self._scenario["description"], T, freqs, rocofs,
+                             tie_lines, aces, lfc_outputs, self._f0, plot_all)
+            #plt.tight_layout()
+            plt.show()
+        
+        
+    def _print_final_frequencies(self, final_freqs):
         final_freqs_str = ""
         print(f"Final frequencies for each area in {self._scenario["description"]}:")
-        with open(f"{self._csv_path}/final_freqs.csv", "a+") as f:
+        with profiler.stage("io"), open(f"{self._csv_path}/final_freqs.csv", "a+") as f:
             for i in range(self._n):
-                final_freqs.append(freq_per_unit_to_Hz(self._x[i][-1, 0], self._f0))
                 final_freqs_str += f"Area {i+1}: {round(final_freqs[i], 4)} Hz | "
             print(final_freqs_str[0:-3])
-            f.write(f"{self._scenario["name"]},{','.join([str(freq) for freq in final_freqs])}\n")
\ No newline at end of file
+            f.write(f"{self._scenario["name"]},{','.join([str(freq) for freq in final_freqs])}\n")
+
+
+class BatchSimulation:
+    # Scenarios that share the system and differ only in the load change are
+    # advanced together by the fused engine in one stacked product per step. It is a
+    # matrix-vector product per scenario rather than one matrix-matrix product, which
+    # is about twice as slow but gives every scenario the same bits as a run on its own.
+    # With reuse_prefixes they are instead simulated one by one through a PrefixCache,
+    # so the ticks up to the point where the loads of scenarios diverge are simulated once.
+    def __init__(self, simulations: list[Simulation], reuse_prefixes=False):
+        self._simulations = simulations
+        self._reuse_prefixes = reuse_prefixes
+        self.reused_steps = 0
+        
+        
+    def run_and_plot_results(self, print_continuous_matrices, print_discrete_matrices,
+                                   plot_all, scenarios):
+        self.run(scenarios)
+        for simulation in self._simulations:
+            simulation.print_matrices(print_continuous_matrices, print_discrete_matrices)
+            simulation.plot_and_print_results(plot_all)
+            
+            
+    def run(self, scenarios):
+        first = self._simulations[0]
+        first._set_areas()
+        for simulation, scenario in zip(self._simulations, scenarios):
+            simulation._scenario = scenario
+            simulation._Areas = first._Areas
+        
+        with profiler.stage("stepping"):
+            if self._reuse_prefixes:
+                cache = PrefixCache(FusedSystem(first._Areas, first._Tij, first._K, first._setpoint, first._time_step_sec))
+                for simulation in self._simulations:
+                    cache.simulate(simulation._x, simulation._w, simulation._u, simulation._y, first._indices)
+                self.reused_steps = cache.reused_steps
+            else:
+                first._get_fused_system_class()(first._Areas, first._Tij, first._K, first._setpoint, first._time_step_sec).simulate_batch(
+                    [simulation._x for simulation in self._simulations], [simulation._w for simulation in self._simulations],
+                    [simulation._u for simulation in self._simulations], [simulation._y for simulation in self._simulations],
+                    first._indices)
+        profiler.count("ticks", (int(first._indices[-1]) + 1)*len(self._simulations))
+        profiler.count("scenarios", len(self._simulations))
+        
+        for simulation in self._simulations:
+            simulation._save_data_to_file()
+            simulation._reduce_results()
+
+
+
+class StreamingSimulation(Simulation):
+    # Steps the fused (or sparse) system in chunks of chunk_steps time steps, which are written through
+    # to disk and to online reducers, so memory does not depend on the length of the simulation.
+    # With checkpoint_dir, a Checkpoint of the state, the reducers and the positions in the results
+    # files is saved every checkpoint_chunks chunks, and an interrupted run continues from it.
+    def __init__(self, f0, base_MV, n, m, D, H, Tt, Tg, R, alpha, beta, Tij, K, setpoint, time_step_sec, steps,
+                 chunk_steps, results_format="npy", checkpoint_dir=None, checkpoint_chunks=1, engine="fused"):
+        super().__init__(f0, base_MV, n, m, D, H, Tt, Tg, R, alpha, beta, Tij, K, setpoint, time_step_sec,
+                         None, None, None, None, None, None, engine, results_format)
+        self._steps = steps
+        self._chunk_steps = chunk_steps
+        self._checkpoint_dir = checkpoint_dir
+        self._checkpoint_chunks = checkpoint_chunks
+        
+        
+    def run(self, scenario, reducers=None):
+        self._scenario = scenario
+        self._reducers = self._default_reducers() + list(reducers or [])
+        self._set_areas()
+        
+        if self._engine == "sparse":
+            from sparse_system import SparseSystem # scipy.sparse is imported only for the sparse engine
+            system = SparseSystem(self._Areas, self._Tij, self._K, self._setpoint, self._time_step_sec)
+        else:
+            system = FusedSystem(self._Areas, self._Tij, self._K, self._setpoint, self._time_step_sec)
+        x0 = [np.zeros(shape=(1, 2+2*self._m[i])) for i in range(self._n)]
+        z0 = system.initial_state(x0, np.zeros(shape=(1, self._n, 1)))
+        profile = LoadProfile.from_attacks(scenario["areas_attacks"][:self._n], self._time_step_sec)
+        
+        checkpoint = self._load_checkpoint(scenario["name"], system)
+        start, offsets = 0, None
+        if checkpoint is not None:
+            z0, start = checkpoint.to_state(system), checkpoint.tick + 1
+            self._reducers, offsets = checkpoint.extra["reducers"], checkpoint.extra["offsets"]
+        
+        Path(self._csv_path).mkdir(parents=True, exist_ok=True)
+        metadata = {"description": scenario["description"], "f0": self._f0,
+                    "time_step_sec": self._time_step_sec, "m": [int(m) for m in self._m]}
+        writer = StreamingResultsWriter(scenario["name"], self._steps, self._m, self._results_path,
+                                        self._results_format, metadata, offsets)
+        chunks = profiler.iterate("stepping", system.stream(z0, profile, self._steps, self._chunk_steps, start))
+        for chunk, (indices, x, w, u, y) in enumerate(chunks):
+            profiler.count("ticks", len(indices))
+            T = indices*self._time_step_sec
+            with profiler.stage("io"):
+                writer.write(T, x, w, u, y)
+            with profiler.stage("metrics"):
+                for reducer in self._reducers:
+                    reducer.update(T, x, w, u, y)
+            if self._checkpoint_dir is not None and (chunk+1) % self._checkpoint_chunks == 0 and indices[-1] < self._steps-1:
+                # The state at the last tick of the chunk, its PID error history is within the chunk
+                with profiler.stage("io"):
+                    Checkpoint.from_state(system, system.state_at(x, u, y, len(indices)-1), int(indices[-1]),
+                                          {"steps": self._steps, "results_format": self._results_format, "system": system.fingerprint(),
+                                           "reducers": self._reducers, "offsets": writer.offsets()}
+                                          ).save(self._checkpoint_path(scenario["name"]))
+        with profiler.stage("io"):
+            writer.close()
+        profiler.count("scenarios")
+        if self._checkpoint_dir is not None:
+            self._checkpoint_path(scenario["name"]).unlink(missing_ok=True)
+        
+        
+    def _checkpoint_path(self, name) -> Path:
+        return Path(self._checkpoint_dir, f"{name}.ckpt")
+        
+        
+    def _load_checkpoint(self, name, system: FusedSystem) -> Checkpoint | None:
+        if self._checkpoint_dir is None or not self._checkpoint_path(name).exists():
+            return None
+        checkpoint = Checkpoint.load(self._checkpoint_path(name))
+        if (checkpoint.extra["steps"], checkpoint.extra["results_format"]) != (self._steps, self._results_format):
+            raise ValueError(f"The checkpoint of {name} is of a simulation of {checkpoint.extra['steps']} steps "
+                             f"in the {checkpoint.extra['results_format']} format, not {self._steps} in {self._results_format}.")
+        # A state of a different system (parameters, gains, setpoints or time step) cannot be continued
+        if checkpoint.extra.get("system") != system.fingerprint():
+            raise ValueError(f"The checkpoint of {name} is of a different system, delete {self._checkpoint_path(name)} to start over.")
+        print(f"Resuming {name} from the time step {checkpoint.tick + 1}")
+        return checkpoint
+        
+        
+    def plot_and_print_results(self, plot_all=False, renderer=None):
+        self.print_results()
+        
+        
+    def print_results(self):
+        summary = self.get_summary()
+        print(f"Frequency nadir for each area in {self._scenario["description"]}: "
+              + " | ".join([f"Area {i+1}: {round(nadir, 4)} Hz" for i, nadir in enumerate(summary["nadir_Hz"])]))
+        self._print_final_frequencies(summary["final_freq_Hz"])
+        self._save_metrics_to_file()
\ No newline at end of file
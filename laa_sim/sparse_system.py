@@ -0,0 +1,109 @@
+import numpy as np
+import scipy.sparse
+
+from controller import PIDControllerBank
+from fused_system import FusedSystem
+
+
+class SparseSystem(FusedSystem):
+    # The augmented system of FusedSystem with M and L in CSR form, assembled from
+    # coordinate lists: the Ad blocks of the areas on the diagonal, one B1d column per
+    # tie-line, and the PID rows, which use only the two nonzeros of Cd. A step costs
+    # nnz(M) instead of the square of the number of states of the whole system.
+    def _set_system_matrix(self) -> None:
+        error_gain, prev_error_gain, second_prev_error_gain = self._controllers.get_velocity_form_gains()
+        rows, cols, values = [], [], []
+        def add(row, col, value):
+            row, col, value = np.broadcast_arrays(row, col, value)
+            rows.append(row.ravel())
+            cols.append(col.ravel())
+            values.append(value.ravel())
+
+        tie_lines = scipy.sparse.coo_array(self.Tij)
+        for i, area in enumerate(self._areas):
+            xi = np.arange(self.x_slices[i].start, self.x_slices[i].stop)
+            u, e1, e2 = self.u_indices[i], self.e1_indices[i], self.e2_indices[i]
+            Cd_nonzero = np.flatnonzero(area.Cd)
+
+            # Area dynamics and LFC input
+            add(xi[:, None], xi[None, :], area.Ad)
+            add(xi, u, area.B2d[:, 0])
+
+            # Incremental PID with error = setpoint - Cd @ x_i
+            add(u, [u, e1, e2], [1, prev_error_gain[i], second_prev_error_gain[i]])
+            add(u, xi[Cd_nonzero], -error_gain[i]*area.Cd[Cd_nonzero])
+            add(e1, xi[Cd_nonzero], -area.Cd[Cd_nonzero])
+            add(e2, e1, 1)
+
+        # Tie-lines change v_i = sum_j Tij[i][j]*x_j[0], only over the existing tie-lines
+        for i, j, Tij in zip(tie_lines.row, tie_lines.col, tie_lines.data):
+            add(np.arange(self.x_slices[i].start, self.x_slices[i].stop), self.x_slices[j].start,
+                self._areas[i].B1d[:, 1]*Tij)
+
+        # Duplicates (an area with a tie-line to itself) are summed
+        self.M = scipy.sparse.csr_array((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                        shape=(self.size, self.size))
+        self.M.eliminate_zeros()
+
+
+    def _set_load_matrix_and_offset(self) -> None:
+        error_gain, _, _ = self._controllers.get_velocity_form_gains()
+        setpoints = self._controllers.get_setpoints()
+
+        rows = np.concatenate([np.arange(xi.start, xi.stop) for xi in self.x_slices])
+        cols = np.concatenate([np.full(xi.stop - xi.start, i) for i, xi in enumerate(self.x_slices)])
+        values = np.concatenate([area.B1d[:, 0] for area in self._areas])
+        self.L = scipy.sparse.csr_array((values, (rows, cols)), shape=(self.size, self._n))
+        self.L.eliminate_zeros()
+
+        self.offset = np.zeros(self.size)
+        self.offset[self.u_indices] = error_gain*setpoints
+        self.offset[self.e1_indices] = setpoints
+
+
+    def closed_loop_matrices(self, Ks) -> np.ndarray:
+        # Dense as those of FusedSystem, for eigenvalues and stacked products of few states
+        Ms = np.repeat(self.M.toarray()[None], len(Ks), axis=0)
+        for M, K in zip(Ms, Ks):
+            self._set_controller_rows(M, PIDControllerBank(K, 0, self._time_step_sec))
+        return Ms
+
+
+    def step_responses(self, steps, outputs) -> np.ndarray:
+        return self._propagate(self.L.toarray(), steps, outputs).transpose(2, 0, 1)
+
+
+    def simulate_batch(self, xs, ws, us, ys, indices, chunk_steps=1024) -> None:
+        # All scenarios are advanced together as a (states x scenarios) array with one
+        # sparse product per step, the drive of the loads is also formed step by step.
+        # As in FusedSystem, the states are kept for chunk_steps steps at a time.
+        steps = len(indices)
+        z = np.empty([min(chunk_steps, steps), self.size, len(ws)])
+        z_prev = np.stack([self.initial_state(x, u) for x, u in zip(xs, us)], axis=1)
+        for start in range(0, steps, chunk_steps):
+            end = min(start+chunk_steps, steps)
+            loads = np.stack([w[max(start-1, 0):end-1, :, 0] for w in ws], axis=2) # steps x n x scenarios
+            for k, t in enumerate(range(start, end)):
+                if t == 0:
+                    z[k] = z_prev
+                else:
+                    z[k] = self.M @ z_prev + self.L @ loads[t-1-max(start-1, 0)]
+                    z[k] += self.offset[:, None]
+                z_prev = z[k]
+            for s in range(len(ws)):
+                self._scatter_rows(start, z[:end-start, :, s], xs[s], ws[s], us[s], ys[s], steps)
+
+
+    def stream(self, z0, profile, steps, chunk_steps, start=0):
+        # Chunks as those of FusedSystem.stream, with one sparse product per step
+        z_prev = z0
+        for chunk_start in range(start, steps, chunk_steps):
+            indices = np.arange(chunk_start, min(chunk_start+chunk_steps, steps))
+            load = profile.evaluate(indices)
+            drive = profile.evaluate(np.maximum(indices-1, 0)) @ self.L.T + self.offset
+
+            z = np.empty([len(indices), self.size])
+            for k, t in enumerate(indices):
+                z[k] = z0 if t == 0 else self.M @ z_prev + drive[k]
+                z_prev = z[k]
+            yield (indices, *self._split_chunk(indices, z, load, steps))
@@ -0,0 +1,202 @@
+import numpy as np
+import argparse
+import json
+import csv
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from genparams import GenParams
+from laa_scenarios import ScenariosParser
+from system_config import SystemConfig
+from simulation import StateInputOutputVectors, build_fused_system
+from reducers import FrequencyExtremaReducer, FrequencySecurityReducer
+from discretisation_cache import set_cache_dir
+from eigen_analysis import STABILITY_TOLERANCE
+from utils import iter_batches
+
+
+SWEPT_PARAMETERS = ["D", "H", "Tt", "Tg", "R", "alpha", "Tij", "K"]
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run a Monte Carlo sweep of the LFC under the LAA scenarios over perturbed system parameters.")
+    parser.add_argument("-c", "--config", type=str, default="sweep_config.json", help="The path to the JSON file with the system, the parameter distributions and the scenarios of the sweep.")
+    parser.add_argument("-o", "--output", type=str, default="results/sweep.csv", help="The path to the CSV file with the metrics of every sample.")
+    parser.add_argument("-wk", "--workers", type=int, default=1, help="The number of worker processes simulating the samples in parallel.")
+    parser.add_argument("-b", "--batch_size", type=int, default=0, help="Advance up to this many scenarios of a sample together. By default, all scenarios of a sample are batched.")
+    parser.add_argument("-dc", "--discretisation_cache_dir", type=str, default=None, help="Store the discretised matrices of the areas in this directory and reuse them in later runs.")
+    return parser.parse_args()
+
+
+DISTRIBUTION_BOUNDS = {"normal": ("relative_std", 0, np.inf), "uniform": ("relative_range", 0, 1),
+                       "lognormal": ("sigma", 0, np.inf)}
+
+
+def validate_distributions(distributions, source="config") -> None:
+    # Every entry is scaled by a positive factor, so a uniform factor must stay above zero
+    unknown = set(distributions) - set(SWEPT_PARAMETERS)
+    if unknown:
+        raise ValueError(f"{source}: cannot sweep {sorted(unknown)}, expected some of {SWEPT_PARAMETERS}.")
+    for key, distribution in distributions.items():
+        kind = distribution.get("distribution")
+        if kind not in DISTRIBUTION_BOUNDS:
+            raise ValueError(f"{source}: unknown distribution {kind} of {key}, expected {', '.join(DISTRIBUTION_BOUNDS)}.")
+        name, low, high = DISTRIBUTION_BOUNDS[kind]
+        value = distribution.get(name)
+        if not isinstance(value, (int, float)) or not low <= value < high:
+            raise ValueError(f"{source}: {name} of the {kind} distribution of {key} must be in [{low}, {high}), got {value}.")
+
+
+def sample_values(base, distribution, rng) -> np.ndarray:
+    # Perturbs every entry of base independently by a positive factor, so zero entries stay zero
+    # and no entry changes its sign (H, D, R, Tt and Tg stay positive). Normal factors that are
+    # not positive are drawn again, which truncates the distribution at zero.
+    base = np.asarray(base, dtype=np.float64)
+    kind = distribution["distribution"]
+    if kind == "normal":
+        factors = 1 + distribution["relative_std"]*rng.standard_normal(base.shape)
+        invalid = factors <= 0
+        while np.any(invalid):
+            factors[invalid] = 1 + distribution["relative_std"]*rng.standard_normal(np.count_nonzero(invalid))
+            invalid = factors <= 0
+        return base*factors
+    if kind == "uniform":
+        return base*rng.uniform(1 - distribution["relative_range"], 1 + distribution["relative_range"], base.shape)
+    if kind == "lognormal":
+        return base*np.exp(distribution["sigma"]*rng.standard_normal(base.shape))
+    raise ValueError(f"Unknown distribution {kind}, expected {', '.join(DISTRIBUTION_BOUNDS)}.")
+
+
+def sample_parameters(system: SystemConfig, split, distributions, samples, seed) -> list[dict]:
+    validate_distributions(distributions)
+    rng = np.random.default_rng(seed)
+    base = {"D": system.D, "H": system.H, "Tt": system.Tt, "Tg": system.Tg, "R": system.R,
+            "alpha": system.splits[split-1]["alpha"], "Tij": system.Tij, "K": system.K}
+    parameters = []
+    for _ in range(samples):
+        sample = {key: np.array(value, dtype=np.float64) for key, value in base.items() if key != "alpha"}
+        sample["alpha"] = [np.array(alpha, dtype=np.float64) for alpha in base["alpha"]]
+        for key, distribution in distributions.items():
+            if key == "alpha":
+                # AGC participation factors must still sum to 1 in every area
+                alpha = [sample_values(area_alpha, distribution, rng) for area_alpha in sample["alpha"]]
+                sample["alpha"] = [area_alpha/np.sum(area_alpha) for area_alpha in alpha]
+            elif key == "Tij":
+                # Tie-lines stay symmetric
+                Tij = np.triu(sample_values(sample["Tij"], distribution, rng), 1)
+                sample["Tij"] = Tij + Tij.T
+            else:
+                sample[key] = sample_values(sample[key], distribution, rng)
+        parameters.append(sample)
+    return parameters
+
+
+def flatten_parameters(sample, swept) -> dict:
+    row = {}
+    for key in swept:
+        values = sample[key]
+        if key == "alpha":
+            for i, area_alpha in enumerate(values):
+                row.update({f"alpha_{i+1}_{j+1}": value for j, value in enumerate(area_alpha)})
+        else:
+            for index, value in np.ndenumerate(values):
+                row["_".join([key] + [str(k+1) for k in index])] = value
+    return row
+
+
+def run_sample(system: SystemConfig, split, sample, scenarios, sim_time_sec, batch_size) -> dict:
+    # Metrics of one sample, aggregated as the worst case over its scenarios and areas
+    time_step_sec = system.time_step_sec
+    gen_params = GenParams(system.f0, system.base_MV, system.n, system.splits[split-1]["m"], sample["D"], sample["H"],
+                           sample["Tt"], sample["Tg"], sample["R"], sample["alpha"], sample["Tij"])
+    fused_system = build_fused_system(gen_params, sample["K"], system.setpoint, time_step_sec)
+    spectral_radius = np.max(np.abs(np.linalg.eigvals(fused_system.M)))
+    row = {"spectral_radius": spectral_radius, "stable": bool(spectral_radius < 1 + STABILITY_TOLERANCE)}
+    if not row["stable"]:
+        return row
+
+    steps = int(sim_time_sec/time_step_sec)
+    T = np.arange(steps)*time_step_sec
+    records = []
+    for batch in iter_batches(scenarios, batch_size if batch_size > 0 else None):
+        vectors = [StateInputOutputVectors(gen_params.n, gen_params.m, T, time_step_sec, None,
+                                           scenario["areas_attacks"]) for scenario in batch]
+        fused_system.simulate_batch([v.get_x() for v in vectors], [v.get_w() for v in vectors],
+                                    [v.get_u() for v in vectors], [v.get_y() for v in vectors], np.arange(steps))
+        for scenario, v in zip(batch, vectors):
+            record = {"name": scenario["name"]}
+            for reducer in [FrequencyExtremaReducer(system.f0), FrequencySecurityReducer(system.f0)]:
+                reducer.update(T, v.get_x(), v.get_w(), v.get_u(), v.get_y())
+                record.update(reducer.result())
+            records.append(record)
+    return dict(row, **aggregate_records(records))
+
+
+def aggregate_records(records) -> dict:
+    nadirs = [min(record["nadir_Hz"]) for record in records]
+    settling = [np.nan if None in record["settling_time_sec"] else max(record["settling_time_sec"]) for record in records]
+    row = {"worst_nadir_Hz": min(nadirs), "worst_nadir_scenario": records[int(np.argmin(nadirs))]["name"],
+           "max_zenith_Hz": max(max(record["zenith_Hz"]) for record in records),
+           "max_abs_rocof_Hz_per_s": max(max(record["max_abs_rocof_Hz_per_s"]) for record in records),
+           "max_settling_time_sec": max(settling), "unsettled_scenarios": int(np.sum(np.isnan(settling)))}
+    for band in records[0]["time_outside_sec"]:
+        times = [max(record["time_outside_sec"][band]) for record in records]
+        row[f"max_time_outside_{band}_sec"] = max(times)
+        row[f"scenarios_outside_{band}"] = int(np.count_nonzero(times))
+    return row
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    # The system is a path to a system config (see system.json) or given inline
+    if isinstance(config["system"], str):
+        system = SystemConfig.load(config["system"])
+    else:
+        system = SystemConfig(config["system"], args.config)
+    split = config.get("split", 1)
+    system.split(split) # Validates the split number
+    distributions = config["parameters"]
+    validate_distributions(distributions, args.config)
+    samples = sample_parameters(system, split, distributions, config["samples"], config.get("seed"))
+
+    scenarios_file = config.get("scenarios_file", "scenarios.json")
+    parser = ScenariosParser(scenarios_file, config["sim_time_sec"])
+    if "scenarios" in config:
+        scenarios = [parser.get_scenario(name) for name in config["scenarios"]]
+        missing = [name for name, scenario in zip(config["scenarios"], scenarios) if scenario is None]
+        if missing:
+            raise ValueError(f"Scenarios {missing} are not in {scenarios_file}.")
+    else:
+        scenarios = parser.get_all_scenarios()
+
+    set_cache_dir(args.discretisation_cache_dir)
+    executor = ProcessPoolExecutor(args.workers, initializer=set_cache_dir,
+                                   initargs=(args.discretisation_cache_dir,)) if args.workers > 1 else None
+    tasks = [(system, split, sample, scenarios, config["sim_time_sec"], args.batch_size) for sample in samples]
+    if executor is not None:
+        results = executor.map(run_sample, *zip(*tasks))
+    else:
+        results = (run_sample(*task) for task in tasks)
+
+    rows = [dict({"sample": i}, **flatten_parameters(sample, distributions), **result)
+            for i, (sample, result) in enumerate(zip(samples, results))]
+    if executor is not None:
+        executor.shutdown()
+
+    # Unstable samples have no metrics, the header covers the columns of all rows
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    unstable = sum(not row["stable"] for row in rows)
+    worst = min((row for row in rows if row["stable"]), key=lambda row: row["worst_nadir_Hz"], default=None)
+    print(f"Swept {len(rows)} samples, {unstable} unstable, results saved to {args.output}")
+    if worst is not None:
+        print(f"Worst nadir {round(worst["worst_nadir_Hz"], 4)} Hz in sample {worst["sample"]} ({worst["worst_nadir_scenario"]})")
@@ -0,0 +1,91 @@
+import numpy as np
+import tomllib
+import json
+
+from pathlib import Path
+
+from genparams import GenParams
+
+
+class SystemConfig:
+    # Validated parameters of the power system from a JSON or TOML file (see system.json):
+    # f0, base_MV, n, D, H (per area), Tt, Tg, R (per governor-turbine unit), Tij (n x n),
+    # splits (list of m - units in every area and alpha - AGC participation of the units),
+    # K (n x 3 PID gains Kp, Ki, Kd), setpoint and time_step_sec.
+    # The file may also hold the parameters in a "system" section (as sweep_config.json).
+    # GenParams of a split are built only when the split is requested.
+    REQUIRED = ["f0", "base_MV", "n", "D", "H", "Tt", "Tg", "R", "Tij", "splits", "K", "setpoint", "time_step_sec"]
+
+
+    def __init__(self, config: dict, source="config") -> None:
+        if "system" in config:
+            config = config["system"]
+        self._source = source
+        missing = [key for key in self.REQUIRED if key not in config]
+        if missing:
+            raise ValueError(f"{source}: missing system parameters {missing}.")
+        self.f0 = config["f0"]
+        self.base_MV = config["base_MV"]
+        self.n = config["n"]
+        self.D = np.array(config["D"])
+        self.H = np.array(config["H"])
+        self.Tt = list(config["Tt"])
+        self.Tg = list(config["Tg"])
+        self.R = list(config["R"])
+        self.Tij = np.array(config["Tij"])
+        self.splits = config["splits"]
+        self.K = np.array(config["K"])
+        self.setpoint = config["setpoint"]
+        self.time_step_sec = config["time_step_sec"]
+        self._validate()
+        self._gen_params = {}
+
+
+    @classmethod
+    def load(cls, path) -> "SystemConfig":
+        path = Path(path)
+        if path.suffix == ".toml":
+            with open(path, "rb") as config_file:
+                return cls(tomllib.load(config_file), str(path))
+        with open(path) as config_file:
+            return cls(json.load(config_file), str(path))
+
+
+    @property
+    def number_of_splits(self) -> int:
+        return len(self.splits)
+
+
+    def split(self, split) -> GenParams:
+        # Generator parameters of a split numbered from 1
+        if not 1 <= split <= self.number_of_splits:
+            raise ValueError(f"{self._source}: split {split} does not exist, expected 1 to {self.number_of_splits}.")
+        if split not in self._gen_params:
+            parameters = self.splits[split-1]
+            self._gen_params[split] = GenParams(self.f0, self.base_MV, self.n, parameters["m"], self.D, self.H,
+                                                self.Tt, self.Tg, self.R,
+                                                [np.array(alpha) for alpha in parameters["alpha"]], self.Tij)
+        return self._gen_params[split]
+
+
+    def _validate(self) -> None:
+        units = len(self.Tt)
+        self._check(self.time_step_sec > 0, "time_step_sec must be positive")
+        self._check(self.D.shape == (self.n,) and self.H.shape == (self.n,), f"D and H must have {self.n} values, one per area")
+        self._check(len(self.Tg) == units and len(self.R) == units, "Tt, Tg and R must have one value per unit")
+        self._check(self.Tij.shape == (self.n, self.n), f"Tij must be a {self.n} x {self.n} matrix")
+        self._check(np.allclose(self.Tij, self.Tij.T) and not np.diagonal(self.Tij).any(), "Tij must be symmetric with a zero diagonal")
+        self._check(self.K.shape == (self.n, 3), f"K must be a {self.n} x 3 matrix of Kp, Ki and Kd")
+        self._check(len(self.splits) > 0, "at least one split is required")
+        for k, split in enumerate(self.splits):
+            m, alpha = split.get("m", []), split.get("alpha", [])
+            self._check(len(m) == self.n and sum(m) == units, f"m of split {k+1} must give the units of {self.n} areas summing to {units}")
+            self._check(len(alpha) == self.n, f"alpha of split {k+1} must have {self.n} areas")
+            for i in range(self.n):
+                self._check(len(alpha[i]) == m[i], f"alpha of area {i+1} in split {k+1} must have {m[i]} values")
+                self._check(np.isclose(np.sum(alpha[i]), 1), f"alpha of area {i+1} in split {k+1} must sum to 1")
+
+
+    def _check(self, condition, message) -> None:
+        if not condition:
+            raise ValueError(f"{self._source}: {message}.")
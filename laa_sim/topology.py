@@ -0,0 +1,204 @@
+import numpy as np
+import scipy.sparse
+import argparse
+import json
+import time
+
+from area import Area
+from genparams import GenParams
+from laa_scenarios import ScenariosParser
+from load_profiles import LoadProfile
+from reducers import FrequencyExtremaReducer
+from simulation import StateInputOutputVectors
+from sparse_system import SparseSystem
+from utils import freq_per_unit_to_Hz
+
+
+# Argument parsing
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate a large multi-area system described by a topology file with sparse stepping.")
+    parser.add_argument("-tp", "--topology", type=str, default="topology.json", help="The path to the JSON topology file with the areas, their units and the tie-lines.")
+    parser.add_argument("-g", "--generate", type=int, nargs=2, default=None, metavar=("AREAS", "UNITS"), help="Write a ring of this many areas with this many units per area to --topology instead of simulating.")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="The seed of the generated topology.")
+    parser.add_argument("-f", "--file_path", type=str, default="scenarios.json", help="The path to the JSON file containing the scenarios. Areas missing in a scenario are not attacked.")
+    parser.add_argument("-s", "--scenario_name", type=str, default=None, help="The name of the scenario to run. By default, all scenarios in the file.")
+    parser.add_argument("-t", "--sim_time_sec", type=int, default=300, help="The end time of the simulation in seconds.")
+    parser.add_argument("-e", "--end", type=int, default=300, help="The end time of the attacks in seconds.")
+    parser.add_argument("-str", "--stream", action="store_true", help="Simulate the scenarios one by one in chunks, with memory independent of the simulation time and the number of scenarios.")
+    parser.add_argument("-cs", "--chunk_steps", type=int, default=10000, help="The number of time steps in one chunk of the streaming simulation.")
+    args = parser.parse_args()
+    if args.chunk_steps < 1:
+        parser.error("--chunk_steps must be at least 1.")
+    return args
+
+
+class Topology:
+    # Interconnection of areas from a JSON topology file:
+    # {"f0": 60, "base_MV": 250, "time_step_sec": 0.01, "setpoint": 0,
+    #  "areas": [{"D": 0.015, "H": 5.031, "K": [4.5, 1.1, 2.8],
+    #             "units": [{"Tt": 0.4, "Tg": 0.08, "R": 3, "alpha": 0.4}, ...]}, ...],
+    #  "tie_lines": [[1, 2, 0.2], [1, 3, 0.25], ...]}
+    # Areas are numbered from 1, every tie-line connects both areas with the same coefficient.
+    # The continuous matrices are assembled for all units at once in coordinate form, so their cost
+    # grows with the number of nonzeros, not with the square of the number of states of an area.
+    def __init__(self, topology: dict) -> None:
+        self.f0 = topology["f0"]
+        self.base_MV = topology["base_MV"]
+        self.time_step_sec = topology["time_step_sec"]
+        self.setpoint = topology.get("setpoint", 0)
+        areas = topology["areas"]
+        self.n = len(areas)
+        self.m = [len(area["units"]) for area in areas]
+        self.D = np.array([area["D"] for area in areas], dtype=np.float64)
+        self.H = np.array([area["H"] for area in areas], dtype=np.float64)
+        self.K = np.array([area["K"] for area in areas], dtype=np.float64)
+        for key in ["Tt", "Tg", "R", "alpha"]:
+            setattr(self, key, np.array([unit[key] for area in areas for unit in area["units"]], dtype=np.float64))
+        self._set_tie_lines(topology["tie_lines"])
+        self._validate()
+        # The same droop characteristic as in GenParams
+        self._unit_area = np.repeat(np.arange(self.n), self.m)
+        self.beta = self.D + 1/np.bincount(self._unit_area, weights=self.R, minlength=self.n)
+
+
+    @classmethod
+    def load(cls, path) -> "Topology":
+        with open(path) as topology_file:
+            return cls(json.load(topology_file))
+
+
+    @classmethod
+    def from_gen_params(cls, gen_params: GenParams, K, setpoint, time_step_sec) -> "Topology":
+        areas = [{"D": gen_params.D[i], "H": gen_params.H[i], "K": list(K[i]),
+                  "units": [{"Tt": gen_params.Tt[i][j], "Tg": gen_params.Tg[i][j], "R": gen_params.R[i][j],
+                             "alpha": gen_params.alpha[i][j]} for j in range(gen_params.m[i])]}
+                 for i in range(gen_params.n)]
+        Tij = np.asarray(gen_params.Tij)
+        tie_lines = [[i+1, j+1, Tij[i][j]] for i in range(gen_params.n) for j in range(i+1, gen_params.n) if Tij[i][j] != 0]
+        return cls({"f0": gen_params.f0, "base_MV": gen_params.base_MV, "time_step_sec": time_step_sec,
+                    "setpoint": setpoint, "areas": areas, "tie_lines": tie_lines})
+
+
+    @staticmethod
+    def generate_ring(n, units_per_area, seed=None) -> dict:
+        # A ring of n areas with random parameters in the ranges of the IEEE 39-bus split
+        rng = np.random.default_rng(seed)
+        areas = []
+        for _ in range(n):
+            alpha = rng.uniform(0.5, 1.5, units_per_area)
+            areas.append({"D": rng.uniform(0.014, 0.015), "H": rng.uniform(3.7, 6.1), "K": [4, 1.1, 2.5],
+                          "units": [{"Tt": rng.uniform(0.3, 0.48), "Tg": rng.uniform(0.06, 0.08),
+                                     "R": rng.uniform(2.3, 3.3), "alpha": a/alpha.sum()} for a in alpha]})
+        tie_lines = [[i+1, (i+1) % n + 1, rng.uniform(0.12, 0.25)] for i in range(n if n > 2 else n-1)]
+        return {"f0": 60, "base_MV": 250, "time_step_sec": 0.01, "setpoint": 0, "areas": areas, "tie_lines": tie_lines}
+
+
+    def _set_tie_lines(self, tie_lines) -> None:
+        tie_lines = np.array(tie_lines, dtype=np.float64).reshape(-1, 3)
+        i, j = tie_lines[:, 0].astype(int) - 1, tie_lines[:, 1].astype(int) - 1
+        if np.any((i < 0) | (i >= self.n) | (j < 0) | (j >= self.n)):
+            raise ValueError(f"Tie-lines must connect areas 1 to {self.n}.")
+        self.Tij = scipy.sparse.csr_array((np.concatenate([tie_lines[:, 2], tie_lines[:, 2]]),
+                                           (np.concatenate([i, j]), np.concatenate([j, i]))), shape=(self.n, self.n))
+
+
+    def _validate(self) -> None:
+        for i, units in enumerate(np.split(self.alpha, np.cumsum(self.m)[:-1])):
+            if len(units) == 0:
+                raise ValueError(f"Area {i+1} has no units.")
+            if not np.isclose(units.sum(), 1):
+                raise ValueError(f"Alpha of the units of area {i+1} sums to {units.sum()}, it must sum to 1.")
+
+
+    def continuous_matrices(self) -> tuple[scipy.sparse.csr_array, ...]:
+        # Block diagonal A, B1 (load, tie-line columns) and B2 of all areas with the state layout
+        # of MatrixA: [frequency, tie-line, turbines, governors] of every area.
+        sizes = 2 + 2*np.array(self.m)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        size = sizes.sum()
+        area = self._unit_area
+        local = np.arange(len(area)) - np.repeat(np.cumsum(self.m) - self.m, self.m)
+        freq, tie = starts, starts + 1
+        turbine = starts[area] + 2 + local
+        governor = starts[area] + 2 + np.array(self.m)[area] + local
+
+        # The same floating point operations as MatrixA, MatrixB1 and MatrixB2
+        Hi_inv = 1/(2*self.H)
+        sumTj = np.asarray(self.Tij.sum(axis=1)).ravel()
+        A = scipy.sparse.csr_array((
+            np.concatenate([-self.D*Hi_inv, -Hi_inv, 2*np.pi*sumTj, np.repeat(Hi_inv, self.m),
+                            -1/self.Tt, 1/self.Tt, -1/(self.Tg*self.R), -1/self.Tg]),
+            (np.concatenate([freq, freq, tie, freq[area], turbine, turbine, governor, governor]),
+             np.concatenate([freq, tie, freq, turbine, turbine, governor, freq[area], governor]))), shape=(size, size))
+        B1 = scipy.sparse.csr_array((np.concatenate([-Hi_inv, np.full(self.n, -2*np.pi)]),
+                                     (np.concatenate([freq, tie]), np.repeat([0, 1], self.n))), shape=(size, 2))
+        B2 = scipy.sparse.csr_array((self.alpha/self.Tg, (governor, np.zeros(len(area), dtype=int))), shape=(size, 1))
+        return A, B1, B2
+
+
+    def build_areas(self) -> list[Area]:
+        # Only the discretisation of every area needs its dense block
+        A, B1, B2 = self.continuous_matrices()
+        areas = []
+        start = 0
+        for i in range(self.n):
+            block = slice(start, start + 2+2*self.m[i])
+            C = np.concatenate([[self.beta[i], 1], np.zeros(2*self.m[i])])
+            areas.append(Area(i+1, self.m[i], A[block, block].toarray(), B1[block].toarray(), B2[block].toarray(),
+                              C, self.time_step_sec))
+            start = block.stop
+        return areas
+
+
+    def build_system(self) -> SparseSystem:
+        return SparseSystem(self.build_areas(), self.Tij.toarray(), self.K, self.setpoint, self.time_step_sec)
+
+
+def simulate_topology(args) -> None:
+    topology = Topology.load(args.topology)
+    start = time.perf_counter()
+    system = topology.build_system()
+    print(f"Assembled {topology.n} areas with {sum(topology.m)} units: {system.size} states, "
+          f"{system.M.nnz} nonzeros in {round(time.perf_counter() - start, 3)} s")
+
+    parser = ScenariosParser(args.file_path, args.end)
+    if args.scenario_name is not None:
+        scenarios = [scenario for scenario in [parser.get_scenario(args.scenario_name)] if scenario is not None]
+    else:
+        scenarios = parser.get_all_scenarios()
+    steps = int(args.sim_time_sec/topology.time_step_sec)
+    areas_attacks = [(scenario["areas_attacks"] + [[]]*topology.n)[:topology.n] for scenario in scenarios]
+
+    start = time.perf_counter()
+    if args.stream:
+        nadirs = [stream_nadirs(topology, system, attacks, steps, args.chunk_steps) for attacks in areas_attacks]
+    else:
+        T = np.arange(steps)*topology.time_step_sec
+        vectors = [StateInputOutputVectors(topology.n, topology.m, T, topology.time_step_sec, None, attacks)
+                   for attacks in areas_attacks]
+        system.simulate_batch([v.get_x() for v in vectors], [v.get_w() for v in vectors], [v.get_u() for v in vectors],
+                              [v.get_y() for v in vectors], np.arange(steps))
+        nadirs = [[freq_per_unit_to_Hz(x[:, 0].min(), topology.f0) for x in v.get_x()] for v in vectors]
+    print(f"Simulated {len(scenarios)} scenarios of {steps} steps in {round(time.perf_counter() - start, 3)} s")
+    for scenario, scenario_nadirs in zip(scenarios, nadirs):
+        print(f"{scenario["name"]}: nadir {round(min(scenario_nadirs), 4)} Hz in area {int(np.argmin(scenario_nadirs))+1}")
+
+
+def stream_nadirs(topology, system: SparseSystem, areas_attacks, steps, chunk_steps) -> list[float]:
+    # Frequency nadir of every area, reduced chunk by chunk without storing the trajectories
+    z0 = np.zeros(system.size) # The system starts at rest, as in StateInputOutputVectors
+    reducer = FrequencyExtremaReducer(topology.f0)
+    profile = LoadProfile.from_attacks(areas_attacks, topology.time_step_sec)
+    for indices, x, w, u, y in system.stream(z0, profile, steps, chunk_steps):
+        reducer.update(indices*topology.time_step_sec, x, w, u, y)
+    return reducer.result()["nadir_Hz"]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.generate is not None:
+        with open(args.topology, "w") as topology_file:
+            json.dump(Topology.generate_ring(*args.generate, args.seed), topology_file, indent=4)
+        print(f"Topology of {args.generate[0]} areas with {args.generate[1]} units each saved to {args.topology}")
+    else:
+        simulate_topology(args)
@@ -1,2 +1,32 @@
+import itertools
+import os
+
+from contextlib import contextmanager
+from pathlib import Path
+
+
 def freq_per_unit_to_Hz(per_unit, f0):
-    return per_unit*f0 + f0
\ No newline at end of file
+    return per_unit*f0 + f0
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    # A file opened under a unique name and renamed to path when the block completes, so concurrent
+    # processes never see a partial file and a failed write keeps the previous one
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def iter_batches(items, batch_size=None):
+    # Consecutive lists of at most batch_size items (all of them if None), taken from the iterable
+    # only when they are needed, so that a lazily read iterable is never held whole
+    items = iter(items)
+    while batch := list(itertools.islice(items, batch_size)):
+        yield batch